@@ -0,0 +1,84 @@
+import argparse
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+from pathlib import Path
+import sys
+import tempfile
+import time
+
+from dashcamtools.util import Snowflake
+
+parser = argparse.ArgumentParser()
+# 並行して ID を生成するスレッドまたはプロセスの数。
+parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+# スレッドまたはプロセス 1 つあたりに生成する ID の数。
+parser.add_argument("--count", type=int, default=50000)
+# 比較する予約の単位。1 では ID ごとに予約する。
+parser.add_argument("--block-sizes", type=int, nargs="+", default=[1, 64])
+
+args = parser.parse_args()
+
+workers_list: list[int] = args.workers
+count: int = args.count
+block_sizes: list[int] = args.block_sizes
+
+MACHINE_ID = 1
+
+class SteppingSnowflake(Snowflake):
+    # 一定の回数ごとに時計を 50 ミリ秒戻し、NTP による補正を再現する。
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.calls = 0
+
+    def _timestamp(self) -> int:
+        self.calls += 1
+        return super()._timestamp() - 50 * (self.calls // 1000 % 2)
+
+def generate(snowflake: Snowflake, count: int) -> array:
+    ids = array("q")
+    for _ in range(count):
+        ids.append(snowflake.generate())
+    return ids
+
+def generate_in_process(block_size: int, state_path: Path, count: int) -> bytes:
+    return generate(Snowflake(MACHINE_ID, block_size=block_size, state_path=state_path), count).tobytes()
+
+def run_threads(snowflake: Snowflake, workers: int) -> tuple[float, list[int]]:
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda _: generate(snowflake, count), range(workers)))
+    return time.perf_counter() - start, [id for ids in results for id in ids]
+
+def run_processes(block_size: int, workers: int) -> tuple[float, list[int]]:
+    # 同じ machine_id のプロセスが、状態のファイルを共有して予約する。
+    with tempfile.TemporaryDirectory() as temp_dir, multiprocessing.Pool(workers) as pool:
+        state_path = Path(temp_dir, "snowflake.state")
+        start = time.perf_counter()
+        results = pool.starmap(generate_in_process, [(block_size, state_path, count)] * workers)
+        elapsed = time.perf_counter() - start
+    return elapsed, [id for result in results for id in array("q", result)]
+
+def main():
+    failed = False
+    print("\t".join(["mode", "block_size", "workers", "ids_per_second", "duplicates"]))
+
+    def report(mode: str, block_size: int, workers: int, elapsed: float, ids: list[int]):
+        nonlocal failed
+        duplicates = len(ids) - len(set(ids))
+        failed = failed or duplicates > 0
+        print("\t".join([mode, str(block_size), str(workers), f"{len(ids) / elapsed:.0f}", str(duplicates)]))
+
+    for block_size in block_sizes:
+        for workers in workers_list:
+            report("threads", block_size, workers, *run_threads(Snowflake(MACHINE_ID, block_size=block_size), workers))
+        for workers in workers_list:
+            report("processes", block_size, workers, *run_processes(block_size, workers))
+        report("clock-steps", block_size, max(workers_list), *run_threads(SteppingSnowflake(MACHINE_ID, block_size=block_size), max(workers_list)))
+
+    if failed:
+        print("Duplicate IDs generated.", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+# 起動時間を測るコマンド。いずれも --help で、引数の解析だけを行って終了する。
+COMMANDS = ["compress", "extract", "fill_attributes", "report", "set_timestamp", "ssim", "tune"]
+# --help で読み込まれてはならないモジュール。読み込まれていれば、遅延させたはずの import が戻っている。
+FORBIDDEN_MODULES = ["sqlalchemy", "dotenv"]
+
+PATTERN_IMPORT_TIME = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+parser = argparse.ArgumentParser()
+parser.add_argument("commands", nargs="*", default=COMMANDS)
+# コマンドごとの試行回数。import の時間は最も短かった回の値を使う。
+parser.add_argument("--runs", type=int, default=5)
+# 読み込みにかかった時間（ミリ秒）の上限。超えたコマンドがあれば終了コード 1 で終了する。
+parser.add_argument("--budget-ms", type=float, default=100.0)
+
+args = parser.parse_args()
+
+commands: list[str] = args.commands
+runs: int = args.runs
+budget_ms: float = args.budget_ms
+
+def measure(command: str) -> tuple[float, float, set[str]]:
+    # -X importtime の出力から、最上位の import の累積時間を合計する。
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, "-X", "importtime", "-m", f"dashcamtools.commands.{command}", "--help"], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    wall = time.perf_counter() - start
+
+    total = 0
+    modules = set()
+    for line in process.stderr.splitlines():
+        match = PATTERN_IMPORT_TIME.match(line)
+        if not match:
+            continue
+        _, cumulative, indent, module = match.groups()
+        modules.add(module.split(".")[0])
+        if len(indent) == 1:
+            total += int(cumulative)
+    return total / 1000, wall * 1000, modules
+
+def main():
+    # settings.py は DB に接続するまで DATABASE_URL を読まないが、念のため空の値を渡す。
+    os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+    failed = False
+    print("\t".join(["command", "import_ms", "wall_ms", "forbidden"]))
+    for command in commands:
+        results = [measure(command) for _ in range(runs)]
+        import_ms = min(result[0] for result in results)
+        wall_ms = min(result[1] for result in results)
+        forbidden = sorted(set(FORBIDDEN_MODULES) & results[0][2])
+
+        print("\t".join([command, f"{import_ms:.1f}", f"{wall_ms:.1f}", ",".join(forbidden)]))
+        if forbidden or import_ms > budget_ms:
+            failed = True
+
+    if failed:
+        print(f"Startup regressed. (budget: {budget_ms:.0f} ms, forbidden modules: {', '.join(FORBIDDEN_MODULES)})", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
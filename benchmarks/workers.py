@@ -0,0 +1,155 @@
+import argparse
+from datetime import datetime, timedelta
+import os
+from pathlib import Path
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+parser = argparse.ArgumentParser()
+# 同時に動かす compress のワーカーの数。
+parser.add_argument("--workers", type=int, default=3)
+parser.add_argument("--files", type=int, default=24)
+# スタブの ffmpeg が 1 回のエンコードにかける秒数。
+parser.add_argument("--encode-seconds", type=float, default=1.0)
+# 起動してからこの秒数の後に、最初のワーカーを SIGKILL で強制終了し、同じ --worker-id で起動し直す。負の値では強制終了しない。
+parser.add_argument("--kill-after", type=float, default=3.0)
+parser.add_argument("--lease-seconds", type=float, default=10.0)
+# すべてのワーカーが終了するまで待つ時間（秒）。
+parser.add_argument("--timeout", type=float, default=300.0)
+
+args = parser.parse_args()
+
+workers: int = args.workers
+files: int = args.files
+encode_seconds: float = args.encode_seconds
+kill_after: float = args.kill_after
+lease_seconds: float = args.lease_seconds
+timeout: float = args.timeout
+
+# 入力をそのまま出力にコピーし、呼び出された入力の名前を記録する ffmpeg。実行ファイルとして PATH から探させるため、POSIX でのみ動く。
+STUB_FFMPEG = f"""#!{sys.executable}
+import os, shutil, sys, time
+arguments = sys.argv[1:]
+source = arguments[arguments.index("-i") + 1]
+with open(os.environ["STUB_FFMPEG_LOG"], "a", encoding="utf-8") as log:
+    log.write(os.path.basename(source) + "\\n")
+time.sleep({encode_seconds})
+shutil.copy(source, arguments[-1])
+if "-progress" in arguments:
+    print("frame=1800\\nfps=1800\\ntotal_size=1000\\nout_time_us=60000000\\nspeed=60x\\nprogress=end", flush=True)
+"""
+
+STUB_FFPROBE = f"""#!{sys.executable}
+import json, sys
+if "default=noprint_wrappers=1:nokey=1" in sys.argv:
+    print("60.0")
+else:
+    print(json.dumps({{ "streams": [{{ "codec_name": "h264", "width": 3840, "height": 2160 }}], "format": {{ "duration": "60.0" }} }}))
+"""
+
+def write_stub(path: Path, content: str) -> None:
+    path.write_text(content, encoding="utf-8")
+    path.chmod(0o755)
+
+def start_worker(storage_dir: Path, work_dir: Path, worker_id: str, env: dict[str, str], log_dir: Path) -> subprocess.Popen:
+    command = [
+        sys.executable, "-m", "dashcamtools.commands.compress", str(storage_dir),
+        "--worker-id", worker_id,
+        "--work-dir", str(work_dir),
+        "--lease-seconds", str(lease_seconds),
+    ]
+    with (log_dir / f"{worker_id}.log").open("a", encoding="utf-8") as log:
+        return subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+def main():
+    failed = False
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        root = Path(temp_dir)
+        bin_dir = root / "bin"
+        storage_dir = root / "storage"
+        raw_dir = storage_dir / "Raw"
+        for dir in [bin_dir, raw_dir]:
+            dir.mkdir(parents=True)
+        write_stub(bin_dir / "ffmpeg", STUB_FFMPEG)
+        write_stub(bin_dir / "ffprobe", STUB_FFPROBE)
+
+        # 1 分ごとに連続した常時録画のファイル。内容は区別できればよい。
+        recorded_at = datetime(2024, 1, 1, 12, 0)
+        names = []
+        for index in range(files):
+            name = f"{recorded_at:%Y%m%d}_{(recorded_at + timedelta(minutes=index)):%y%m%d%H%M}_NF.mp4"
+            (raw_dir / name).write_bytes(os.urandom(1000 + index))
+            names.append(name)
+
+        database_path = root / "db.sqlite"
+        encode_log = root / "ffmpeg.log"
+        env = {
+            **os.environ,
+            "PATH": f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}",
+            "DATABASE_URL": f"sqlite:///{database_path}",
+            "STUB_FFMPEG_LOG": str(encode_log),
+            "PYTHONPATH": os.pathsep.join(filter(None, [str(Path(__file__).resolve().parent.parent), os.environ.get("PYTHONPATH")])),
+        }
+
+        worker_ids = [f"worker{index}" for index in range(workers)]
+        start = time.perf_counter()
+        processes = { worker_id: start_worker(storage_dir, root / "work", worker_id, env, root) for worker_id in worker_ids }
+
+        killed = False
+        deadline = time.monotonic() + timeout
+        while any(process.poll() is None for process in processes.values()):
+            if time.monotonic() > deadline:
+                for process in processes.values():
+                    process.kill()
+                print(f"Workers did not finish in {timeout:.0f} seconds.", file=sys.stderr)
+                sys.exit(1)
+
+            if not killed and kill_after >= 0 and time.perf_counter() - start >= kill_after:
+                # 処理中のファイルのリースと作業中のファイルを残したまま落とし、同じ名前で起動し直して続きを処理させる。
+                killed = True
+                victim = worker_ids[0]
+                processes[victim].send_signal(signal.SIGKILL)
+                processes[victim].wait()
+                processes[victim] = start_worker(storage_dir, root / "work", victim, env, root)
+            time.sleep(0.1)
+        elapsed = time.perf_counter() - start
+
+        with sqlite3.connect(database_path) as connection:
+            successes = dict(connection.execute("SELECT name, COUNT(*) FROM reports WHERE status = 'successful' GROUP BY name").fetchall())
+            # 終了したワーカーは、ファイルと machine_id のリースをすべて手放しているはず。
+            leases = connection.execute("SELECT (SELECT COUNT(*) FROM work_leases) + (SELECT COUNT(*) FROM machine_leases)").fetchone()[0]
+        encodes: dict[str, int] = {}
+        if encode_log.exists():
+            for line in encode_log.read_text(encoding="utf-8").splitlines():
+                encodes[line] = encodes.get(line, 0) + 1
+
+        archived = { path.name for path in (storage_dir / "Archive").glob("*.mp4") }
+        missing = [name for name in names if successes.get(name, 0) == 0 or name not in archived]
+        duplicated = [name for name in names if successes.get(name, 0) > 1]
+        remaining = sorted(path.name for path in raw_dir.glob("*.mp4"))
+        # 強制終了で中断したエンコードだけは、起動し直したワーカーがやり直してよい。
+        reencoded = sum(count - 1 for count in encodes.values() if count > 1)
+
+        print("\t".join(["workers", "files", "seconds", "files_per_second", "missing", "duplicated", "remaining", "reencoded", "leases"]))
+        print("\t".join(map(str, [workers, files, f"{elapsed:.3f}", f"{files / elapsed:.2f}", len(missing), len(duplicated), len(remaining), reencoded, leases])))
+
+        failed = bool(missing or duplicated or remaining or leases or reencoded > (1 if killed else 0))
+        if failed:
+            for name in missing:
+                print(f"{name}: not processed.", file=sys.stderr)
+            for name in duplicated:
+                print(f"{name}: processed {successes[name]} times.", file=sys.stderr)
+            for worker_id in worker_ids:
+                print((root / f"{worker_id}.log").read_text(encoding="utf-8")[-2000:], file=sys.stderr)
+
+    if failed:
+        print("Files were not processed exactly once.", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+from pathlib import Path
+import subprocess
+import tempfile
+
+from dashcamtools.encoders import EncoderPreset
+from dashcamtools.probe import probe_duration
+from dashcamtools.quality import concat_filter, measure_quality, window_inputs
+
+def sample_windows(duration: float, count: int, seconds: float) -> list[tuple[float, float]]:
+    # 動画全体から等間隔に count 個の区間を選ぶ。
+    return [(duration * (index + 1) / (count + 1), seconds) for index in range(count)]
+
+def encode_samples(source: Path, output: Path, preset: EncoderPreset, windows: list[tuple[float, float]], threads: int | None = None, timeout: float | None = None) -> None:
+    # 各区間だけをデコードしてつなげ、エンコードする。-c copy で切り出すと区間の端の B フレームが欠けるため、デコードしてから切る。
+    command = [
+        "ffmpeg",
+        "-y",
+        "-loglevel", "error",
+        *window_inputs(source, windows),
+        "-filter_complex", f"{concat_filter(0, len(windows))}[v]",
+        "-map", "[v]",
+        *preset.arguments(threads),
+        str(output),
+    ]
+    subprocess.run(command, check=True, timeout=timeout)
+
+def search_quality(source: Path, preset: EncoderPreset, target_ssim: float, low: int, high: int, sample_count: int, sample_seconds: float, threads: int | None = None, timeout: float | None = None) -> int:
+    # SSIM が target_ssim 以上になる範囲で、最も大きい（= 最もファイルが小さくなる）CRF を二分探索で求める。
+    # どの値でも目標に届かない場合は low を返す。timeout は、1 回のエンコードと画質の比較のそれぞれにかけてよい時間（秒）。
+    windows = sample_windows(probe_duration(source), sample_count, sample_seconds)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        def measure(quality: int) -> float:
+            output = Path(work_dir, f"quality{quality}{source.suffix}")
+            encode_samples(source, output, preset.with_quality(quality), windows, threads, timeout)
+            return measure_quality([output], source, windows=windows, timeout=timeout)[0].ssim.mean
+
+        best = low
+        while low <= high:
+            middle = (low + high) // 2
+            if measure(middle) >= target_ssim:
+                best = middle
+                low = middle + 1
+            else:
+                high = middle - 1
+        return best
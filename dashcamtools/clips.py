@@ -0,0 +1,142 @@
+from bisect import bisect_left, bisect_right
+from pathlib import Path
+import subprocess
+
+from dashcamtools.encoders import EncoderPreset, LIBX264
+from dashcamtools.segments import run_command, write_concat_list
+
+# ffprobe が出力するキーフレームの時刻は、小数点以下 6 桁に丸められている。この差までは同じ時刻とみなす。
+KEYFRAME_TOLERANCE = 0.0005
+# frame accurate な切り出しで、両端のキーフレームの間に満たない部分を再エンコードするプリセット。
+EDGE_PRESET = EncoderPreset(LIBX264, { "crf": "18", "preset": "veryfast" })
+
+class Cut:
+    def __init__(self, path: Path, start: float, end: float, reencode: bool, split_time: float | None = None) -> None:
+        self.path = path
+        # path の先頭からの時刻（秒）。
+        self.start = start
+        self.end = end
+        self.reencode = reencode
+        # ストリームコピーで end のキーフレームの前で切るために、segment マルチプレクサーに渡す start からの時刻。
+        self.split_time = split_time
+
+def split_time(keyframes: list[float], start: float, end: float) -> float:
+    # ffmpeg は先頭のフレームからの時刻で分割するため、ffprobe の時刻とは先頭のフレームの時刻だけずれる。
+    # ずれても end のキーフレームで分かれるよう、その 1 つ前のキーフレームとの中間を指定する。
+    index = bisect_left(keyframes, end - KEYFRAME_TOLERANCE) - 1
+    previous = max(keyframes[index], start) if index >= 0 else start
+    return (previous + end) / 2 - start
+
+def plan_cuts(path: Path, keyframes: list[float], start: float, end: float, duration: float, accurate: bool) -> list[Cut]:
+    # ストリームコピーではキーフレームでしか切れないため、accurate でなければ範囲をキーフレームまで広げる。
+    # accurate であれば、内側のキーフレームの間をストリームコピーし、両端の半端な GOP だけを再エンコードする。
+    # 先頭のキーフレームより前や、最後のキーフレームより後に余ったフレームは、ファイルの先頭や末尾として扱う。
+    at_head = not keyframes or start <= keyframes[0] + KEYFRAME_TOLERANCE
+    at_tail = end >= duration - KEYFRAME_TOLERANCE
+    if at_head and at_tail:
+        return [Cut(path, 0.0, duration, False)]
+
+    if not accurate:
+        index = bisect_right(keyframes, start + KEYFRAME_TOLERANCE) - 1
+        copy_start = 0.0 if at_head or index < 0 else keyframes[index]
+        index = bisect_left(keyframes, end - KEYFRAME_TOLERANCE)
+        copy_end = duration if at_tail or index >= len(keyframes) else keyframes[index]
+        return [Cut(path, copy_start, copy_end, False, None if copy_end >= duration else split_time(keyframes, copy_start, copy_end))]
+
+    index = bisect_left(keyframes, start - KEYFRAME_TOLERANCE)
+    copy_start = keyframes[index] if index < len(keyframes) else duration
+    index = bisect_right(keyframes, end + KEYFRAME_TOLERANCE) - 1
+    copy_end = duration if at_tail else keyframes[index]
+    if copy_start >= copy_end - KEYFRAME_TOLERANCE:
+        # 範囲がキーフレームをまたがなければ、すべて再エンコードする。高々 1 つの GOP の長さで済む。
+        return [Cut(path, start, end, True)]
+    if at_head:
+        copy_start = 0.0
+
+    cuts = []
+    if not at_head and start < copy_start - KEYFRAME_TOLERANCE:
+        cuts.append(Cut(path, start, copy_start, True))
+    cuts.append(Cut(path, copy_start, copy_end, False, None if at_tail else split_time(keyframes, copy_start, copy_end)))
+    if not at_tail and end > copy_end + KEYFRAME_TOLERANCE:
+        cuts.append(Cut(path, copy_end, end, True))
+    return cuts
+
+def copy_command(cut: Cut, output_pattern: str) -> list[str]:
+    # キーフレームから読み始め、次のキーフレームで分割した最初のファイルを使う。
+    # -to や -t によるストリームコピーでは、B フレームの分だけ末尾が欠けたり余ったりするため、segment マルチプレクサーで切る。
+    seek = ["-ss", f"{cut.start + KEYFRAME_TOLERANCE:.6f}"] if cut.start > 0 else []
+    # ファイルの末尾まで使う場合は、読む範囲より後ろを指定して分割させない。
+    split_time = cut.split_time if cut.split_time is not None else cut.end - cut.start + 1
+    return [
+        "ffmpeg",
+        "-y",
+        "-loglevel", "error",
+        *seek,
+        # 分割した後ろのファイルは使わないため、読む範囲を次のキーフレームの少し先までに限る。
+        "-t", f"{cut.end - cut.start + 1:.6f}",
+        "-i", str(cut.path),
+        "-map", "0",
+        "-c", "copy",
+        "-f", "segment",
+        "-segment_times", f"{split_time:.6f}",
+        output_pattern,
+    ]
+
+def reencode_command(cut: Cut, output_path: str, preset: EncoderPreset) -> list[str]:
+    # 正確なシークでは start より前のフレームを捨てるため、丸めでキーフレーム自体を捨てないよう、少し前から始める。
+    start = max(cut.start - KEYFRAME_TOLERANCE, 0.0)
+    return [
+        "ffmpeg",
+        "-y",
+        "-loglevel", "error",
+        "-ss", f"{start:.6f}",
+        "-i", str(cut.path),
+        "-t", f"{cut.end - start - KEYFRAME_TOLERANCE:.6f}",
+        "-map", "0",
+        *preset.arguments(),
+        # 音声もストリームコピーでは start より前のパケットから始まり、つなげると映像とずれるため、エンコードし直して揃える。
+        "-c:a", "aac",
+        output_path,
+    ]
+
+def concat_command(list_path: Path, output_path: Path, reencoded: bool) -> list[str]:
+    # 再エンコードした部分は SPS や PPS が元のファイルと異なるため、キーフレームごとにストリームの中にも書き込む。
+    bitstream_filter = ["-bsf:v", "h264_mp4toannexb"] if reencoded else []
+    return [
+        "ffmpeg",
+        "-y",
+        "-loglevel", "error",
+        "-f", "concat",
+        "-safe", "0",
+        "-i", str(list_path),
+        "-map", "0",
+        "-c", "copy",
+        *bitstream_filter,
+        "-movflags", "+faststart",
+        str(output_path),
+    ]
+
+def extract_clip(cuts: list[Cut], durations: dict[Path, float], output_path: Path, work_dir: Path, preset: EncoderPreset = EDGE_PRESET) -> None:
+    # 切り出した部分を work_dir に書き出し、concat demuxer でつなげる。ファイル全体を使う部分は、元のファイルをそのまま参照する。
+    pieces: list[Path] = []
+    for index, cut in enumerate(cuts):
+        duration = durations[cut.path]
+        if not cut.reencode and cut.start <= 0 and cut.end >= duration:
+            pieces.append(cut.path)
+        elif cut.reencode:
+            piece = work_dir / f"piece{index:03d}{cut.path.suffix}"
+            run_command(reencode_command(cut, str(piece), preset))
+            pieces.append(piece)
+        else:
+            piece_dir = work_dir / f"piece{index:03d}"
+            piece_dir.mkdir()
+            run_command(copy_command(cut, str(piece_dir / f"chunk%03d{cut.path.suffix}")))
+            pieces.append(piece_dir / f"chunk000{cut.path.suffix}")
+
+    list_path = work_dir / "pieces.txt"
+    write_concat_list(pieces, list_path)
+    try:
+        run_command(concat_command(list_path, output_path, any(cut.reencode for cut in cuts)))
+    except subprocess.CalledProcessError:
+        output_path.unlink(missing_ok=True)
+        raise
@@ -1,165 +1,861 @@
+from __future__ import annotations
+
 import argparse
-from datetime import datetime, timezone, UTC
+from contextlib import ExitStack
+from datetime import datetime, timedelta, timezone, UTC
 import os
 from pathlib import Path
 import shutil
+import signal
+import socket
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import traceback
+from typing import Iterator, TYPE_CHECKING
+
+from dashcamtools.models import parse_video_name
+from dashcamtools.util import iso8601, random_path, resolve_unique_name, resolve_unique_path, temporary_path, Snowflake
+from dashcamtools.dedup import full_hash, partial_hash
+from dashcamtools.pipeline import Pipeline, Stage
+from dashcamtools.encoders import compress_command, remux_command, EncoderPool, EncoderPreset, FAST_PRESETS, H264_NVENC, LIBX264, PRESETS, QUALITY_OPTIONS
+from dashcamtools.adaptive import search_quality
+from dashcamtools.previews import compress_with_previews_command, preview_paths, write_keyframes
+from dashcamtools.probe import probe_duration, probe_video
+from dashcamtools.segments import encode_segmented
+from dashcamtools.scheduler import order_videos, DiskPressure, SavingsEstimator, POLICIES, POLICY_OLDEST, POLICY_SAVINGS
+
+if TYPE_CHECKING:
+    from dashcamtools.orm import CompressJob, ScannedFile, VideoFile
+    from dashcamtools.telemetry import EncodeStats
+
+IO_MODE_COPY = "copy"
+IO_MODE_DIRECT = "direct"
 
-from dashcamtools.orm import get_db, Log, LogSeverity, Report, ReportStatus, VideoFile
-from dashcamtools.util import iso8601, resolve_unique_path, temporary_path, Snowflake
-from dashcamtools.repositories import LogRepository, ReportRepository, VideoFileRepository
+# ffprobe の結果に基づく、ファイルごとの処理。
+ACTION_ENCODE = "encode"
+ACTION_REMUX = "remux"
+ACTION_SKIP = "skip"
 
-parser = argparse.ArgumentParser()
-parser.add_argument("storage_dir", metavar="storage-dir", type=Path)
-parser.add_argument("--nvenc", action="store_true")
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("storage_dir", metavar="storage-dir", type=Path)
+    parser.add_argument("--nvenc", action="store_true")
+    # ダウンロード、圧縮、アップロードを並行して行う場合の、ステージ間で待機できるファイルの数。
+    parser.add_argument("--pipeline-depth", type=int, default=0)
+    # 同時に実行するエンコードの数。
+    parser.add_argument("--jobs", type=int, default=1)
+    # --nvenc を指定した場合に、同時に使用する NVENC のセッション数の上限。超えた分は libx264 でエンコードする。
+    parser.add_argument("--nvenc-sessions", type=int, default=3)
+    # tune コマンドで保存したプリセット、または組み込みのプリセット（libx264, h264_nvenc）の名前。
+    parser.add_argument("--preset", type=str)
+    # 指定した場合は、クリップごとにこの SSIM を満たす最も大きい CRF（CQ）を、サンプル区間のエンコードで探索する。
+    parser.add_argument("--target-ssim", type=float)
+    parser.add_argument("--quality-range", type=int, nargs=2, default=[22, 34], metavar=("LOW", "HIGH"))
+    parser.add_argument("--sample-count", type=int, default=3)
+    parser.add_argument("--sample-seconds", type=float, default=1.0)
+    # copy: ローカルの一時ファイルにコピーしてからエンコードし、アップロードする。
+    # direct: ffmpeg が source_dir から直接読み、remote_temp_dir に直接書き出す。Archive へは名前の変更だけで移動する。
+    parser.add_argument("--io-mode", choices=[IO_MODE_COPY, IO_MODE_DIRECT], default=IO_MODE_COPY)
+    # 映像のビットレート（kbps）がこの値以下のファイルは、すでに圧縮済みとみなし、エンコードせずにそのまま Archive に移動する。
+    parser.add_argument("--skip-bitrate", type=int)
+    # 映像のビットレート（kbps）がこの値以下のファイルは、エンコードせずに -c copy で再多重化する。
+    parser.add_argument("--remux-bitrate", type=int)
+    # 走査結果のキャッシュを使わずに、source_dir のすべてのファイルを stat し直す。
+    parser.add_argument("--full-rescan", action="store_true")
+    # 処理する順序。event: イベント録画を先に、oldest: 更新時刻の古い順に、savings: 過去の実績からエンコード時間あたりの削減量が多いと見込まれる順に。
+    parser.add_argument("--order", choices=POLICIES, nargs="+", default=[POLICY_OLDEST])
+    # source_dir のボリュームの空き容量（GB）がこの値を下回っている間は、速度を優先したプリセットでエンコードし、CRF の探索も省く。
+    parser.add_argument("--min-free-gb", type=float)
+    # 空き容量が少ないときに使うプリセットの名前。そのコーデックの既定の高速なプリセットを置き換える。
+    parser.add_argument("--fast-preset", type=str)
+    # 終了せずに source_dir を監視し続け、新しいファイルを見つけ次第処理する。SIGTERM を受け取ると、処理中のファイルを終えてから終了する。
+    parser.add_argument("--watch", action="store_true")
+    # --watch で source_dir を調べる間隔（秒）。
+    parser.add_argument("--poll-interval", type=float, default=2.0)
+    # --watch で、書き込み中のファイルを処理しないよう、サイズと更新時刻がこの秒数変わらなかったファイルだけを処理する。
+    parser.add_argument("--settle-seconds", type=float, default=5.0)
+    # ffmpeg の出力が進まなくなってから強制終了するまでの最短の時間（秒）。実際の時間は、クリップの長さと過去のエンコードの速度から決める。0 で無効。
+    parser.add_argument("--stall-timeout", type=float, default=60.0)
+    # libx264 でエンコードする長いクリップを、キーフレームでこの数に分割して並行してエンコードし、つなげる。1 では分割しない。
+    parser.add_argument("--segments", type=int, default=1)
+    # --segments で分割する、クリップの最短の長さ（秒）。
+    parser.add_argument("--segment-min-duration", type=float, default=600.0)
+    # 処理したファイルの数やステージごとの時間などを、Prometheus のテキスト形式で書き出すファイル（node_exporter の textfile collector 用）。
+    parser.add_argument("--metrics-file", type=Path)
+    # ダウンロードしたファイルや圧縮したファイルを置くディレクトリ。中断したジョブの続きに使うため、再起動で消えない場所を指定する。
+    # 実際には、この下と storage_dir の Temp の下に、ワーカーごとのサブディレクトリを作る。
+    parser.add_argument("--work-dir", type=Path, default=Path(tempfile.gettempdir(), "dashcamtools"))
+    # 複数のワーカーで同じ storage_dir と DB を使う場合の、ワーカーごとに異なる名前。既定はホスト名。
+    # 同じ名前で同時に複数のプロセスを動かしてはならない。また、SQLite はネットワーク越しに共有できないため、複数のホストでは PostgreSQL などを使う。
+    parser.add_argument("--worker-id", type=str)
+    # ログの ID を作る Snowflake の machine_id（0 から 1023）。既定は --worker-id から求め、ほかのワーカーが使っていれば空いている値を使う。
+    # 指定した値をほかのワーカーが使っている場合は、起動せずに終了する。
+    parser.add_argument("--machine-id", type=int)
+    # ファイルのリースの有効期間（秒）。ワーカーが落ちると、この時間が過ぎてからほかのワーカーがそのファイルを処理する。
+    parser.add_argument("--lease-seconds", type=float, default=300.0)
+    # エンコードのセッション 1 つあたりに、一度にリースを取得するファイルの数。NVENC のセッションは、過去の速度の比で重み付けする。
+    parser.add_argument("--claim-per-slot", type=float, default=2.0)
+    # 指定した場合は、圧縮と同じデコードからサムネイルのスプライトと 360p の動画を作り、キーフレームの一覧とともにこのディレクトリに書き出す。
+    # 分割エンコード、CRF の探索、再多重化の場合は、キーフレームの一覧だけを書き出す。
+    parser.add_argument("--preview-dir", type=Path)
+    return parser
 
-args = parser.parse_args()
+class Job:
+    def __init__(self, source: Path, destination: Path, video: VideoFile, scanned: ScannedFile, record: CompressJob) -> None:
+        self.source = source
+        self.video = video
+        self.scanned = scanned
+        # DB に保存したこのファイルの進行状況。
+        self.record = record
+        self.action = ACTION_ENCODE
+        self.destination = destination
+        self.start = time.perf_counter()
+        self.started_at = Job.next_started_at()
+        # 書き込み中で、まだ record に記録していない一時ファイル。ジョブが失敗または中断したときに削除する。
+        self.resources = ExitStack()
+        self.copy: Path | None = None
+        self.output: Path | None = None
+        self.duration_download: float | None = None
+        self.duration_compress: float | None = None
+        self.duration_wait = 0.0
+        self.codec: str | None = None
+        self.quality: int | None = None
+        # ffmpeg の -progress と資源使用量から求めた統計。再開したジョブや再多重化では None。
+        self.stats: EncodeStats | None = None
+        # 重複の検出に使う、source の内容のハッシュ。必要になったときに求める。
+        self.partial_hash: str | None = None
+        self.full_hash: str | None = None
+        # 圧縮と同時に書き出した、スプライトと低解像度の動画の一時ファイル。
+        self.sprite: Path | None = None
+        self.proxy: Path | None = None
 
-storage_dir: Path = args.storage_dir
-nvenc: bool = args.nvenc
+    last_started_at: datetime | None = None
 
-source_dir: Path = storage_dir / "Raw"
-target_dir: Path = storage_dir / "Archive"
-trash_dir: Path = storage_dir / "Trash"
-remote_temp_dir: Path = storage_dir / "Temp"
+    @classmethod
+    def next_started_at(cls) -> datetime:
+        # started_at は Report の主キーのため、時計の分解能が粗い環境でも重複しないようにする。
+        started_at = datetime.now(tz=timezone.utc)
+        if cls.last_started_at is not None and started_at <= cls.last_started_at:
+            started_at = cls.last_started_at + timedelta(microseconds=1)
+        cls.last_started_at = started_at
+        return started_at
 
 def main():
-    def do_compress(input_path: str, output_path: str) -> subprocess.CompletedProcess:
-        def resolve_command():
-            if nvenc:
-                return [
-                    "ffmpeg", 
-                    "-y", # overwrite
-                    "-loglevel", "error",
-                    "-i", input_path, 
-                    "-map", "0",
-                    "-c:v", "h264_nvenc", 
-                    "-c:a", "copy",
-                    "-cq", "30",
-                    "-preset", "p7",
-                    "-profile", "high",
-                    output_path,
-                ]
-            else:
-                return [
-                    "ffmpeg", 
-                    "-y", # overwrite
-                    "-loglevel", "error",
-                    "-i", input_path, 
-                    "-map", "0", 
-                    "-crf", "28", 
-                    "-c:v", "libx264", 
-                    "-c:a", "copy", 
-                    output_path,
-                ]
-        return subprocess.run(resolve_command())
+    parser = build_parser()
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
 
-    def set_timestamp(source_stat: os.stat_result, output: Path):
-        os.utime(output, (source_stat.st_atime, source_stat.st_mtime))
+    storage_dir: Path = args.storage_dir
+    nvenc: bool = args.nvenc
+    pipeline_depth: int = args.pipeline_depth
+    jobs: int = args.jobs
+    nvenc_sessions: int = args.nvenc_sessions
+    full_rescan: bool = args.full_rescan
+    worker_id: str = args.worker_id or socket.gethostname()
+    work_dir: Path = args.work_dir / worker_id
+    machine_id: int | None = args.machine_id
+    lease_seconds: float = args.lease_seconds
+    claim_per_slot: float = args.claim_per_slot
+    order: list[str] = args.order
+    min_free_gb: float | None = args.min_free_gb
+    fast_preset_name: str | None = args.fast_preset
+    watch: bool = args.watch
+    poll_interval: float = args.poll_interval
+    settle_seconds: float = args.settle_seconds
+    metrics_file: Path | None = args.metrics_file
+    min_stall_timeout: float = args.stall_timeout
+    segments: int = args.segments
+    segment_min_duration: float = args.segment_min_duration
+    preset_name: str | None = args.preset
+    target_ssim: float | None = args.target_ssim
+    quality_range: list[int] = args.quality_range
+    sample_count: int = args.sample_count
+    sample_seconds: float = args.sample_seconds
+    io_mode: str = args.io_mode
+    skip_bitrate: int | None = args.skip_bitrate
+    remux_bitrate: int | None = args.remux_bitrate
+    preview_dir: Path | None = args.preview_dir
 
-    def move_to_trash(source: Path) -> Path:
-        destination = resolve_unique_path(trash_dir / source.name)
-        shutil.move(source, destination)
-        return destination
+    source_dir: Path = storage_dir / "Raw"
+    target_dir: Path = storage_dir / "Archive"
+    trash_dir: Path = storage_dir / "Trash"
+    # ほかのワーカーの書きかけのファイルを片付けてしまわないよう、ワーカーごとに分ける。
+    remote_temp_dir: Path = storage_dir / "Temp" / worker_id
 
+    # SQLAlchemy の読み込みには時間がかかるため、引数を解析してから読み込む。
+    from dashcamtools.orm import get_db, CompressJob, ContentHash, JobState, Log, LogSeverity, ProbeResult, Report, ReportStatus, ScannedFile, VideoFile
+    from dashcamtools.repositories import BufferedWriter, CompressJobRepository, ContentHashRepository, EncoderPresetRepository, LogRepository, MachineLeaseRepository, ProbeResultRepository, ReportRepository, ScanIndexRepository, VideoFileRepository, WorkLeaseRepository
+    from dashcamtools.leases import claim_size, machine_id_candidates, LeaseHeartbeat, LeaseLostError, MachineLeaseHeartbeat
+    from dashcamtools.scanner import scan_directory
+    from dashcamtools.telemetry import run_with_progress, megabytes_per_second, merge_stats, stall_timeout, EncodeStats, MetricsExporter, StalledError
+
+    # 異なるワーカーが同じ machine_id を使うとログの ID が重複するため、DB のリースで machine_id を確保してから始める。
     with get_db() as db:
+        machine_lease_repository = MachineLeaseRepository(db)
+        snowflake_machine_id = machine_lease_repository.claim([machine_id] if machine_id is not None else machine_id_candidates(worker_id), worker_id, lease_seconds)
+        machine_id_owner = machine_lease_repository.find_owner(machine_id) if snowflake_machine_id is None and machine_id is not None else None
+        db.commit()
+    if snowflake_machine_id is None:
+        if machine_id is not None:
+            print(f"Machine ID {machine_id} is used by active worker {machine_id_owner}.", file=sys.stderr)
+        else:
+            print("All machine IDs are used by other active workers.", file=sys.stderr)
+        sys.exit(1)
+    # 同じホストで同じ machine_id を使うプロセスとは、このファイルで ID の予約を共有する。ワーカーごとの work_dir は片付けの対象のため、その外に置く。
+    snowflake_state_path = work_dir.parent / f"snowflake-{snowflake_machine_id}.state"
+
+    def do_compress(input_path: str, output_path: str, preset: EncoderPreset, threads: int | None, timeout: float | None) -> EncodeStats:
+        return run_with_progress(compress_command(input_path, output_path, preset, threads), timeout=timeout)
+
+    def do_compress_with_previews(job: Job, preset: EncoderPreset, threads: int | None, timeout: float | None, duration: float | None) -> EncodeStats:
+        return run_with_progress(compress_with_previews_command(str(job.copy), str(job.output), preset, threads, str(job.sprite), str(job.proxy), duration), timeout=timeout)
+
+    def set_timestamp(source_stat: os.stat_result, output: Path):
+        os.utime(output, (source_stat.st_atime, source_stat.st_mtime))
+
+    # ログを書き終えてから machine_id のリースを手放すよう、BufferedWriter より先に入る。
+    with MachineLeaseHeartbeat(get_db, worker_id, lease_seconds), get_db() as db, BufferedWriter(get_db) as writer:
+        # 各ステージのスレッドが ORM オブジェクトの属性を読むため、コミットのたびに失効させて、ロックの外で読み込み直させないようにする。
+        db.expire_on_commit = False
         video_repository = VideoFileRepository(db)
-        report_repository = ReportRepository(db)
-        log_repository = LogRepository(db, snowflake=Snowflake(machine_id=0))
+        report_repository = ReportRepository(db, writer=writer)
+        log_repository = LogRepository(db, snowflake=Snowflake(machine_id=snowflake_machine_id, state_path=snowflake_state_path), writer=writer)
+        scan_index_repository = ScanIndexRepository(db)
+        journal_repository = CompressJobRepository(db)
+        content_repository = ContentHashRepository(db)
+        lease_repository = WorkLeaseRepository(db)
+
+        # パイプライン処理では各ステージが別スレッドで動くため、セッションの操作を直列化する。
+        db_lock = threading.RLock()
 
         def print_log(text: str, severity: LogSeverity = LogSeverity.INFO):
             try:
                 print(text, file=sys.stderr)
-                log_repository.create(Log(severity=severity, text=text, timestamp=datetime.now(tz=timezone.utc)))
+                with db_lock:
+                    log_repository.create(Log(severity=severity, text=text, timestamp=datetime.now(tz=timezone.utc)))
             except Exception as e:
                 print(e, file=sys.stderr)
 
-        print_log(f"Starting job... (storage_dir: {storage_dir}, nvenc: {nvenc})")
+        metrics = MetricsExporter(metrics_file) if metrics_file is not None else None
+
+        def create_report(report: Report):
+            with db_lock:
+                report_repository.create(report)
+
+            if metrics is not None:
+                metrics.observe(report)
+                try:
+                    metrics.write(shutil.disk_usage(source_dir).free)
+                except OSError as e:
+                    print(e, file=sys.stderr)
+
+        def mark_archived(video: VideoFile, **values):
+            with db_lock:
+                for key, value in values.items():
+                    setattr(video, key, value)
+                video.is_archived = True
+                db.commit()
+
+        # Trash にあるファイルの名前。索引から読み、ファイルシステムを 1 つずつ調べずに重複しない名前を決める。
+        trash_names: set[str] = set(content_repository.list_names(str(trash_dir)))
+
+        def hash_source(job: Job) -> str:
+            if job.partial_hash is None:
+                job.partial_hash = partial_hash(job.source, job.scanned.size)
+            return job.partial_hash
+
+        def index_content(job: Job, directory: Path, name: str, archived_name: str | None):
+            with db_lock:
+                content_repository.save(ContentHash(directory=str(directory), name=name, size=job.scanned.size, mtime=job.scanned.mtime, partial_hash=job.partial_hash, full_hash=job.full_hash, archived_name=archived_name))
+                db.commit()
+
+        def move_to_trash(job: Job, archived_name: str | None) -> Path:
+            hash_source(job)
+            with db_lock:
+                destination = trash_dir / resolve_unique_name(job.source.name, trash_names)
+                # 索引にないファイルが置かれていた場合に限り、ファイルシステムを調べて名前を決め直す。
+                if destination.exists():
+                    destination = resolve_unique_path(destination)
+                trash_names.add(destination.name)
+            shutil.move(job.source, destination)
+            index_content(job, trash_dir, destination.name, archived_name)
+            return destination
+
+        def find_duplicate(job: Job) -> ContentHash | None:
+            # 内容が同じファイルをすでに Archive に置いていれば、その索引を返す。
+            content_hash = hash_source(job)
+            with db_lock:
+                candidates = content_repository.list_by_partial_hash(job.scanned.size, content_hash)
+
+            for candidate in candidates:
+                if candidate.archived_name is None or not (target_dir / candidate.archived_name).exists():
+                    continue
+
+                # 部分的なハッシュが一致した場合に限り、ファイル全体を読んで確かめる。
+                if candidate.full_hash is None:
+                    candidate_path = Path(candidate.directory, candidate.name)
+                    if not candidate_path.is_file():
+                        continue
+                    candidate.full_hash = full_hash(candidate_path)
+                    with db_lock:
+                        content_repository.save(candidate)
+                        db.commit()
+
+                if job.full_hash is None:
+                    job.full_hash = full_hash(job.source)
+                if job.full_hash == candidate.full_hash:
+                    return candidate
+            return None
+
+        def checkpoint(job: Job, state: JobState, **values):
+            # 成果物を書き終えてから状態を記録する。記録した成果物は、強制終了されても次回の実行で再利用する。
+            for key, value in values.items():
+                setattr(job.record, key, value)
+            job.record.state = state
+            job.record.updated_at = datetime.now(tz=timezone.utc)
+            with db_lock:
+                # リースが切れてほかのワーカーが処理を始めていれば、このワーカーは何も記録せずに手を引く。
+                if not lease_repository.is_owned(job.source.name, worker_id):
+                    raise LeaseLostError(job.source.name, worker_id)
+                journal_repository.save(job.record)
+                db.commit()
+            job.resources.pop_all()
+
+        def create_artifact(job: Job, dir: Path, suffix: str | None = None) -> Path:
+            path = random_path(dir, suffix or job.source.suffix)
+            job.resources.callback(path.unlink, missing_ok=True)
+            return path
+
+        def resume(record: CompressJob | None, source: ScannedFile) -> CompressJob | None:
+            # 中断したジョブのうち、同じファイルを同じ --io-mode で処理していたものは、成果物が残っている段階から再開する。
+            if record is None or record.state == JobState.TRASHED:
+                return None
+            if record.size != source.size or record.mtime != source.mtime or record.io_mode != io_mode:
+                return None
+
+            if record.state == JobState.UPLOADED and not (target_dir / record.name).exists():
+                return None
+            if record.state == JobState.ENCODED and not (record.output_path and Path(record.output_path).is_file()):
+                record.state = JobState.COPIED
+            if record.state == JobState.COPIED and not (record.copy_path and Path(record.copy_path).is_file() and Path(record.copy_path).stat().st_size == source.size):
+                return None
+            return record
+
+        def sweep(directory: Path, keep: set[Path]) -> int:
+            # 強制終了したジョブの書きかけのファイルなど、どのジョブからも参照されていないファイルを削除する。
+            count = 0
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        # 分割エンコードの作業ディレクトリ。
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                        count += 1
+                    elif entry.is_file() and Path(entry.path).resolve() not in keep:
+                        os.unlink(entry.path)
+                        count += 1
+            return count
 
-        for dir in [source_dir, target_dir, trash_dir, remote_temp_dir]:
+        # コーデックごとに使用するプリセット。--preset で指定したものは、そのコーデックの既定のプリセットを置き換える。
+        presets: dict[str, EncoderPreset] = dict(PRESETS)
+        use_nvenc = nvenc
+        if preset_name is not None:
+            preset = EncoderPresetRepository(db).find_by_name(preset_name)
+            if preset is None:
+                print_log(f"Preset {preset_name} does not exist.", severity=LogSeverity.ERROR)
+                return
+            presets[preset.codec] = preset
+            use_nvenc = use_nvenc or preset.codec == H264_NVENC
+
+        fast_presets: dict[str, EncoderPreset] = dict(FAST_PRESETS)
+        if fast_preset_name is not None:
+            preset = EncoderPresetRepository(db).find_by_name(fast_preset_name)
+            if preset is None:
+                print_log(f"Preset {fast_preset_name} does not exist.", severity=LogSeverity.ERROR)
+                return
+            fast_presets[preset.codec] = preset
+
+        print_log(f"Starting job... (worker_id: {worker_id}, storage_dir: {storage_dir}, nvenc: {use_nvenc}, preset: {preset_name}, target_ssim: {target_ssim}, io_mode: {io_mode}, pipeline_depth: {pipeline_depth}, jobs: {jobs}, order: {order}, min_free_gb: {min_free_gb}, watch: {watch})")
+
+        for dir in [source_dir, target_dir, trash_dir, remote_temp_dir, work_dir, *([preview_dir] if preview_dir is not None else [])]:
             dir.mkdir(parents=True, exist_ok=True)
 
         # source_dir からすべてのファイルを取得し、それに応じて videos レコードを追加します。
         print_log("First, get all files from the source directory...")
-        sources = list(source_dir.glob("*.mp4"))
-        source_names = [source.name for source in sources]
-        existing_video_names: set[str] = { record.name for record in video_repository.list_by_names(source_names) }
-        
-        new_source = [source for source in sources if source.name not in existing_video_names]
-        print_log(f"Collecting information of {len(new_source)} file(s)...")
-        for source in new_source:
-            mtime = datetime.fromtimestamp(os.path.getmtime(source), tz=UTC)
-            record = VideoFile(name=source.name, mtime=mtime)
-            video_repository.add(record)
-        db.commit()
-        print_log("Collecting information of files completed.")
+        sources = scan_directory(scan_index_repository, source_dir, "*.mp4", full_rescan=full_rescan)
+        source_files = { source.name: source for source in sources }
+
+        with db_lock:
+            # 前回このワーカーが落ちたときのリースは、期限を待たずに手放す。
+            if lease_repository.count_active(worker_id) > 0:
+                print_log(f"Active leases of worker {worker_id} found. Another process may be running with the same --worker-id.", severity=LogSeverity.ERROR)
+            lease_repository.release_all(worker_id)
+            db.commit()
+
+        journal: dict[str, CompressJob] = {}
+        for record in journal_repository.list_by_names(source_files.keys()):
+            # 各ステージのスレッドが保持して更新するため、セッションから切り離す。
+            db.expunge(record)
+            record = resume(record, source_files[record.name])
+            if record is not None:
+                journal[record.name] = record
+
+        artifacts = { Path(path).resolve() for record in journal.values() for path in [record.copy_path if record.state == JobState.COPIED else None, record.output_path if record.state == JobState.ENCODED else None] if path is not None }
+        swept = sweep(work_dir, artifacts) + sweep(remote_temp_dir, artifacts)
+        print_log(f"{len(journal)} interrupted job(s) found, {swept} stale temporary file(s) removed.")
+
+        # 前回までの ffprobe の結果。名前、サイズ、更新時刻が同じファイルは調べ直さない。
+        probe_results: dict[tuple[str, int, float], ProbeResult] = {}
+
+        def classify(job: Job) -> bool:
+            key = (job.scanned.name, job.scanned.size, job.scanned.mtime)
+            result = probe_results.get(key)
+            if result is None:
+                info = probe_video(job.source)
+                result = ProbeResult(name=key[0], size=key[1], mtime=key[2], codec=info.codec, bit_rate=info.bit_rate, width=info.width, height=info.height, duration=info.duration, probed_at=datetime.now(tz=timezone.utc))
+                with db_lock:
+                    ProbeResultRepository(db).add(result)
+                    db.commit()
+                probe_results[key] = result
+
+            if result.bit_rate is not None:
+                kbps = result.bit_rate / 1000
+                if skip_bitrate is not None and kbps <= skip_bitrate:
+                    job.action = ACTION_SKIP
+                elif remux_bitrate is not None and kbps <= remux_bitrate:
+                    job.action = ACTION_REMUX
+            return True
+
+        def download(job: Job) -> bool:
+            if job.record.state == JobState.UPLOADED:
+                # アップロードまで完了していれば、残りの後始末だけを行う。
+                print_log(f"{job.source.name}: resuming from {job.record.state.value}.")
+                finish(job, job.destination.stat().st_size, None)
+                return False
+
+            if job.destination.exists():
+                trash_file = move_to_trash(job, None)
+
+                print_log(f"{job.source.name}: already exists in the destination. skipped. (moved to: {trash_file})")
+                create_report(Report(started_at=job.started_at, name=job.source.name, status=ReportStatus.SKIPPED))
+                return False
+
+            if job.record.state == JobState.QUEUED:
+                duplicate = find_duplicate(job)
+                if duplicate is not None:
+                    trash_file = move_to_trash(job, duplicate.archived_name)
+                    mark_archived(job.video)
+
+                    print_log(f"{job.source.name}: same content as {duplicate.archived_name} in the destination. skipped. (moved to: {trash_file})")
+                    create_report(Report(started_at=job.started_at, name=job.source.name, status=ReportStatus.SKIPPED, mtime=datetime.fromtimestamp(job.scanned.mtime, tz=timezone.utc), original_bytes=job.scanned.size))
+                    return False
+
+            if job.action == ACTION_SKIP:
+                source_stat = job.source.stat()
+                hash_source(job)
+                shutil.move(job.source, job.destination)
+                index_content(job, target_dir, job.destination.name, job.destination.name)
+                mark_archived(job.video)
+
+                print_log(f"{job.source.name}: already compressed. moved to the destination as is.")
+                create_report(Report(started_at=job.started_at, name=job.source.name, status=ReportStatus.SKIPPED, mtime=datetime.fromtimestamp(source_stat.st_mtime, tz=timezone.utc), original_bytes=source_stat.st_size, compressed_bytes=source_stat.st_size, codec="copy"))
+                return False
+
+            if job.record.state in (JobState.COPIED, JobState.ENCODED):
+                print_log(f"{job.source.name}: resuming from {job.record.state.value}.")
+                job.copy = Path(job.record.copy_path) if job.record.copy_path else None
+                job.duration_download = job.record.duration_download
+                return True
+
+            checkpoint(job, JobState.QUEUED)
+
+            if io_mode == IO_MODE_DIRECT:
+                job.copy = job.source
+                job.duration_download = 0.0
+                checkpoint(job, JobState.COPIED, copy_path=str(job.copy), duration_download=job.duration_download)
+                return True
+
+            job.copy = create_artifact(job, work_dir)
+            download_start = time.perf_counter()
+            shutil.copy(job.source, job.copy)
+            job.duration_download = time.perf_counter() - download_start
+            checkpoint(job, JobState.COPIED, copy_path=str(job.copy), duration_download=job.duration_download)
+            return True
 
-        source_videos = video_repository.list_by_names(source_names) 
-        source_paths = { path.name: path for path in sources }
-        for source, video in [(source_paths[source_video.name], source_video) for source_video in source_videos]:
+        def compress(job: Job) -> bool:
+            if job.record.state == JobState.ENCODED:
+                job.output = Path(job.record.output_path)
+                job.codec = job.record.codec
+                job.quality = job.record.quality
+                job.duration_compress = job.record.duration_compress
+                return True
+
+            # direct では、最後に名前の変更だけで Archive に移動できるよう、出力先と同じボリュームに書き出す。
+            output_dir = remote_temp_dir if io_mode == IO_MODE_DIRECT else work_dir
+            job.output = create_artifact(job, output_dir)
+
+            if job.action == ACTION_REMUX:
+                compress_start = time.perf_counter()
+                job.stats = run_with_progress(remux_command(str(job.copy), str(job.output)), timeout=encode_timeout(clip_duration(job), "copy"))
+                job.duration_compress = time.perf_counter() - compress_start
+                job.codec = "copy"
+                encoded(job)
+                return True
+
+            with encoder_pool.acquire(preferences) as codec:
+                compress_start = time.perf_counter()
+                fast = disk_pressure is not None and disk_pressure.is_active()
+                preset = fast_presets[codec] if fast else presets[codec]
+                threads = encoder_pool.threads(codec)
+
+                duration = clip_duration(job)
+                timeout = encode_timeout(duration, codec)
+                if target_ssim is not None and not fast:
+                    # 標本のエンコードは全体より短いため、全体の見込みの時間を上限とすれば足りる。
+                    quality = search_quality(job.copy, preset, target_ssim, quality_range[0], quality_range[1], sample_count, sample_seconds, threads, timeout)
+                    preset = preset.with_quality(quality)
+                    print_log(f"{job.source.name}: selected {QUALITY_OPTIONS[codec]} {quality} in {time.perf_counter() - compress_start:.3f} seconds.")
+
+                if segments > 1 and codec == LIBX264 and duration is not None and duration >= segment_min_duration:
+                    job.stats = encode_in_segments(job, preset, threads, timeout, duration)
+                elif preview_dir is not None and target_ssim is None:
+                    job.sprite = create_artifact(job, output_dir, ".jpg")
+                    job.proxy = create_artifact(job, output_dir, ".mp4")
+                    job.stats = do_compress_with_previews(job, preset, threads, timeout, duration)
+                else:
+                    job.stats = do_compress(str(job.copy), str(job.output), preset, threads, timeout)
+                job.duration_compress = time.perf_counter() - compress_start
+                job.codec = codec
+                job.quality = preset.quality
+            encoded(job)
+            return True
+
+        def clip_duration(job: Job) -> float | None:
+            result = probe_results.get((job.scanned.name, job.scanned.size, job.scanned.mtime))
+            if result is not None and result.duration is not None:
+                return result.duration
+            try:
+                return probe_duration(job.copy)
+            except (subprocess.SubprocessError, ValueError):
+                return None
+
+        def encode_timeout(duration: float | None, codec: str) -> float | None:
+            if min_stall_timeout <= 0:
+                return None
+            return stall_timeout(duration, encode_speeds.get(codec), min_stall_timeout)
+
+        def encode_in_segments(job: Job, preset: EncoderPreset, threads: int | None, timeout: float | None, duration: float) -> EncodeStats:
+            collected: list[EncodeStats] = []
+
+            def encode(command: list[str]):
+                collected.append(run_with_progress(command, timeout=timeout))
+
+            # このジョブに割り当てたコアを、チャンクのプロセスで分け合う。
+            chunk_threads = max(1, (threads or os.cpu_count() or 1) // segments)
             start = time.perf_counter()
-            started_at = datetime.now(tz=timezone.utc)
-        
+            count = encode_segmented(job.copy, job.output, preset, segments, chunk_threads, encode=encode, work_dir=work_dir, timeout=timeout)
+            print_log(f"{job.source.name}: encoded in {count} segment(s).")
+            return merge_stats(collected, time.perf_counter() - start, duration)
+
+        def encoded(job: Job):
+            if preview_dir is not None:
+                # 記録する前に最終的な場所に移し、ENCODED から再開したジョブでは作り直さない。
+                previews = preview_paths(preview_dir, job.destination.name)
+                if job.sprite is not None and job.sprite.is_file():
+                    shutil.move(job.sprite, previews.sprite)
+                if job.proxy is not None and job.proxy.is_file():
+                    shutil.move(job.proxy, previews.proxy)
+                write_keyframes(job.output, previews.keyframes)
+            checkpoint(job, JobState.ENCODED, output_path=str(job.output), copy_path=None, codec=job.codec, quality=job.quality, duration_compress=job.duration_compress)
+            # 圧縮したファイルがあれば続きから再開できるため、ダウンロードしたファイルはすぐに削除する。
+            if job.copy != job.source:
+                job.copy.unlink(missing_ok=True)
+
+        def upload(job: Job) -> bool:
+            source_stat = job.source.stat()
+            output_stat = job.output.stat()
+            set_timestamp(source_stat, job.output)
+
+            upload_start = time.perf_counter()
+            if io_mode == IO_MODE_DIRECT:
+                job.output.replace(job.destination)
+            else:
+                # 圧縮したファイルは Archive に移動し終えるまで残し、アップロード中に中断してもやり直せるようにする。
+                with temporary_path(suffix=job.source.suffix, dir=remote_temp_dir) as temp_output:
+                    shutil.copy(job.output, temp_output)
+                    shutil.move(temp_output, job.destination)
+            upload_end = time.perf_counter()
+
+            checkpoint(job, JobState.UPLOADED, output_path=None)
+            job.output.unlink(missing_ok=True)
+
+            finish(job, output_stat.st_size, upload_end - upload_start)
+            return True
+
+        def finish(job: Job, compressed_bytes: int, duration_upload: float | None):
+            source_stat = job.source.stat()
+            source_mtime = datetime.fromtimestamp(source_stat.st_mtime, tz=timezone.utc)
+
+            move_to_trash(job, job.destination.name)
+            checkpoint(job, JobState.TRASHED)
+            # 圧縮したファイルのキーフレームは元のファイルと異なるため、--preview-dir がなければ、元のファイルで調べた一覧を使わせない。
+            mark_archived(job.video, **(preview_paths(preview_dir, job.destination.name).to_columns() if preview_dir is not None else { "keyframes_path": None }))
+
+            duration = time.perf_counter() - job.start
+            duration_compress = f"{job.record.duration_compress:.3f}" if job.record.duration_compress is not None else "-"
+
+            print_log(f"{job.source.name}: completed in {duration:.3f} seconds. (compress: {duration_compress} seconds, wait: {job.duration_wait:.3f} seconds)")
+
+            stats = job.stats or EncodeStats()
+            create_report(Report(
+                started_at=job.started_at,
+                name=job.source.name,
+                status=ReportStatus.SUCCESSFUL,
+                mtime=source_mtime,
+                original_bytes=source_stat.st_size,
+                compressed_bytes=compressed_bytes,
+                codec=job.record.codec,
+                quality=job.record.quality,
+                duration_download=job.record.duration_download,
+                duration_compress=job.record.duration_compress,
+                duration_upload=duration_upload,
+                duration_wait=job.duration_wait,
+                duration=duration,
+                io_mode=io_mode,
+                encode_fps=stats.average_fps,
+                encode_speed=stats.speed,
+                cpu_time=stats.cpu_time,
+                max_rss=stats.max_rss,
+                # direct ではダウンロードしないため、スループットを記録しない。
+                mbps_download=megabytes_per_second(source_stat.st_size, job.record.duration_download),
+                mbps_compress=megabytes_per_second(source_stat.st_size, job.record.duration_compress),
+                mbps_upload=megabytes_per_second(compressed_bytes, duration_upload),
+            ))
+
+        def fail(job: Job, e: Exception):
+            if isinstance(e, (subprocess.CalledProcessError, subprocess.TimeoutExpired, StalledError)):
+                print_log(f"{job.source.name}: failed. ({e})", severity=LogSeverity.ERROR)
+                if e.stderr:
+                    print_log(e.stderr, severity=LogSeverity.ERROR)
+            elif isinstance(e, LeaseLostError):
+                print_log(f"{job.source.name}: abandoned. ({e})", severity=LogSeverity.ERROR)
+            else:
+                print_log("".join(traceback.format_exception(e)), severity=LogSeverity.ERROR)
+            create_report(Report(started_at=job.started_at, name=job.source.name, status=ReportStatus.FAILED))
+
+        def wait(job: Job, seconds: float):
+            job.duration_wait += seconds
+
+        if use_nvenc:
+            slots = { H264_NVENC: min(nvenc_sessions, jobs), LIBX264: jobs - min(nvenc_sessions, jobs) }
+            preferences = [H264_NVENC, LIBX264]
+        else:
+            slots = { LIBX264: jobs }
+            preferences = [LIBX264]
+        encoder_pool = EncoderPool(slots)
+
+        def release(job: Job):
+            job.resources.close()
+            with db_lock:
+                lease_repository.release([job.source.name], worker_id)
+                db.commit()
+
+        pipeline = Pipeline(
+            stages=[
+                *([Stage("classify", classify)] if skip_bitrate is not None or remux_bitrate is not None else []),
+                Stage("download", download),
+                Stage("compress", compress, workers=encoder_pool.concurrency),
+                Stage("upload", upload),
+            ],
+            depth=pipeline_depth,
+            on_error=fail,
+            on_finish=release,
+            on_wait=wait,
+        )
+
+        def create_job(video: VideoFile, source: ScannedFile, record: CompressJob | None) -> Job:
+            record = record or CompressJob(name=source.name, state=JobState.QUEUED, size=source.size, mtime=source.mtime, io_mode=io_mode)
+            return Job(source_dir / video.name, target_dir / video.name, video, source, record)
+
+        def pressure_changed(active: bool, free: int):
+            if active:
+                print_log(f"Free space of {source_dir} is {free / 1e9:.1f} GB, below {min_free_gb} GB. Switching to the fast presets.")
+            else:
+                print_log(f"Free space of {source_dir} is {free / 1e9:.1f} GB. Switching back to the normal presets.")
+
+        disk_pressure = DiskPressure(source_dir, int(min_free_gb * 1e9), on_change=pressure_changed) if min_free_gb is not None else None
+
+        # コーデックごとの、過去 30 日間のエンコードの速度の 10 パーセンタイル。遅い場合に合わせて、進捗が止まったとみなすまでの時間を決める。
+        speed_percentiles = report_repository.list_percentiles(Report.encode_speed, [0.1, 0.5], since=datetime.now(tz=timezone.utc) - timedelta(days=30), group=Report.codec)
+        encode_speeds: dict[str, float] = { codec: slow for codec, _, slow, _ in speed_percentiles }
+
+        # 一度にリースを取得するファイルの数。処理能力に比例させ、ほかのワーカーが手を付けられないファイルを抱え込みすぎない。
+        batch_size = claim_size(slots, { codec: median for codec, _, _, median in speed_percentiles }, claim_per_slot)
+
+        estimator = SavingsEstimator(report_repository.list_savings_rates() if POLICY_SAVINGS in order else {})
+
+        def prepare(sources: list[ScannedFile]) -> list[tuple[VideoFile, ScannedFile]]:
+            # videos レコードのないファイルについて、レコードを追加します。
+            source_files = { source.name: source for source in sources }
+            with db_lock:
+                existing_video_names: set[str] = { record.name for record in video_repository.list_by_names(source_files.keys()) }
+
+                new_source = [source for source in sources if source.name not in existing_video_names]
+                print_log(f"Collecting information of {len(new_source)} file(s)...")
+                new_videos = []
+                for source in new_source:
+                    mtime = datetime.fromtimestamp(source.mtime, tz=UTC)
+                    record = VideoFile(name=source.name, mtime=mtime, is_archived=False)
+                    if parse_video_name(source.name) is not None:
+                        record.fill_attributes()
+                    new_videos.append(record)
+                video_repository.add_all_ignoring_duplicates(new_videos)
+                db.commit()
+                print_log("Collecting information of files completed.")
+
+                source_videos = video_repository.list_by_names(source_files.keys())
+
+            sizes = { source.name: source.size for source in sources }
+            return [(video, source_files[video.name]) for video in order_videos(source_videos, sizes, order, estimator)]
+
+        def claim_jobs(candidates: list[tuple[VideoFile, ScannedFile]]) -> Iterator[Job]:
+            # 候補の順に、リースを取得できたファイルだけを処理する。ほかのワーカーが処理しているファイルは飛ばす。
+            remaining = candidates
+            claimed: set[str] = set()
             try:
-                destination = target_dir / source.name
-                if destination.exists():
-                    trash_file = move_to_trash(source)
+                while remaining and not is_stopping():
+                    with db_lock:
+                        claimed = set(lease_repository.claim([video.name for video, _ in remaining], worker_id, lease_seconds, batch_size))
+                        db.commit()
+                    if not claimed:
+                        return
 
-                    print_log(f"{source.name}: already exists in the destination. skipped. (moved to: {trash_file})")
-                    report_repository.create(Report(started_at=started_at, name=source.name, status=ReportStatus.SKIPPED))
-                    continue
-                
-                with temporary_path(suffix=source.suffix) as copy:
-                    download_start = time.perf_counter()
-                    shutil.copy(source, copy)
-                    download_end = time.perf_counter()
-
-                    with temporary_path(suffix=source.suffix) as output:
-                        compress_start = time.perf_counter()
-                        result = do_compress(str(copy), str(output))
-                        result.check_returncode()
-
-                        compress_end = time.perf_counter()
-                        
-                        source_stat = source.stat()
-                        output_stat = output.stat()
-                        set_timestamp(source_stat, output)
-
-                        source_mtime = datetime.fromtimestamp(source_stat.st_mtime, tz=timezone.utc)
-
-                        upload_start = time.perf_counter()
-                        with temporary_path(suffix=source.suffix, dir=remote_temp_dir) as temp_output:
-                            shutil.move(output, temp_output)
-                            shutil.move(temp_output, destination)
-                        upload_end = time.perf_counter()
-                        
-                        move_to_trash(source)
-                        video.is_archived = True
+                    batch = [(video, source) for video, source in remaining if video.name in claimed]
+                    remaining = [(video, source) for video, source in remaining if video.name not in claimed]
+
+                    # リースを取得するまでに、ほかのワーカーが進めた状態を読み直す。
+                    with db_lock:
+                        records = { record.name: record for record in journal_repository.list_by_names(claimed) }
+                        for record in records.values():
+                            db.expunge(record)
+                        if skip_bitrate is not None or remux_bitrate is not None:
+                            probe_results.update({ (result.name, result.size, result.mtime): result for result in ProbeResultRepository(db).list_by_names(claimed) })
+
+                    for video, source in batch:
+                        claimed.discard(video.name)
+                        job = create_job(video, source, resume(records.get(video.name), source))
+                        # 走査してからリースを取得するまでに、ほかのワーカーが処理し終えていることがある。
+                        if not job.source.exists():
+                            release(job)
+                            continue
+                        if is_stopping():
+                            release(job)
+                            break
+                        yield job
+            finally:
+                # 停止したときに、取得したまま投入しなかったファイルのリースを手放す。
+                if claimed:
+                    with db_lock:
+                        lease_repository.release(claimed, worker_id)
                         db.commit()
 
-                        duration_compress = compress_end - compress_start
-                        duration = upload_end - start
-
-                        print_log(f"{source.name}: completed in {duration:.3f} seconds. (compress: {(duration_compress):.3f} seconds)")
-                        
-                        codec = "h264_nvenc" if nvenc else "libx264"
-                        report_repository.create(Report(started_at=started_at, name=source.name, status=ReportStatus.SUCCESSFUL, mtime=source_mtime, original_bytes=source_stat.st_size, compressed_bytes=output_stat.st_size, codec=codec, duration_download=download_end - download_start, duration_compress=duration_compress, duration_upload=upload_end - upload_start, duration=duration))
-
-            except KeyboardInterrupt as e:
-                raise e
-
-            except subprocess.CalledProcessError as e:
-                print_log(f"{source.name}: failed.", severity=LogSeverity.ERROR)
-                print_log(e.stderr, severity=LogSeverity.ERROR)
-                report_repository.create(Report(started_at=started_at, name=source.name, status=ReportStatus.FAILED))
-                
-            except:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                print_log("".join(traceback.format_exception(exc_type, exc_value, exc_traceback)), severity=LogSeverity.ERROR)
-                report_repository.create(Report(started_at=started_at, name=source.name, status=ReportStatus.FAILED))
+        # SIGTERM を受け取ったら新しいジョブの投入をやめ、投入済みのジョブを終えてから終了する。
+        draining = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: draining.set())
+
+        def is_stopping() -> bool:
+            return draining.is_set() or pipeline.stopping.is_set()
+
+        def batch_jobs() -> Iterator[Job]:
+            yield from claim_jobs(prepare(sources))
+
+        def watch_jobs() -> Iterator[Job]:
+            print_log(f"Watching {source_dir} for new files...")
+            sources = source_files.values()
+            # 起動時の走査の後に追加されたファイルも見落とさないよう、索引に記録した更新時刻と比べる。
+            with db_lock:
+                indexed_directory = scan_index_repository.find_directory(str(source_dir))
+            directory_mtime = indexed_directory.mtime if indexed_directory is not None else None
+            # 投入済みのファイル。失敗したファイルも、source_dir に残っている間は再投入しない。
+            queued: set[str] = set()
+            # 書き込みが終わるのを待っているファイルごとの、最後に観測したサイズ、更新時刻と、その時刻。
+            pending: dict[str, tuple[int, float, float]] = {}
+            # ほかのワーカーがリースを持っているファイルと、そのリースの期限。期限が切れるまでは取得を試みない。
+            leased: dict[str, datetime] = {}
+            # 起動時にあったファイル。コピー中のファイルも、robocopy や cp -p では更新時刻が古いため、更新時刻だけで書き込みが終わったとみなすのはこれらに限る。
+            existing = { source.name for source in sources }
+
+            while not is_stopping():
+                names = { source.name for source in sources }
+                queued &= names
+                existing &= names
+                pending = { name: value for name, value in pending.items() if name in names }
+                leased = { name: expires_at for name, expires_at in leased.items() if name in names }
+
+                settled: list[ScannedFile] = []
+                now = time.monotonic()
+                utc_now = datetime.now(tz=timezone.utc)
+                for source in sources:
+                    if source.name in queued or (source.name in leased and leased[source.name] > utc_now):
+                        continue
+
+                    # ディレクトリの更新時刻は、ファイルへの追記では変わらないため、待っているファイルは個別に stat する。
+                    try:
+                        stat = (source_dir / source.name).stat()
+                    except FileNotFoundError:
+                        continue
+
+                    # 起動時にあり、更新されてから settle_seconds 以上経ったファイルは、書き込みが終わっているとみなしてすぐに処理する。
+                    # それ以外は、サイズと更新時刻が settle_seconds 以上変わらなくなるまで待つ。
+                    observed = pending.get(source.name)
+                    if source.name in existing and time.time() - stat.st_mtime >= settle_seconds:
+                        pass
+                    elif observed is None or observed[:2] != (stat.st_size, stat.st_mtime):
+                        pending[source.name] = (stat.st_size, stat.st_mtime, now)
+                        continue
+                    elif now - observed[2] < settle_seconds:
+                        continue
+
+                    pending.pop(source.name, None)
+                    leased.pop(source.name, None)
+                    queued.add(source.name)
+                    settled.append(ScannedFile(directory=source.directory, name=source.name, size=stat.st_size, mtime=stat.st_mtime))
+
+                if settled:
+                    print_log(f"{len(settled)} new file(s) found.")
+                    started: set[str] = set()
+                    for job in claim_jobs(prepare(settled)):
+                        started.add(job.source.name)
+                        yield job
+                    # ほかのワーカーが処理しているファイルは、リースの期限が切れてから改めて取得を試みる。
+                    skipped = { source.name for source in settled } - started
+                    queued -= skipped
+                    with db_lock:
+                        leased.update(lease_repository.list_expirations(skipped))
+
+                if draining.wait(poll_interval):
+                    break
+                # ディレクトリが変わっていなければ、索引を読み直さない。
+                current_mtime = source_dir.stat().st_mtime
+                if current_mtime != directory_mtime:
+                    directory_mtime = current_mtime
+                    with db_lock:
+                        sources = scan_directory(scan_index_repository, source_dir, "*.mp4")
+
+        try:
+            with LeaseHeartbeat(get_db, worker_id, lease_seconds):
+                pipeline.run(watch_jobs() if watch else batch_jobs())
+        finally:
+            # ファイルの列挙に失敗して止まった場合も、ほかのワーカーが期限を待たずに取得できるようにする。
+            with db_lock:
+                db.rollback()
+                lease_repository.release_all(worker_id)
+                db.commit()
+        if draining.is_set():
+            print_log("Stopped by SIGTERM after finishing the queued files.")
 
 if __name__ == "__main__":
     main()
@@ -1,85 +1,179 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import os
 from pathlib import Path
-import re
+import shutil
 import subprocess
 import sys
 import tempfile
 
-
-PATTERN_VIDEO_NAME = re.compile(r"^\d{8}_(\d{10})_NF.MP4$", flags=re.I)
-FORMAT_TIMESTAMP = "%y%m%d%H%M"
+from dashcamtools.models import from_unix_minute, to_unix_minute, VideoPart
+from dashcamtools.encoders import PRESETS, LIBX264
+from dashcamtools.probe import count_frames, is_stream_compatible, probe_duration
+from dashcamtools.segments import encode_chunks, join_chunks, verify_join, SegmentMismatchError
 
 parser = argparse.ArgumentParser()
 parser.add_argument("videos")
 parser.add_argument("destination")
+# 同時に処理するグループの数。
+parser.add_argument("--jobs", type=int, default=1)
+parser.add_argument("--direction", choices=["front", "rear"], nargs="+", default=["front"])
+# 常時録画に加えて、イベント録画（G, S）もつなげる。
+parser.add_argument("--include-events", action="store_true")
+# 指定した場合は、videos を走査せずに DB のタイムラインから範囲内のファイルを求める。例: 2024-08-01T14:00
+parser.add_argument("--since", type=datetime.fromisoformat)
+parser.add_argument("--until", type=datetime.fromisoformat)
+# 再エンコードが必要なグループで、ファイルごとに並行してエンコードするプロセスの数。1 ではグループ全体を 1 つのプロセスでエンコードする。
+parser.add_argument("--segments", type=int, default=1)
 
 args = parser.parse_args()
 
 videos = Path(args.videos)
 destination =  Path(args.destination)
+jobs: int = args.jobs
+directions: list[str] = args.direction
+include_events: bool = args.include_events
+since: datetime | None = args.since
+until: datetime | None = args.until
+segments: int = args.segments
+
+def partial_path(output_path: Path) -> Path:
+    # ffmpeg は拡張子で形式を決めるため、拡張子は変えない。
+    return output_path.with_name(f"{output_path.stem}.partial{output_path.suffix}")
 
 def concatenate_videos(video_paths: list[Path], output_path: Path):
+    # 同じカメラで連続して録画されたファイルはパラメーターが一致するため、再エンコードせずにつなげられる。
+    # 一致しない場合だけ再エンコードする。
+    if is_stream_compatible(video_paths):
+        codec_options = ["-c", "copy"]
+    elif segments > 1 and encode_parts(video_paths, output_path):
+        return
+    else:
+        codec_options = ["-crf", str(28), "-c:v", "libx264"]
+
     with tempfile.NamedTemporaryFile(mode="w+", suffix=".txt", encoding="utf-8", delete=False) as file_list_path:
-        file_list = "".join([f"file '{str(path)}'\n" for path in video_paths])
+        file_list = "".join([f"file '{str(path.resolve())}'\n" for path in video_paths])
         file_list_path.write(file_list)
         file_list_path.flush()
-        
+    
+    # 失敗や中断で書きかけのファイルが出力の名前で残ると、次回は既に存在するとして飛ばされるため、一時的な名前で書き出してから名前を変える。
+    partial = partial_path(output_path)
+    try:
         command = [
             "ffmpeg",
+            "-y",
+            "-loglevel", "error",
             "-f", "concat",
             "-safe", "0",
             "-i", str(file_list_path.name),
             "-map", "0",
-            "-crf", str(28),
-            "-c:v", "libx264",
-            str(output_path),
+            *codec_options,
+            str(partial),
         ]
         
-        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        print(result.stdout.decode())
+        subprocess.run(command, check=True)
+        partial.replace(output_path)
+    finally:
+        partial.unlink(missing_ok=True)
+        Path(file_list_path.name).unlink(missing_ok=True)
 
-def group_videos(paths: list[Path]) -> list[list[Path]]:
-    last_timestamp: int | None = None
-    groups: list[list[Path]] = []
-    group_in_progress: list[Path] = []
+def encode_parts(video_paths: list[Path], output_path: Path) -> bool:
+    # ファイルごとに同じ設定で並行して再エンコードすれば、ストリームコピーでつなげられる。
+    # ただし、解像度やフレームレート、音声の形式は入力のまま残るため、そろわなければ False を返し、1 つのプロセスでのエンコードに任せる。
+    frames = sum(count_frames(path) for path in video_paths)
+    duration = sum(probe_duration(path) for path in video_paths)
+    threads = max(1, (os.cpu_count() or 1) // (segments * jobs))
+
+    # つなげた結果を確かめるまでは、出力の名前で置かない。
+    with tempfile.TemporaryDirectory() as temp_dir:
+        outputs = [Path(temp_dir, f"encoded{index:03d}{path.suffix}") for index, path in enumerate(video_paths)]
+        encode_chunks(video_paths, outputs, PRESETS[LIBX264], segments, threads)
+        if not is_stream_compatible(outputs):
+            print(f"Parts of {output_path.name} have different stream parameters. Re-encoding in a single process.", file=sys.stderr)
+            return False
+
+        joined = Path(temp_dir, f"joined{output_path.suffix}")
+        join_chunks(outputs, joined, Path(temp_dir))
+        verify_join(joined, frames, duration, len(video_paths))
+
+        # 一時ディレクトリと出力先が別のファイルシステムにあれば移動はコピーになるため、一時的な名前でコピーしてから名前を変える。
+        partial = partial_path(output_path)
+        try:
+            shutil.move(joined, partial)
+            partial.replace(output_path)
+        finally:
+            partial.unlink(missing_ok=True)
+    return True
+
+def group_videos(parts: list[VideoPart]) -> list[list[VideoPart]]:
+    groups: list[list[VideoPart]] = []
+    group_in_progress: list[VideoPart] = []
     
-    for path in paths:
-        matched = PATTERN_VIDEO_NAME.search(path.name)
-        timestamp = datetime.strptime(matched[1], FORMAT_TIMESTAMP)
-        timestamp.replace(year=2000 + timestamp.year)
-        unix_minute = int(timestamp.timestamp()) // 60
-        
-        if last_timestamp is not None and last_timestamp != (unix_minute - 1):
+    for part in sorted(parts):
+        # 同じ分の常時録画とイベント録画が両方ある場合は、先にあるほうだけを使う。
+        if group_in_progress and part.is_front == group_in_progress[-1].is_front and part.timestamp == group_in_progress[-1].timestamp:
+            continue
+
+        if group_in_progress and not part.is_next_to(group_in_progress[-1]):
             groups.append(group_in_progress)
             group_in_progress = []
         
-        group_in_progress.append(path)
-        last_timestamp = unix_minute
+        group_in_progress.append(part)
     
     # ループの中で最後に作られたグループを追加する
-    if last_timestamp is not None:
+    if group_in_progress:
         groups.append(group_in_progress)
 
     return groups
 
+def list_groups() -> list[list[VideoPart]]:
+    if since is None and until is None:
+        parts = [part for part in map(VideoPart.from_path, videos.glob("*.mp4")) if part is not None]
+        return group_videos([part for part in parts if ("front" if part.is_front else "rear") in directions and (include_events or not part.is_event)])
+
+    # DATABASE_URL を設定していなくても videos を走査する使い方ができるよう、DB は必要になったときに読み込む。
+    from dashcamtools.orm import get_db, VideoDirection
+    from dashcamtools.repositories import VideoFileRepository
+
+    start_minute = to_unix_minute(since) if since is not None else 0
+    end_minute = to_unix_minute(until) if until is not None else 2 ** 62
+    is_event = None if include_events else False
+    groups: list[list[VideoPart]] = []
+    with get_db() as db:
+        repository = VideoFileRepository(db)
+        # 途切れなく録画された区間を DB で求め、区間ごとに 1 つのファイルにつなげる。
+        for direction in directions:
+            for segment in repository.list_segments(VideoDirection(direction), start_minute, end_minute, is_event=is_event):
+                videos_in_segment = repository.list_timeline(VideoDirection(direction), segment.start_minute, segment.end_minute, is_event=is_event)
+                # 同じ分に常時録画とイベント録画が両方ある場合は、常時録画を使う。
+                group: dict[int, VideoPart] = {}
+                for video in sorted(videos_in_segment, key=lambda video: (video.unix_minute, video.is_event)):
+                    group.setdefault(video.unix_minute, VideoPart(videos / video.name, video.unix_minute, is_front=video.direction == VideoDirection.FRONT, is_event=video.is_event))
+                groups.append(list(group.values()))
+    return groups
+
 def main():
-    # p.stem[9:] は、最初の 8 けたの連番を除いたものを得る。
-    paths = sorted([video for video in videos.glob("*.mp4") if PATTERN_VIDEO_NAME.search(video.name)], key=lambda p: p.stem[9:])
-    groups = group_videos(paths)
+    groups = list_groups()
     
     print(f"Concatenating {len(groups)} groups...")
-    for group in groups:
-        timestamp = datetime.strptime(PATTERN_VIDEO_NAME.search(group[0].name)[1], FORMAT_TIMESTAMP)
-        timestamp.replace(year=2000 + timestamp.year)
-        output = destination / f"{timestamp.strftime('%Y%m%d-%H%M')}F.mp4"
+
+    def process(group: list[VideoPart]):
+        timestamp = from_unix_minute(group[0].timestamp)
+        output = destination / f"{timestamp.strftime('%Y%m%d-%H%M')}{'F' if group[0].is_front else 'R'}.mp4"
         
         if output.exists():
             print(f"File {output.name} already exists. Skipped.", file=sys.stderr)
-            continue
+            return
 
         print(f"Concatenating {len(group)} video(s)...")
-        concatenate_videos(group, output)
+        try:
+            concatenate_videos([part.path for part in group], output)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, SegmentMismatchError):
+            print(f"Failed to concatenate into {output.name}.", file=sys.stderr)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        list(executor.map(process, groups))
 
 if __name__ == "__main__":
     main()
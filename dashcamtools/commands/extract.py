@@ -0,0 +1,129 @@
+import argparse
+from datetime import datetime, timedelta
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+
+from dashcamtools.clips import extract_clip, plan_cuts, Cut
+from dashcamtools.models import from_unix_minute, to_unix_minute
+from dashcamtools.previews import preview_paths, read_keyframes, write_keyframes
+from dashcamtools.probe import is_stream_compatible, probe_duration, probe_video
+
+# 範囲の始まりより前に録画を始めたファイルを探す時間（分）。1 つのファイルの長さはこれを超えないものとする。
+LOOKBACK_MINUTES = 5
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("videos")
+    parser.add_argument("destination")
+    # 切り出す範囲の中心の時刻（カメラの時刻）。例: 2024-08-01T14:03:12
+    parser.add_argument("time", type=datetime.fromisoformat)
+    # time の前後に切り出す秒数。
+    parser.add_argument("--before", type=float, default=30.0)
+    parser.add_argument("--after", type=float, default=30.0)
+    parser.add_argument("--direction", choices=["front", "rear"], nargs="+", default=["front", "rear"])
+    # 常時録画に加えて、イベント録画（G, S）も使う。同じ分に両方がある場合は常時録画を使う。
+    parser.add_argument("--include-events", action="store_true")
+    # 範囲をキーフレームまで広げずに、フレーム単位で切り出す。両端の半端な GOP だけを再エンコードする。
+    parser.add_argument("--accurate", action="store_true")
+    # キーフレームの一覧がまだないファイルを調べた結果を書き出すディレクトリ。既定は videos と同じ階層の Previews。
+    parser.add_argument("--preview-dir", type=Path)
+    return parser
+
+def main():
+    args = build_parser().parse_args()
+
+    videos = Path(args.videos)
+    destination = Path(args.destination)
+    time: datetime = args.time
+    before: float = args.before
+    after: float = args.after
+    directions: list[str] = args.direction
+    include_events: bool = args.include_events
+    accurate: bool = args.accurate
+    preview_dir: Path = args.preview_dir or videos.parent / "Previews"
+
+    window_start = time - timedelta(seconds=before)
+    window_end = time + timedelta(seconds=after)
+
+    # SQLAlchemy の読み込みには時間がかかるため、引数を解析してから読み込む。
+    from dashcamtools.orm import get_db, VideoDirection, VideoFile
+    from dashcamtools.repositories import VideoFileRepository
+
+    with get_db() as db:
+        repository = VideoFileRepository(db)
+
+        def load_keyframes(video: VideoFile, path: Path) -> list[float]:
+            # compress --preview-dir や前回の extract で書き出した一覧があれば、ファイルを読み直さずに使う。
+            if video.keyframes_path is not None:
+                cached = Path(video.keyframes_path)
+                if cached.is_file() and cached.stat().st_mtime >= path.stat().st_mtime:
+                    return read_keyframes(cached)
+
+            preview_dir.mkdir(parents=True, exist_ok=True)
+            keyframes_path = preview_paths(preview_dir, video.name).keyframes
+            keyframes = write_keyframes(path, keyframes_path)
+            video.keyframes_path = str(keyframes_path)
+            db.commit()
+            return keyframes
+
+        def plan(direction: VideoDirection) -> tuple[list[Cut], dict[Path, float]]:
+            cuts: list[Cut] = []
+            durations: dict[Path, float] = {}
+            candidates = repository.list_timeline(direction, to_unix_minute(window_start) - LOOKBACK_MINUTES, to_unix_minute(window_end), is_event=None if include_events else False)
+
+            # 録画時刻はファイル名の分単位のものしかないため、各ファイルはその分の 0 秒に始まるとみなす。
+            # 前のファイルと重なる部分は、前のファイルから切り出す。
+            cursor = window_start
+            for video in sorted(candidates, key=lambda video: (video.unix_minute, video.is_event)):
+                path = videos / video.name
+                if not path.is_file():
+                    print(f"{video.name}: file does not exist. skipped.", file=sys.stderr)
+                    continue
+
+                file_start = from_unix_minute(video.unix_minute)
+                duration = probe_duration(path)
+                start = max(cursor, file_start)
+                end = min(window_end, file_start + timedelta(seconds=duration))
+                if start >= end:
+                    continue
+
+                # 両端の再エンコードには libx264 を使うため、H.264 でないファイルはキーフレームまで広げて切り出す。
+                frame_accurate = accurate and probe_video(path).codec == "h264"
+                if accurate and not frame_accurate:
+                    print(f"{video.name}: not H.264. cut at keyframes.", file=sys.stderr)
+
+                keyframes = load_keyframes(video, path)
+                cuts.extend(plan_cuts(path, keyframes, (start - file_start).total_seconds(), (end - file_start).total_seconds(), duration, frame_accurate))
+                durations[path] = duration
+                cursor = end
+            return cuts, durations
+
+        destination.mkdir(parents=True, exist_ok=True)
+        for direction in directions:
+            output = destination / f"{time.strftime('%Y%m%d-%H%M%S')}{'F' if direction == 'front' else 'R'}.mp4"
+            if output.exists():
+                print(f"File {output.name} already exists. Skipped.", file=sys.stderr)
+                continue
+
+            cuts, durations = plan(VideoDirection(direction))
+            if not cuts:
+                print(f"No {direction} recordings between {window_start} and {window_end}.", file=sys.stderr)
+                continue
+            if not is_stream_compatible(list(durations.keys())):
+                print(f"Failed to extract {output.name}. Recordings in the range have different stream parameters.", file=sys.stderr)
+                continue
+
+            reencoded = sum(cut.end - cut.start for cut in cuts if cut.reencode)
+            print(f"Extracting {output.name} from {len(durations)} file(s)... (re-encoding {reencoded:.3f} seconds)", file=sys.stderr)
+            try:
+                with tempfile.TemporaryDirectory() as work_dir:
+                    extract_clip(cuts, durations, output, Path(work_dir))
+            except subprocess.CalledProcessError as e:
+                print(f"Failed to extract {output.name}. ({e})", file=sys.stderr)
+                if e.stderr:
+                    print(e.stderr, file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,57 @@
 import argparse
+import sys
+import time
 
-from dashcamtools.orm import get_db
-from dashcamtools.repositories import VideoFileRepository
+from dashcamtools.models import parse_video_name, to_unix_minute
 
-parser = argparse.ArgumentParser()
-
-args = parser.parse_args()
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    # 一度に読み出し、更新する行の数。
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    return parser
 
 def main():
-    with get_db() as db:
+    args = build_parser().parse_args()
+
+    chunk_size: int = args.chunk_size
+
+    # SQLAlchemy の読み込みには時間がかかるため、引数を解析してから読み込む。
+    from dashcamtools.orm import get_db, VideoDirection
+    from dashcamtools.repositories import VideoFileRepository
+
+    # 読み出しの途中で同じテーブルを更新するため、読み出しと更新でセッションを分ける。
+    with get_db() as reader, get_db() as db:
+        reader_repository = VideoFileRepository(reader)
         video_repository = VideoFileRepository(db)
-        video_repository.fill_attributes_all()
-        # db.commit()
+
+        start = time.perf_counter()
+        filled = 0
+        skipped = 0
+
+        for names in reader_repository.iterate_names_without_attributes(chunk_size):
+            rows = []
+            for name in names:
+                parsed = parse_video_name(name)
+                if parsed is None:
+                    skipped += 1
+                    continue
+
+                recorded_at, is_event, is_front = parsed
+                rows.append({
+                    "name": name,
+                    "direction": VideoDirection.FRONT if is_front else VideoDirection.REAR,
+                    "is_event": is_event,
+                    "recorded_at": recorded_at,
+                    "unix_minute": to_unix_minute(recorded_at),
+                })
+
+            if rows:
+                video_repository.update_attributes(rows)
+                db.commit()
+
+            filled += len(rows)
+            elapsed = time.perf_counter() - start
+            print(f"{filled} row(s) filled. ({filled / elapsed:.0f} rows/s)", file=sys.stderr)
+
+        elapsed = time.perf_counter() - start
+        print(f"Completed in {elapsed:.3f} seconds. (filled: {filled}, skipped: {skipped}, {filled / elapsed if elapsed > 0 else 0:.0f} rows/s)", file=sys.stderr)
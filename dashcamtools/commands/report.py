@@ -0,0 +1,78 @@
+import argparse
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+PERCENTILES = [0.5, 0.9, 0.99]
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    # 指定した場合は、Raw に残っているファイルを処理し終えるまでの時間を見積もる。
+    parser.add_argument("storage_dir", metavar="storage-dir", type=Path, nargs="?")
+    # 集計の対象とする期間（日）。0 の場合はすべてのレポートを集計する。
+    parser.add_argument("--days", type=float, default=30)
+    return parser
+
+def format_value(value, digits: int = 3) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return f"{value:.{digits}f}"
+    return str(value)
+
+def print_table(header: list[str], rows: list[list]) -> None:
+    print("\t".join(header))
+    for row in rows:
+        print("\t".join(map(format_value, row)))
+    print()
+
+def main():
+    args = build_parser().parse_args()
+
+    storage_dir: Path | None = args.storage_dir
+    days: float = args.days
+
+    # SQLAlchemy の読み込みには時間がかかるため、引数を解析してから読み込む。
+    from sqlalchemy import func
+
+    from dashcamtools.orm import get_db, Report
+    from dashcamtools.repositories import ReportRepository, ScanIndexRepository
+    from dashcamtools.scanner import scan_directory
+
+    since = datetime.now(tz=timezone.utc) - timedelta(days=days) if days > 0 else None
+
+    with get_db() as db:
+        repository = ReportRepository(db)
+
+        # ステージごとのスループット（MB/s）。ダウンロードと圧縮は元のファイル、アップロードは圧縮したファイルのサイズによる。
+        stages = [
+            ("download", Report.original_bytes / func.nullif(Report.duration_download, 0) / 1e6),
+            ("compress", Report.original_bytes / func.nullif(Report.duration_compress, 0) / 1e6),
+            ("upload", Report.compressed_bytes / func.nullif(Report.duration_upload, 0) / 1e6),
+        ]
+        rows = []
+        for stage, value in stages:
+            for _, count, *percentiles in repository.list_percentiles(value, PERCENTILES, since):
+                rows.append([stage, count, *percentiles])
+        print_table(["stage", "count", *[f"p{percentile * 100:g}_mbps" for percentile in PERCENTILES]], rows)
+
+        encode_percentiles = { codec: percentiles for codec, _, *percentiles in repository.list_percentiles(Report.original_bytes / func.nullif(Report.duration_compress, 0) / 1e6, PERCENTILES, since, group=Report.codec) }
+        rows = []
+        for codec, count, original_bytes, compressed_bytes, quality, encode_fps, duration_compress in repository.summarize_codecs(since):
+            ratio = compressed_bytes / original_bytes if original_bytes else None
+            rows.append([codec, count, original_bytes, compressed_bytes, ratio, quality, encode_fps, *encode_percentiles.get(codec, [None] * len(PERCENTILES))])
+        print_table(["codec", "count", "original_bytes", "compressed_bytes", "ratio", "quality", "encode_fps", *[f"p{percentile * 100:g}_mbps" for percentile in PERCENTILES]], rows)
+
+        busy_bytes, busy_seconds = repository.measure_busy_time(since)
+        throughput = busy_bytes / busy_seconds if busy_seconds > 0 else None
+        row = [busy_bytes, busy_seconds, throughput / 1e6 if throughput else None]
+        header = ["busy_bytes", "busy_seconds", "busy_mbps"]
+
+        if storage_dir is not None:
+            sources = scan_directory(ScanIndexRepository(db), storage_dir / "Raw", "*.mp4")
+            remaining_bytes = sum(source.size for source in sources)
+            header.extend(["remaining_files", "remaining_bytes", "projected_hours"])
+            row.extend([len(sources), remaining_bytes, remaining_bytes / throughput / 3600 if throughput else None])
+        print_table(header, [row])
+
+if __name__ == "__main__":
+    main()
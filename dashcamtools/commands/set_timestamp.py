@@ -1,46 +1,104 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from fnmatch import fnmatch
 import os
 from pathlib import Path
 import sys
 from win32_setctime import setctime
 
 
-parser = argparse.ArgumentParser()
-parser.add_argument("glob", type=str)
-parser.add_argument("source_dir", metavar="source-dir", type=Path)
-parser.add_argument("target_dir", metavar="target-dir", type=Path)
-parser.add_argument("-q", "--quiet", action="store_true")
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("glob", type=str)
+    parser.add_argument("source_dir", metavar="source-dir", type=Path)
+    parser.add_argument("target_dir", metavar="target-dir", type=Path)
+    parser.add_argument("-q", "--quiet", action="store_true")
+    # タイムスタンプを並行して設定するスレッドの数。
+    parser.add_argument("--jobs", type=int, default=8)
+    # この秒数以内の差は、設定済みとみなす。FAT や exFAT では更新日時が 2 秒単位でしか記録されない。
+    parser.add_argument("--tolerance", type=float, default=2.0)
+    # タイムスタンプを設定せず、設定する内容だけを表示する。
+    parser.add_argument("--dry-run", action="store_true")
+    return parser
 
-args = parser.parse_args()
+# 作成日時を設定できるのは Windows だけ。ほかの OS の st_ctime は変更日時なので、比較もしない。
+CTIME_SUPPORTED = sys.platform == "win32"
 
-glob: str = args.glob
-source_dir: Path = args.source_dir
-target_dir: Path = args.target_dir
-quiet: bool = args.quiet
+def list_stats(directory: Path, pattern: str) -> dict[str, os.stat_result]:
+    # ディレクトリを 1 回だけ読む。Windows では一覧に stat の情報が含まれ、ファイルごとに問い合わせずに済む。
+    with os.scandir(directory) as entries:
+        return { entry.name: entry.stat() for entry in entries if fnmatch(entry.name, pattern) and entry.is_file() }
+
+def list_sources(source_dir: Path, glob: str) -> dict[str, os.stat_result]:
+    # サブディレクトリをたどるパターンの場合に限り、Path.glob で探す。
+    if "/" in glob or "\\" in glob or "**" in glob:
+        return { source.name: source.stat() for source in source_dir.glob(glob) if source.is_file() }
+    return list_stats(source_dir, glob)
+
+def is_synced(source_stat: os.stat_result, target_stat: os.stat_result, tolerance: float) -> bool:
+    if abs(target_stat.st_mtime - source_stat.st_mtime) > tolerance:
+        return False
+    return not CTIME_SUPPORTED or abs(target_stat.st_ctime - source_stat.st_ctime) <= tolerance
+
+def apply(target: Path, source_stat: os.stat_result) -> None:
+    os.utime(target, (source_stat.st_atime, source_stat.st_mtime))
+    if CTIME_SUPPORTED:
+        setctime(target, source_stat.st_ctime)
 
 def main():
+    args = build_parser().parse_args()
+
+    glob: str = args.glob
+    source_dir: Path = args.source_dir
+    target_dir: Path = args.target_dir
+    quiet: bool = args.quiet
+    jobs: int = args.jobs
+    tolerance: float = args.tolerance
+    dry_run: bool = args.dry_run
+
     def format(timestamp: float) -> str:
         return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
-    
-    for source in source_dir.glob(glob):
-        target = target_dir / source.name
-        if not target.exists():
+
+    sources = list_sources(source_dir, glob)
+    targets = list_stats(target_dir, Path(glob).name)
+
+    missing = 0
+    synced = 0
+    changes: list[tuple[str, os.stat_result]] = []
+    for name, source_stat in sorted(sources.items()):
+        target_stat = targets.get(name)
+        if target_stat is None:
+            missing += 1
             if not quiet:
-                print(f"{source.name}: file does not exist in the target.", file=sys.stderr)
+                print(f"{name}: file does not exist in the target.", file=sys.stderr)
             continue
 
-        source_stat = source.stat()
-        target_stat = target.stat()
-
-        if (target_stat.st_mtime - source_stat.st_mtime) == 0.0 and (target_stat.st_ctime - source_stat.st_ctime) == 0.0:
+        if is_synced(source_stat, target_stat, tolerance):
+            synced += 1
             if not quiet:
-                print(f"{source.name}: timestamp is already set. skipped.")
+                print(f"{name}: timestamp is already set. skipped.")
             continue
 
-        print(f"{source.name}: {format(source_stat.st_mtime)} {format(source_stat.st_ctime)}")
-        os.utime(target, (source_stat.st_atime, source_stat.st_mtime))
-        setctime(target, source_stat.st_ctime)
+        changes.append((name, source_stat))
+        if dry_run:
+            print(f"{name}: {format(target_stat.st_mtime)} {format(target_stat.st_ctime)} -> {format(source_stat.st_mtime)} {format(source_stat.st_ctime)}")
+
+    failed = 0
+    if not dry_run:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = { executor.submit(apply, target_dir / name, source_stat): (name, source_stat) for name, source_stat in changes }
+            for future in as_completed(futures):
+                name, source_stat = futures[future]
+                try:
+                    future.result()
+                    print(f"{name}: {format(source_stat.st_mtime)} {format(source_stat.st_ctime)}")
+                except OSError as e:
+                    failed += 1
+                    print(f"{name}: failed to set timestamp. {e}", file=sys.stderr)
+
+    action = "to update" if dry_run else "updated"
+    print(f"{len(changes) - failed} file(s) {action}, {synced} already set, {missing} missing in the target, {failed} failed.", file=sys.stderr)
 
 
 if __name__ == "__main__":
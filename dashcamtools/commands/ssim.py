@@ -1,76 +1,35 @@
 import argparse
-from datetime import datetime
-import os
 from pathlib import Path
-import sys
-from win32_setctime import setctime
-import re
-import statistics
-import subprocess
 
-from dashcamtools.util import temporary_path
+from dashcamtools.quality import measure_quality
 
 
-PATTERN_LINE = re.compile(r"^n:\d+\s+.+\s+All:([\d+\.]+)\s\((.+?)\)$")
-
-parser = argparse.ArgumentParser()
-parser.add_argument("targets", type=Path, nargs="+")
-parser.add_argument("original", type=Path)
-
-args = parser.parse_args()
-
-targets: list[Path] = args.targets
-original: Path = args.original
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("targets", type=Path, nargs="+")
+    parser.add_argument("original", type=Path)
+    # N フレームごとに 1 フレームだけ比較する。概算を素早く得たい場合に使う。
+    parser.add_argument("--every-nth", type=int, default=1)
+    # libvmaf を有効にしてビルドされた ffmpeg が必要。
+    parser.add_argument("--vmaf", action="store_true")
+    return parser
 
 def main():
-    def do_ssim(target: Path, original: Path) -> str:
-        command = [
-            "ffmpeg",
-            "-y",
-            "-loglevel", "error",
-            "-i", target,
-            "-i", original,
-            "-filter_complex", f"ssim=f=-",
-            "-an",
-            "-f", "null",
-            "-"
-        ]
-        result = subprocess.run(command, capture_output=True, text=True).stdout
-        return result
-
+    args = build_parser().parse_args()
 
-    def extract_statistics(name: str, output: str) -> "map[str]":
-        alls = []
-        dbs = []
-
-        for line in output.splitlines():
-            match = PATTERN_LINE.search(line)
-            if not match:
-                continue
-        
-            (all, db) = match.groups()
-            
-            alls.append(float(all))
-            dbs.append(float(db))
-
-        min_all = min(alls)
-        max_all = max(alls)
-        all_mean = statistics.mean(alls)
-        all_stddev = statistics.stdev(alls)
-        
-        min_db = min(dbs)
-        max_db = max(dbs)
-        db_mean = statistics.mean(dbs)
-        db_stddev = statistics.stdev(dbs)
-
-        values = [name, min_all, max_all, all_mean, all_stddev, min_db, max_db, db_mean, db_stddev]
-        return map(str, values)
+    targets: list[Path] = args.targets
+    original: Path = args.original
+    every_nth: int = args.every_nth
+    vmaf: bool = args.vmaf
 
     original_stat = original.stat()
 
-    for target in targets:
-        ssim_log = do_ssim(target, original)
-        stats = [str(target.stat().st_size), str(original_stat.st_size)] + list(extract_statistics(target.name, ssim_log))
+    for result in measure_quality(targets, original, every_nth=every_nth, vmaf=vmaf):
+        values = [result.target.name, *result.ssim.values(), *result.ssim_db.values(), *result.psnr.values()]
+        if result.vmaf is not None:
+            values.extend(result.vmaf.values())
+
+        stats = [str(result.target.stat().st_size), str(original_stat.st_size)] + list(map(str, values))
         print("\t".join(stats))
 
 if __name__ == "__main__":
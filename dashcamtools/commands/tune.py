@@ -0,0 +1,175 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import itertools
+import os
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+import time
+
+from dashcamtools.encoders import compress_command, EncoderPreset, format_options, H264_NVENC, LIBX264
+from dashcamtools.quality import measure_quality
+from dashcamtools.util import file_hash
+
+# 一度の ffmpeg で画質を比較する出力の数。多すぎると同時にデコードするストリームが増え、メモリが足りなくなる。
+QUALITY_BATCH_SIZE = 8
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("clips", type=Path, nargs="*")
+    parser.add_argument("--codec", choices=[LIBX264, H264_NVENC], default=LIBX264)
+    # 例: --param crf=23,26,28 --param preset=medium,slow
+    parser.add_argument("--param", action="append", default=[])
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--every-nth", type=int, default=1)
+    # 指定したパラメーターの組み合わせを、compress の --preset で使えるように保存する。
+    parser.add_argument("--save-preset", type=str)
+    return parser
+
+def expand_grid(params: list[str]) -> list[dict[str, str]]:
+    keys: list[str] = []
+    values: list[list[str]] = []
+    for param in params:
+        key, value = param.split("=", 1)
+        keys.append(key)
+        values.append(value.split(","))
+    return [dict(zip(keys, combination)) for combination in itertools.product(*values)]
+
+def run_measured(command: list[str]) -> tuple[float, float | None]:
+    # 経過時間と、子プロセスが消費した CPU 時間を返す。CPU 時間は wait4 のある環境でのみ得られる。
+    start = time.perf_counter()
+    process = subprocess.Popen(command)
+    if hasattr(os, "wait4"):
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        cpu_time = usage.ru_utime + usage.ru_stime
+    else:
+        process.wait()
+        cpu_time = None
+    duration = time.perf_counter() - start
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    return duration, cpu_time
+
+def is_dominated(row: dict, rows: list[dict]) -> bool:
+    # サイズ、画質、速度のすべてで劣るか等しく、いずれかで厳密に劣る行は、パレート最適ではない。
+    for another in rows:
+        if another is row:
+            continue
+        if another["compressed_bytes"] <= row["compressed_bytes"] and another["ssim_mean"] >= row["ssim_mean"] and another["duration"] <= row["duration"]:
+            if another["compressed_bytes"] < row["compressed_bytes"] or another["ssim_mean"] > row["ssim_mean"] or another["duration"] < row["duration"]:
+                return True
+    return False
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    clips: list[Path] = args.clips
+    codec: str = args.codec
+    params: list[str] = args.param
+    jobs: int = args.jobs
+    every_nth: int = args.every_nth
+    save_preset: str | None = args.save_preset
+
+    if save_preset is None and not clips:
+        parser.error("clips are required unless --save-preset is given")
+
+    # SQLAlchemy の読み込みには時間がかかるため、引数を解析してから読み込む。
+    from dashcamtools.orm import get_db, TuneResult
+    from dashcamtools.repositories import EncoderPresetRepository, TuneResultRepository
+
+    grid = expand_grid(params)
+
+    with get_db() as db:
+        if save_preset is not None:
+            if len(grid) != 1:
+                parser.error("--save-preset requires exactly one combination of parameters")
+
+            preset = EncoderPreset(codec, grid[0])
+            EncoderPresetRepository(db).save(save_preset, preset)
+            db.commit()
+            print(f"Saved preset {save_preset}: {codec} {preset.format_options()}", file=sys.stderr)
+            return
+
+        result_repository = TuneResultRepository(db)
+        threads = max(1, (os.cpu_count() or 1) // jobs) if codec == LIBX264 and jobs > 1 else None
+        conditions = { "jobs": jobs, "threads": threads or 0, "every_nth": every_nth }
+
+        results: dict[str, list[TuneResult]] = { format_options(options): [] for options in grid }
+        for clip in clips:
+            clip_hash = file_hash(clip)
+            original_bytes = clip.stat().st_size
+
+            pending = [options for options in grid if result_repository.find(clip_hash, codec, format_options(options), **conditions) is None]
+            print(f"{clip.name}: {len(grid) - len(pending)} cached, {len(pending)} to encode.", file=sys.stderr)
+
+            with tempfile.TemporaryDirectory() as work_dir:
+                outputs = [Path(work_dir, f"{index}{clip.suffix}") for index in range(len(pending))]
+
+                def encode(options: dict[str, str], output: Path) -> tuple[float, float | None]:
+                    command = compress_command(str(clip), str(output), EncoderPreset(codec, options), threads)
+                    return run_measured(command)
+
+                with ThreadPoolExecutor(max_workers=jobs) as executor:
+                    measurements = list(executor.map(encode, pending, outputs))
+
+                for start in range(0, len(pending), QUALITY_BATCH_SIZE):
+                    batch = slice(start, start + QUALITY_BATCH_SIZE)
+                    qualities = measure_quality(outputs[batch], clip, every_nth=every_nth)
+                    for options, output, (duration, cpu_time), quality in zip(pending[batch], outputs[batch], measurements[batch], qualities):
+                        result_repository.add(TuneResult(
+                            clip_hash=clip_hash,
+                            codec=codec,
+                            options=format_options(options),
+                            **conditions,
+                            original_bytes=original_bytes,
+                            compressed_bytes=output.stat().st_size,
+                            duration=duration,
+                            cpu_time=cpu_time,
+                            ssim_mean=quality.ssim.mean,
+                            ssim_min=quality.ssim.min,
+                            psnr_mean=quality.psnr.mean,
+                            measured_at=datetime.now(tz=timezone.utc),
+                        ))
+                    db.commit()
+
+            for options in grid:
+                key = format_options(options)
+                results[key].append(result_repository.find(clip_hash, codec, key, **conditions))
+
+        rows = []
+        for key, clip_results in results.items():
+            cpu_times = [result.cpu_time for result in clip_results]
+            rows.append({
+                "options": key,
+                "original_bytes": sum(result.original_bytes for result in clip_results),
+                "compressed_bytes": sum(result.compressed_bytes for result in clip_results),
+                "ssim_mean": sum(result.ssim_mean for result in clip_results) / len(clip_results),
+                "ssim_min": min(result.ssim_min for result in clip_results),
+                "psnr_mean": sum(result.psnr_mean for result in clip_results) / len(clip_results),
+                "duration": sum(result.duration for result in clip_results),
+                "cpu_time": sum(cpu_times) if None not in cpu_times else None,
+            })
+
+        print("\t".join(["pareto", "codec", "options", "compressed_bytes", "ratio", "ssim_mean", "ssim_min", "psnr_mean", "duration", "cpu_time"]))
+        for row in sorted(rows, key=lambda row: row["compressed_bytes"]):
+            values = [
+                "" if is_dominated(row, rows) else "*",
+                codec,
+                row["options"],
+                row["compressed_bytes"],
+                f"{row['compressed_bytes'] / row['original_bytes']:.4f}",
+                f"{row['ssim_mean']:.6f}",
+                f"{row['ssim_min']:.6f}",
+                f"{row['psnr_mean']:.3f}",
+                f"{row['duration']:.3f}",
+                "" if row["cpu_time"] is None else f"{row['cpu_time']:.3f}",
+            ]
+            print("\t".join(map(str, values)))
+
+if __name__ == "__main__":
+    main()
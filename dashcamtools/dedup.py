@@ -0,0 +1,27 @@
+import hashlib
+from pathlib import Path
+
+from dashcamtools.util import file_hash
+
+# DB に記録したハッシュと比べるため、インストールされているパッケージによらず同じアルゴリズムを使う。
+# 読む量が少なく、時間のほとんどはファイルの読み込みにかかるため、標準ライブラリの blake2b で足りる。
+def new_hash():
+    return hashlib.blake2b(digest_size=16)
+
+# 先頭、末尾と、その間から等間隔に読むブロックの大きさと数。SMB 越しでも、ファイル全体を読むより十分に少ない。
+BLOCK_SIZE = 64 * 1024
+MIDDLE_BLOCKS = 8
+
+def partial_hash(path: Path, size: int) -> str:
+    # サイズと、先頭、末尾、途中のいくつかのブロックだけから求めるハッシュ。一致した場合は full_hash で確かめる。
+    digest = new_hash()
+    digest.update(size.to_bytes(8, "little"))
+    offsets = [0, *(size * index // (MIDDLE_BLOCKS + 1) for index in range(1, MIDDLE_BLOCKS + 1)), max(0, size - BLOCK_SIZE)]
+    with path.open("rb") as file:
+        for offset in offsets:
+            file.seek(offset)
+            digest.update(file.read(BLOCK_SIZE))
+    return digest.hexdigest()
+
+def full_hash(path: Path) -> str:
+    return file_hash(path)
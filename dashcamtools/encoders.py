@@ -0,0 +1,114 @@
+from contextlib import contextmanager
+import os
+import threading
+from typing import Iterator
+
+LIBX264 = "libx264"
+H264_NVENC = "h264_nvenc"
+
+# 画質を指定するオプション。値が大きいほど画質が下がり、ファイルが小さくなる。
+QUALITY_OPTIONS = { LIBX264: "crf", H264_NVENC: "cq" }
+
+class EncoderPreset:
+    def __init__(self, codec: str, options: dict[str, str]) -> None:
+        self.codec = codec
+        # ffmpeg の出力オプション。キーは先頭の "-" を除いたもの。
+        self.options = options
+
+    def arguments(self, threads: int | None = None) -> list[str]:
+        arguments = ["-c:v", self.codec]
+        for key, value in self.options.items():
+            arguments.extend([f"-{key}", value])
+        if threads is not None:
+            arguments.extend(["-threads", str(threads)])
+        return arguments
+
+    def format_options(self) -> str:
+        return format_options(self.options)
+
+    @property
+    def quality(self) -> int | None:
+        value = self.options.get(QUALITY_OPTIONS[self.codec])
+        return int(value) if value is not None else None
+
+    def with_quality(self, quality: int) -> "EncoderPreset":
+        return EncoderPreset(self.codec, { **self.options, QUALITY_OPTIONS[self.codec]: str(quality) })
+
+def format_options(options: dict[str, str]) -> str:
+    return ",".join(f"{key}={value}" for key, value in options.items())
+
+def parse_options(value: str) -> dict[str, str]:
+    if not value:
+        return {}
+    return dict(option.split("=", 1) for option in value.split(","))
+
+# 組み込みのプリセット。名前はコーデック名と同じ。
+PRESETS: dict[str, EncoderPreset] = {
+    LIBX264: EncoderPreset(LIBX264, { "crf": "28" }),
+    H264_NVENC: EncoderPreset(H264_NVENC, { "cq": "30", "preset": "p7", "profile": "high" }),
+}
+
+# 空き容量が少ないときに使う、圧縮率よりも速度を優先したプリセット。
+FAST_PRESETS: dict[str, EncoderPreset] = {
+    LIBX264: EncoderPreset(LIBX264, { "crf": "28", "preset": "veryfast" }),
+    H264_NVENC: EncoderPreset(H264_NVENC, { "cq": "30", "preset": "p1" }),
+}
+
+def compress_command(input_path: str, output_path: str, preset: EncoderPreset, threads: int | None = None) -> list[str]:
+    return [
+        "ffmpeg",
+        "-y", # overwrite
+        "-loglevel", "error",
+        "-i", input_path,
+        "-map", "0",
+        *preset.arguments(threads),
+        "-c:a", "copy",
+        output_path,
+    ]
+
+def remux_command(input_path: str, output_path: str) -> list[str]:
+    return [
+        "ffmpeg",
+        "-y", # overwrite
+        "-loglevel", "error",
+        "-i", input_path,
+        "-map", "0",
+        "-c", "copy",
+        "-movflags", "+faststart",
+        output_path,
+    ]
+
+class EncoderPool:
+    # コーデックごとに、同時に実行できるエンコードの数を制限する。
+    def __init__(self, limits: dict[str, int]) -> None:
+        self.limits = { codec: limit for codec, limit in limits.items() if limit > 0 }
+        self.available = dict(self.limits)
+        self.condition = threading.Condition()
+
+    @property
+    def concurrency(self) -> int:
+        return sum(self.limits.values())
+
+    @contextmanager
+    def acquire(self, preferences: list[str]) -> Iterator[str]:
+        # preferences の先頭から順に、空きのあるコーデックを割り当てる。
+        with self.condition:
+            while True:
+                codec = next((codec for codec in preferences if self.available.get(codec, 0) > 0), None)
+                if codec is not None:
+                    break
+                self.condition.wait()
+            self.available[codec] -= 1
+
+        try:
+            yield codec
+        finally:
+            with self.condition:
+                self.available[codec] += 1
+                self.condition.notify_all()
+
+    def threads(self, codec: str) -> int | None:
+        # libx264 のプロセスを複数同時に動かす場合は、コア数を超えないようにスレッド数を分け合う。
+        if codec != LIBX264 or self.limits.get(codec, 0) <= 1:
+            return None
+        return max(1, (os.cpu_count() or 1) // self.limits[codec])
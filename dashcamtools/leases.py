@@ -0,0 +1,89 @@
+import math
+import sys
+import threading
+from typing import Callable, ContextManager
+import zlib
+
+from sqlalchemy.orm import Session
+
+from dashcamtools.encoders import H264_NVENC, LIBX264
+from dashcamtools.repositories import MachineLeaseRepository, WorkLeaseRepository
+
+# 有効期間のうち、この割合が過ぎるたびにリースを延長する。
+HEARTBEAT_FACTOR = 1 / 3
+# 過去のエンコードの実績がない場合の、libx264 の 1 セッションに対するおおよその速さの比。
+DEFAULT_SPEED_RATIOS = { LIBX264: 1.0, H264_NVENC: 4.0 }
+
+# Snowflake の machine_id（10 ビット）の数。
+MACHINE_ID_COUNT = 1024
+
+def machine_id_of(worker_id: str) -> int:
+    # 同じワーカーが起動し直したときに同じ値を使えるよう、ワーカーの ID から求める。ほかのワーカーと重なることがあるため、DB のリースで確かめてから使う。
+    return zlib.crc32(worker_id.encode("utf-8")) & (MACHINE_ID_COUNT - 1)
+
+def machine_id_candidates(worker_id: str) -> list[int]:
+    # ワーカーの ID から求めた値を優先し、ほかのワーカーが使っていれば、その次の値から順に試す。
+    preferred = machine_id_of(worker_id)
+    return [(preferred + offset) % MACHINE_ID_COUNT for offset in range(MACHINE_ID_COUNT)]
+
+def claim_size(slots: dict[str, int], speeds: dict[str, float], per_slot: float) -> int:
+    # libx264 の 1 セッションを 1 とした処理能力に比例させ、速いワーカーほど多くのファイルを一度に取得する。
+    baseline = speeds.get(LIBX264)
+    capacity = 0.0
+    for codec, count in slots.items():
+        if baseline and speeds.get(codec):
+            capacity += count * speeds[codec] / baseline
+        else:
+            capacity += count * DEFAULT_SPEED_RATIOS.get(codec, 1.0)
+    return max(1, math.ceil(capacity * per_slot))
+
+class LeaseHeartbeat:
+    # 処理中と処理待ちのファイルのリースを、別のセッションで定期的に延長する。
+    # 期限は各ワーカーの時計で決めるため、有効期間はワーカー間の時計のずれより十分に長くする。
+    def __init__(self, session_factory: Callable[[], ContextManager[Session]], owner: str, seconds: float) -> None:
+        self.session_factory = session_factory
+        self.owner = owner
+        self.seconds = seconds
+        self.closed = threading.Event()
+        self.thread: threading.Thread | None = None
+
+    def __enter__(self) -> "LeaseHeartbeat":
+        self.thread = threading.Thread(target=self._run, name="lease-heartbeat", daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.closed.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self) -> None:
+        while not self.closed.wait(self.seconds * HEARTBEAT_FACTOR):
+            try:
+                with self.session_factory() as db:
+                    self.extend(db)
+                    db.commit()
+            except Exception as e:
+                print(e, file=sys.stderr)
+
+    def extend(self, db: Session) -> None:
+        WorkLeaseRepository(db).extend(self.owner, self.seconds)
+
+class MachineLeaseHeartbeat(LeaseHeartbeat):
+    # 起動時に取得した machine_id のリースを、終了するまで延長し、終了するときに手放す。
+    def __exit__(self, *_) -> None:
+        super().__exit__()
+        with self.session_factory() as db:
+            MachineLeaseRepository(db).release(self.owner)
+            db.commit()
+
+    def extend(self, db: Session) -> None:
+        MachineLeaseRepository(db).extend(self.owner, self.seconds)
+
+class LeaseLostError(Exception):
+    def __init__(self, name: str, owner: str) -> None:
+        self.name = name
+        self.owner = owner
+
+    def __str__(self) -> str:
+        return f"The lease of {self.name} held by worker {self.owner} has expired and may have been claimed by another worker."
@@ -0,0 +1,249 @@
+from typing import Callable, Iterable
+
+from sqlalchemy import BigInteger, Boolean, Column, Connection, DateTime, Double, Engine, Index, Integer, MetaData, String, Table, Text, inspect, insert, select, text, update
+
+# 適用済みの版を記録するテーブル。ORM のモデルとは別に管理する。
+metadata = MetaData()
+schema_version = Table("schema_version", metadata, Column("version", Integer, nullable=False))
+
+def add_columns(connection: Connection, table_name: str, columns: Iterable[Column]) -> None:
+    # 途中まで適用して失敗した DB にも適用できるよう、まだない列だけを追加する。
+    existing = { column["name"] for column in inspect(connection).get_columns(table_name) }
+    for column in columns:
+        if column.name not in existing:
+            column_type = column.type.compile(dialect=connection.dialect)
+            connection.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column.name} {column_type}"))
+
+def add_missing_columns(connection: Connection, tables: Iterable[Table]) -> None:
+    # create_all は既存のテーブルに列を追加しないため、後から追加した列をここで補う。
+    for table in tables:
+        add_columns(connection, table.name, table.columns)
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+# 版を記録する前のスキーマ。ORM のモデルを後から変更しても移行の結果が変わらないよう、当時の定義を写しておく。
+# UTCTimestamp は Text に、StrEnum は String に保存される。
+schema_1 = MetaData()
+
+Table(
+    "video_files", schema_1,
+    Column("name", String(255), primary_key=True),
+    Column("direction", String, nullable=True),
+    Column("is_event", Boolean, nullable=True),
+    Column("recorded_at", DateTime, nullable=True),
+    Column("mtime", Text, nullable=False, index=True),
+    Column("is_archived", Boolean, nullable=False),
+    Column("unix_minute", BigInteger, nullable=True),
+    Index("ix_video_files_timeline", "direction", "unix_minute"),
+)
+
+Table(
+    "reports", schema_1,
+    Column("started_at", Text, primary_key=True),
+    Column("name", String(255), nullable=False),
+    Column("status", String, nullable=False),
+    Column("mtime", Text, nullable=True),
+    Column("original_bytes", Integer, nullable=True),
+    Column("compressed_bytes", Integer, nullable=True),
+    Column("codec", String(255), nullable=True),
+    Column("quality", Integer, nullable=True),
+    Column("duration_download", Double, nullable=True),
+    Column("duration_compress", Double, nullable=True),
+    Column("duration_upload", Double, nullable=True),
+    Column("duration_wait", Double, nullable=True),
+    Column("duration", Double, nullable=True),
+    Column("io_mode", String(255), nullable=True),
+    Column("encode_fps", Double, nullable=True),
+    Column("encode_speed", Double, nullable=True),
+    Column("cpu_time", Double, nullable=True),
+    Column("max_rss", BigInteger, nullable=True),
+    Column("mbps_download", Double, nullable=True),
+    Column("mbps_compress", Double, nullable=True),
+    Column("mbps_upload", Double, nullable=True),
+)
+
+Table(
+    "scanned_directories", schema_1,
+    Column("path", String(1024), primary_key=True),
+    Column("mtime", Double, nullable=False),
+)
+
+Table(
+    "scanned_files", schema_1,
+    Column("directory", String(1024), primary_key=True),
+    Column("name", String(255), primary_key=True),
+    Column("size", BigInteger, nullable=False),
+    Column("mtime", Double, nullable=False),
+)
+
+Table(
+    "probe_results", schema_1,
+    Column("name", String(255), primary_key=True),
+    Column("size", BigInteger, primary_key=True),
+    Column("mtime", Double, primary_key=True),
+    Column("codec", String(255), nullable=True),
+    Column("bit_rate", BigInteger, nullable=True),
+    Column("width", Integer, nullable=True),
+    Column("height", Integer, nullable=True),
+    Column("duration", Double, nullable=True),
+    Column("probed_at", Text, nullable=False),
+)
+
+Table(
+    "encoder_presets", schema_1,
+    Column("name", String(255), primary_key=True),
+    Column("codec", String(255), nullable=False),
+    Column("options", Text, nullable=False),
+)
+
+Table(
+    "tune_results", schema_1,
+    Column("clip_hash", String(64), primary_key=True),
+    Column("codec", String(255), primary_key=True),
+    Column("options", String(255), primary_key=True),
+    Column("original_bytes", BigInteger, nullable=False),
+    Column("compressed_bytes", BigInteger, nullable=False),
+    Column("duration", Double, nullable=False),
+    Column("cpu_time", Double, nullable=True),
+    Column("ssim_mean", Double, nullable=False),
+    Column("ssim_min", Double, nullable=False),
+    Column("psnr_mean", Double, nullable=False),
+    Column("measured_at", Text, nullable=False),
+)
+
+Table(
+    "compress_jobs", schema_1,
+    Column("name", String(255), primary_key=True),
+    Column("state", String, nullable=False),
+    Column("size", BigInteger, nullable=False),
+    Column("mtime", Double, nullable=False),
+    Column("io_mode", String(255), nullable=False),
+    Column("copy_path", Text, nullable=True),
+    Column("output_path", Text, nullable=True),
+    Column("codec", String(255), nullable=True),
+    Column("quality", Integer, nullable=True),
+    Column("duration_download", Double, nullable=True),
+    Column("duration_compress", Double, nullable=True),
+    Column("updated_at", Text, nullable=False),
+)
+
+Table(
+    "content_hashes", schema_1,
+    Column("directory", String(1024), primary_key=True),
+    Column("name", String(255), primary_key=True),
+    Column("size", BigInteger, nullable=False),
+    Column("mtime", Double, nullable=False),
+    Column("partial_hash", String(64), nullable=False),
+    Column("full_hash", String(64), nullable=True),
+    Column("archived_name", String(255), nullable=True),
+    Index("ix_content_hashes_partial", "size", "partial_hash"),
+)
+
+Table(
+    "logs", schema_1,
+    Column("id", Integer, primary_key=True),
+    Column("severity", String, nullable=False),
+    Column("text", Text, nullable=True),
+    Column("timestamp", Text, nullable=False),
+)
+
+def migrate_1(connection: Connection) -> None:
+    # 版を記録する前は、起動のたびに create_all と add_missing_columns でスキーマを揃えていた。その結果と同じにする。
+    schema_1.create_all(connection)
+    add_missing_columns(connection, schema_1.sorted_tables)
+
+def migrate_2(connection: Connection) -> None:
+    Table(
+        "work_leases", MetaData(),
+        Column("name", String(255), primary_key=True),
+        Column("owner", String(255), nullable=True),
+        Column("claimed_at", Text, nullable=True),
+        Column("heartbeat_at", Text, nullable=True),
+        Column("expires_at", Text, nullable=False),
+        Index("ix_work_leases_owner", "owner"),
+    ).create(connection, checkfirst=True)
+
+def migrate_3(connection: Connection) -> None:
+    add_columns(connection, "video_files", [
+        Column("sprite_path", Text, nullable=True),
+        Column("proxy_path", Text, nullable=True),
+        Column("keyframes_path", Text, nullable=True),
+    ])
+
+def migrate_4(connection: Connection) -> None:
+    # 主キーに測定の条件を加える。既存の結果は条件が分からないため、測定し直させる。
+    if inspect(connection).has_table("tune_results"):
+        connection.execute(text("DROP TABLE tune_results"))
+    Table(
+        "tune_results", MetaData(),
+        Column("clip_hash", String(64), primary_key=True),
+        Column("codec", String(255), primary_key=True),
+        Column("options", String(255), primary_key=True),
+        Column("jobs", Integer, primary_key=True),
+        Column("threads", Integer, primary_key=True),
+        Column("every_nth", Integer, primary_key=True),
+        Column("original_bytes", BigInteger, nullable=False),
+        Column("compressed_bytes", BigInteger, nullable=False),
+        Column("duration", Double, nullable=False),
+        Column("cpu_time", Double, nullable=True),
+        Column("ssim_mean", Double, nullable=False),
+        Column("ssim_min", Double, nullable=False),
+        Column("psnr_mean", Double, nullable=False),
+        Column("measured_at", Text, nullable=False),
+    ).create(connection)
+
+def migrate_5(connection: Connection) -> None:
+    Table(
+        "machine_leases", MetaData(),
+        Column("machine_id", Integer, primary_key=True, autoincrement=False),
+        Column("owner", String(255), nullable=True),
+        Column("heartbeat_at", Text, nullable=True),
+        Column("expires_at", Text, nullable=False),
+        Index("ix_machine_leases_owner", "owner"),
+    ).create(connection, checkfirst=True)
+
+# 版 n + 1 にするための変更が n 番目。どの版の DB に適用しても壊れないよう、テーブルや列の有無を確かめてから変更する。
+# 各移行は、その版で追加したテーブルや列だけを、ORM のモデルに頼らずに定義する。
+MIGRATIONS: list[Callable[[Connection], None]] = [
+    migrate_1,
+    migrate_2,
+    migrate_3,
+    migrate_4,
+    migrate_5,
+]
+
+# PostgreSQL の勧告ロックのキー。移行を適用する接続を 1 つに限る。
+MIGRATION_LOCK_KEY = 0x6461736863616D
+
+def current_version(connection: Connection) -> int:
+    if not inspect(connection).has_table(schema_version.name):
+        return 0
+    return connection.scalar(select(schema_version.c.version)) or 0
+
+def lock(connection: Connection) -> None:
+    # 複数のワーカーが同時に起動しても、移行を一度だけ適用するよう、ほかの接続を待たせる。
+    if connection.dialect.name == "sqlite":
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+    elif connection.dialect.name == "postgresql":
+        connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), { "key": MIGRATION_LOCK_KEY })
+
+def migrate(engine: Engine) -> int:
+    with engine.connect() as connection:
+        # 最新の版であれば、版を読み出すだけで終わる。
+        if current_version(connection) >= len(MIGRATIONS):
+            return len(MIGRATIONS)
+        connection.rollback()
+
+        lock(connection)
+        schema_version.create(connection, checkfirst=True)
+        version = connection.scalar(select(schema_version.c.version))
+        if version is None:
+            connection.execute(insert(schema_version).values(version=0))
+            version = 0
+
+        for migration in MIGRATIONS[version:]:
+            migration(connection)
+        if version < len(MIGRATIONS):
+            connection.execute(update(schema_version).values(version=len(MIGRATIONS)))
+        connection.commit()
+        return len(MIGRATIONS)
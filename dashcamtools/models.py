@@ -1,7 +1,36 @@
+from datetime import datetime, timedelta
 from pathlib import Path
+import re
+
+PATTERN_VIDEO_NAME = re.compile(r"^\d{8}_(\d{10})_(N|G|S)(F|R).MP4$", flags=re.I)
+FORMAT_TIMESTAMP = "%y%m%d%H%M"
+
+EPOCH = datetime(1970, 1, 1)
+
+def to_unix_minute(recorded_at: datetime) -> int:
+    # 録画時刻はカメラのローカル時刻のため、実行環境のタイムゾーンによらない値になるよう UTC とみなして変換する。
+    return (recorded_at - EPOCH) // timedelta(minutes=1)
+
+def from_unix_minute(unix_minute: int) -> datetime:
+    return EPOCH + timedelta(minutes=unix_minute)
+
+def parse_video_name(name: str) -> tuple[datetime, bool, bool] | None:
+    # (録画時刻, イベント録画か, 前方カメラか) を返す。
+    # 形式を正規表現で確かめたあとは、strptime を使わずに固定の位置から数値を切り出す。
+    matched = PATTERN_VIDEO_NAME.match(name)
+    if matched is None:
+        return None
+
+    timestamp = matched[1]
+    try:
+        recorded_at = datetime(2000 + int(timestamp[0:2]), int(timestamp[2:4]), int(timestamp[4:6]), int(timestamp[6:8]), int(timestamp[8:10]))
+    except ValueError:
+        # 形式は合っていても、0 日や 25 時のようにありえない時刻であれば、形式が違う場合と同じく扱う。
+        return None
+    return recorded_at, matched[2].upper() != "N", matched[3].upper() == "F"
 
 class VideoPart:
-    def __init__(self, path: Path, timestamp: int, is_front: str, is_event: bool) -> None:
+    def __init__(self, path: Path, timestamp: int, is_front: bool, is_event: bool) -> None:
         self.path = path
         # タイムスタンプ。分単位の整数（エポック秒を 60 でわったもの）。
         self.timestamp = timestamp
@@ -15,4 +44,14 @@ class VideoPart:
         return self.timestamp < another.timestamp
     
     def is_next_to(self, another: "VideoPart"):
-        return self.is_front == another.is_front and (another.timestamp != (self.timestamp - 1))
+        # another の直後の 1 分間を、同じカメラで録画したものであれば True。
+        return self.is_front == another.is_front and (another.timestamp == (self.timestamp - 1))
+
+    @staticmethod
+    def from_path(path: Path) -> "VideoPart | None":
+        parsed = parse_video_name(path.name)
+        if parsed is None:
+            return None
+
+        recorded_at, is_event, is_front = parsed
+        return VideoPart(path, to_unix_minute(recorded_at), is_front=is_front, is_event=is_event)
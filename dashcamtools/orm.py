@@ -1,27 +1,53 @@
 from contextlib import contextmanager
 from datetime import datetime, UTC
 import enum
-import re
+import threading
 from typing import Optional, Iterator, Type
 
-from sqlalchemy import Dialect, String, Boolean, Text, ForeignKey, Date, Integer, BigInteger, Double, UniqueConstraint, TypeDecorator, create_engine
+from sqlalchemy import Dialect, Engine, String, Boolean, Text, ForeignKey, Date, Index, Integer, BigInteger, Double, UniqueConstraint, TypeDecorator, create_engine, event
 from sqlalchemy.orm import Mapped, mapped_column, relationship, sessionmaker, Session, declarative_base, sessionmaker, DeclarativeBase
 from sqlalchemy.types import DateTime, String
 
-from dashcamtools.settings import DATABASE_URL
+from dashcamtools.models import parse_video_name, to_unix_minute
+from dashcamtools.settings import database_url
 
-PATTERN_VIDEO_NAME = re.compile(r"^\d{8}_(\d{10})_(N|G|S)(F|R).MP4$", flags=re.I)
-FORMAT_TIMESTAMP = "%y%m%d%H%M"
 
+# エンジンとセッションは、最初に DB を使うときに作る。DB を使わないコマンドや --help では接続もスキーマの確認もしない。
+_engine: Engine | None = None
+_session_factory: sessionmaker[Session] | None = None
+_engine_lock = threading.Lock()
 
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def set_sqlite_pragmas(dbapi_connection, _) -> None:
+    # WAL では書き込みのたびに fsync しないため、ログやレポートを頻繁に書き込んでも遅くならない。
+    # なお、WAL はネットワーク上のファイルシステムでは使えないため、DB はローカルに置くこと。
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=30000")
+    cursor.close()
+
+def get_engine() -> Engine:
+    global _engine, _session_factory
+
+    with _engine_lock:
+        if _engine is None:
+            from dashcamtools.migrations import migrate
+
+            engine = create_engine(database_url())
+            if engine.dialect.name == "sqlite":
+                event.listen(engine, "connect", set_sqlite_pragmas)
+            migrate(engine)
+
+            _session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+            _engine = engine
+        return _engine
 
 Base: Type[DeclarativeBase] = declarative_base()
 
 @contextmanager
 def get_db() -> Iterator[Session]:
-    db = SessionLocal()
+    get_engine()
+    db = _session_factory()
     try:
         yield db
     finally:
@@ -29,6 +55,7 @@ def get_db() -> Iterator[Session]:
 
 class UTCTimestamp(TypeDecorator):
     impl = Text
+    cache_ok = True
 
     def process_bind_param(self, value: datetime | None, dialect):
         if value is not None:
@@ -45,6 +72,7 @@ class UTCTimestamp(TypeDecorator):
 # see: https://qiita.com/methane/items/dd19bc7be27a5e991cca
 class StrEnum(TypeDecorator):
     impl = String
+    cache_ok = True
 
     def __init__(self, enum: Type[enum.Enum], *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -76,6 +104,14 @@ class VideoDirection(enum.Enum):
     FRONT = "front"
     REAR = "rear"
 
+# compress のファイルごとの進行状況。この順に進む。
+class JobState(enum.Enum):
+    QUEUED = "queued"
+    COPIED = "copied"
+    ENCODED = "encoded"
+    UPLOADED = "uploaded"
+    TRASHED = "trashed"
+
 class VideoFile(Base):
     __tablename__ = "video_files"
 
@@ -85,21 +121,29 @@ class VideoFile(Base):
     recorded_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
     mtime: Mapped[datetime] = mapped_column(UTCTimestamp, nullable=False, index=True)
     is_archived: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)
+    # recorded_at を分単位の整数にしたもの。タイムラインの範囲検索に使う。
+    unix_minute: Mapped[int] = mapped_column(BigInteger, nullable=True)
+    # compress --preview-dir で書き出したスプライト、低解像度の動画、キーフレームの一覧のパス。
+    sprite_path: Mapped[str] = mapped_column(Text, nullable=True)
+    proxy_path: Mapped[str] = mapped_column(Text, nullable=True)
+    keyframes_path: Mapped[str] = mapped_column(Text, nullable=True)
+
+    __table_args__ = (
+        Index("ix_video_files_timeline", "direction", "unix_minute"),
+    )
 
     def fill_attributes(self) -> "VideoFile":
-        matched = PATTERN_VIDEO_NAME.search(self.name)
-        timestamp = datetime.strptime(matched[1], FORMAT_TIMESTAMP)
-        timestamp.replace(year=2000 + timestamp.year)
+        parsed = parse_video_name(self.name)
+        if parsed is None:
+            raise ValueError(f"Unexpected video name: {self.name}")
 
-        self.recorded_at = timestamp
-        self.is_event = VideoFile.prase_event_type(matched[2])
-        self.direction = VideoFile.parse_direction(matched[3])
+        recorded_at, is_event, is_front = parsed
+        self.recorded_at = recorded_at
+        self.is_event = is_event
+        self.direction = VideoDirection.FRONT if is_front else VideoDirection.REAR
+        self.unix_minute = to_unix_minute(recorded_at)
         return self
 
-    @property
-    def unix_minute(self) -> int:
-        return int(self.recorded_at.timestamp()) // 60
-
     @staticmethod
     def from_name(name: str, mtime: datetime) -> "VideoFile":
         return VideoFile(name=name, mtime=mtime).fill_attributes()
@@ -136,10 +180,148 @@ class Report(Base):
     original_bytes: Mapped[int] = mapped_column(Integer, nullable=True)
     compressed_bytes: Mapped[int] = mapped_column(Integer, nullable=True)
     codec: Mapped[str] = mapped_column(String(255), nullable=True)
+    # エンコードに使用した CRF（libx264）または CQ（h264_nvenc）。
+    quality: Mapped[int] = mapped_column(Integer, nullable=True)
     duration_download: Mapped[float] = mapped_column(Double, nullable=True)
     duration_compress: Mapped[float] = mapped_column(Double, nullable=True)
     duration_upload: Mapped[float] = mapped_column(Double, nullable=True)
+    # ステージ間のキューで待機した時間の合計。
+    duration_wait: Mapped[float] = mapped_column(Double, nullable=True)
+    duration: Mapped[float] = mapped_column(Double, nullable=True)
+    # compress の --io-mode（copy または direct）。
+    io_mode: Mapped[str] = mapped_column(String(255), nullable=True)
+    # ffmpeg の -progress から求めた、エンコードの平均フレームレートと実時間に対する速度。
+    encode_fps: Mapped[float] = mapped_column(Double, nullable=True)
+    encode_speed: Mapped[float] = mapped_column(Double, nullable=True)
+    # ffmpeg が消費した CPU 時間（秒）と最大常駐メモリ（KB）。
+    cpu_time: Mapped[float] = mapped_column(Double, nullable=True)
+    max_rss: Mapped[int] = mapped_column(BigInteger, nullable=True)
+    # ステージごとのスループット（MB/s）。ダウンロードと圧縮は元のファイル、アップロードは圧縮したファイルのサイズによる。
+    mbps_download: Mapped[float] = mapped_column(Double, nullable=True)
+    mbps_compress: Mapped[float] = mapped_column(Double, nullable=True)
+    mbps_upload: Mapped[float] = mapped_column(Double, nullable=True)
+
+class ScannedDirectory(Base):
+    __tablename__ = "scanned_directories"
+
+    path: Mapped[str] = mapped_column(String(1024), primary_key=True)
+    # 前回の走査時のディレクトリの更新時刻。変わっていなければ、ファイルの一覧も変わっていない。
+    mtime: Mapped[float] = mapped_column(Double, nullable=False)
+
+class ScannedFile(Base):
+    __tablename__ = "scanned_files"
+
+    directory: Mapped[str] = mapped_column(String(1024), primary_key=True)
+    name: Mapped[str] = mapped_column(String(255), primary_key=True)
+    size: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    mtime: Mapped[float] = mapped_column(Double, nullable=False)
+
+class ProbeResult(Base):
+    __tablename__ = "probe_results"
+
+    # 同じ名前でも、サイズか更新時刻が変われば別のファイルとして扱う。
+    name: Mapped[str] = mapped_column(String(255), primary_key=True)
+    size: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    mtime: Mapped[float] = mapped_column(Double, primary_key=True)
+    codec: Mapped[str] = mapped_column(String(255), nullable=True)
+    bit_rate: Mapped[int] = mapped_column(BigInteger, nullable=True)
+    width: Mapped[int] = mapped_column(Integer, nullable=True)
+    height: Mapped[int] = mapped_column(Integer, nullable=True)
     duration: Mapped[float] = mapped_column(Double, nullable=True)
+    probed_at: Mapped[datetime] = mapped_column(UTCTimestamp, nullable=False)
+
+class EncoderPresetRecord(Base):
+    __tablename__ = "encoder_presets"
+
+    name: Mapped[str] = mapped_column(String(255), primary_key=True)
+    codec: Mapped[str] = mapped_column(String(255), nullable=False)
+    # "crf=26,preset=slow" のような、カンマ区切りの ffmpeg のオプション。
+    options: Mapped[str] = mapped_column(Text, nullable=False)
+
+class TuneResult(Base):
+    __tablename__ = "tune_results"
+
+    clip_hash: Mapped[str] = mapped_column(String(64), primary_key=True)
+    codec: Mapped[str] = mapped_column(String(255), primary_key=True)
+    options: Mapped[str] = mapped_column(String(255), primary_key=True)
+    # 測定の条件。同時に動かしたエンコードの数と、各エンコードの -threads（0 は ffmpeg の既定）で速度が、
+    # 画質を比較したフレームの間隔で SSIM と PSNR が変わるため、条件が異なる結果は使い回さない。
+    jobs: Mapped[int] = mapped_column(Integer, primary_key=True)
+    threads: Mapped[int] = mapped_column(Integer, primary_key=True)
+    every_nth: Mapped[int] = mapped_column(Integer, primary_key=True)
+    original_bytes: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    compressed_bytes: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    duration: Mapped[float] = mapped_column(Double, nullable=False)
+    cpu_time: Mapped[float] = mapped_column(Double, nullable=True)
+    ssim_mean: Mapped[float] = mapped_column(Double, nullable=False)
+    ssim_min: Mapped[float] = mapped_column(Double, nullable=False)
+    psnr_mean: Mapped[float] = mapped_column(Double, nullable=False)
+    measured_at: Mapped[datetime] = mapped_column(UTCTimestamp, nullable=False)
+
+class CompressJob(Base):
+    __tablename__ = "compress_jobs"
+
+    name: Mapped[str] = mapped_column(String(255), primary_key=True)
+    state: Mapped[JobState] = mapped_column(StrEnum(JobState), nullable=False)
+    # 再開時に、同じ名前の別のファイルと取り違えないよう、ジョブを始めた時点のサイズと更新時刻を記録する。
+    size: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    mtime: Mapped[float] = mapped_column(Double, nullable=False)
+    io_mode: Mapped[str] = mapped_column(String(255), nullable=False)
+    # 完了した段階の成果物。copy_path は COPIED、output_path は ENCODED の状態で有効。
+    copy_path: Mapped[str] = mapped_column(Text, nullable=True)
+    output_path: Mapped[str] = mapped_column(Text, nullable=True)
+    codec: Mapped[str] = mapped_column(String(255), nullable=True)
+    quality: Mapped[int] = mapped_column(Integer, nullable=True)
+    duration_download: Mapped[float] = mapped_column(Double, nullable=True)
+    duration_compress: Mapped[float] = mapped_column(Double, nullable=True)
+    updated_at: Mapped[datetime] = mapped_column(UTCTimestamp, nullable=False)
+
+# 複数のワーカーで compress を動かす場合の、ファイルごとの処理の担当。期限の切れたリースは、ほかのワーカーが取り直せる。
+class WorkLease(Base):
+    __tablename__ = "work_leases"
+
+    name: Mapped[str] = mapped_column(String(255), primary_key=True)
+    # リースを持っているワーカーの --worker-id。誰も持っていなければ NULL。
+    owner: Mapped[str] = mapped_column(String(255), nullable=True)
+    claimed_at: Mapped[datetime] = mapped_column(UTCTimestamp, nullable=True)
+    heartbeat_at: Mapped[datetime] = mapped_column(UTCTimestamp, nullable=True)
+    expires_at: Mapped[datetime] = mapped_column(UTCTimestamp, nullable=False)
+
+    __table_args__ = (
+        Index("ix_work_leases_owner", "owner"),
+    )
+
+# Snowflake の machine_id ごとの担当。ワーカーは起動時に取得し、終了するまで延長する。期限の切れたリースは、ほかのワーカーが取り直せる。
+class MachineLease(Base):
+    __tablename__ = "machine_leases"
+
+    machine_id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    # リースを持っているワーカーの --worker-id。誰も持っていなければ NULL。
+    owner: Mapped[str] = mapped_column(String(255), nullable=True)
+    heartbeat_at: Mapped[datetime] = mapped_column(UTCTimestamp, nullable=True)
+    expires_at: Mapped[datetime] = mapped_column(UTCTimestamp, nullable=False)
+
+    __table_args__ = (
+        Index("ix_machine_leases_owner", "owner"),
+    )
+
+class ContentHash(Base):
+    __tablename__ = "content_hashes"
+
+    # ファイルの現在の場所。compress が Trash や Archive に移動したファイルを記録する。
+    directory: Mapped[str] = mapped_column(String(1024), primary_key=True)
+    name: Mapped[str] = mapped_column(String(255), primary_key=True)
+    size: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    mtime: Mapped[float] = mapped_column(Double, nullable=False)
+    partial_hash: Mapped[str] = mapped_column(String(64), nullable=False)
+    # 部分的なハッシュが一致したときにだけ求める、ファイル全体のハッシュ。
+    full_hash: Mapped[str] = mapped_column(String(64), nullable=True)
+    # このファイルの内容を圧縮して、または圧縮せずに置いた Archive のファイルの名前。
+    archived_name: Mapped[str] = mapped_column(String(255), nullable=True)
+
+    __table_args__ = (
+        Index("ix_content_hashes_partial", "size", "partial_hash"),
+    )
 
 class Log(Base):
     __tablename__ = "logs"
@@ -148,5 +330,3 @@ class Log(Base):
     severity: Mapped[LogSeverity] = mapped_column(StrEnum(LogSeverity), nullable=False)
     text: Mapped[str] = mapped_column(Text, nullable=True)
     timestamp: Mapped[datetime] = mapped_column(UTCTimestamp)
-
-Base.metadata.create_all(bind=engine)
@@ -0,0 +1,185 @@
+from queue import Empty, Full, Queue
+import sys
+import threading
+import time
+from typing import Callable, Generic, Iterable, TypeVar
+
+T = TypeVar("T")
+
+# 上流のステージがすべての項目を送り終えたことを表す番兵。
+_END = object()
+
+# キューの待機中に停止要求を確認する間隔（秒）。
+POLL_INTERVAL = 0.5
+
+class Stage(Generic[T]):
+    def __init__(self, name: str, process: Callable[[T], bool], workers: int = 1) -> None:
+        self.name = name
+        # 項目を処理する関数。False を返した項目は、後続のステージに渡さずに完了とする。
+        self.process = process
+        # このステージで同時に項目を処理するスレッドの数。
+        self.workers = workers
+
+class Pipeline(Generic[T]):
+    def __init__(
+        self,
+        stages: list[Stage[T]],
+        depth: int,
+        on_error: Callable[[T, Exception], None],
+        on_finish: Callable[[T], None],
+        on_wait: Callable[[T, float], None],
+    ) -> None:
+        self.stages = stages
+        # ステージ間のキューの長さ。0 の場合は、各項目をすべてのステージに順番に通す。
+        self.depth = depth
+        self.on_error = on_error
+        self.on_finish = on_finish
+        self.on_wait = on_wait
+        self.stopping = threading.Event()
+        # 項目の列挙で発生した例外。スレッドを止めた後で、run の呼び出し元に送出する。
+        self.feed_error: Exception | None = None
+
+    def run(self, items: Iterable[T]) -> None:
+        if self.depth <= 0 and all(stage.workers == 1 for stage in self.stages):
+            self._run_inline(items)
+        else:
+            self._run_threaded(items)
+            if self.feed_error is not None:
+                raise self.feed_error
+
+    def _process(self, stage: Stage[T], item: T) -> bool:
+        try:
+            return stage.process(item)
+        except Exception as e:
+            # on_error が失敗しても、スレッドを止めずに項目を完了として扱い、on_finish で片付けさせる。
+            try:
+                self.on_error(item, e)
+            except Exception as error:
+                print(f"{stage.name}: failed to handle an error. ({error})", file=sys.stderr)
+            return False
+
+    def _finish(self, item: T) -> None:
+        # on_finish が失敗しても、スレッドを止めずに、終端の受け渡しやほかの項目の片付けを続ける。
+        try:
+            self.on_finish(item)
+        except Exception as e:
+            print(f"Failed to finish an item. ({e})", file=sys.stderr)
+
+    def _run_inline(self, items: Iterable[T]) -> None:
+        for item in items:
+            try:
+                for stage in self.stages:
+                    if not self._process(stage, item):
+                        break
+            finally:
+                self._finish(item)
+
+    def _run_threaded(self, items: Iterable[T]) -> None:
+        queues: list[Queue] = [Queue(maxsize=max(self.depth, 1)) for _ in self.stages]
+
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0]), name="feed", daemon=True)]
+        for index, stage in enumerate(self.stages):
+            outbound = queues[index + 1] if index + 1 < len(queues) else None
+            remaining = _Countdown(stage.workers)
+            for worker in range(stage.workers):
+                threads.append(threading.Thread(target=self._work, args=(stage, queues[index], outbound, remaining), name=f"{stage.name}-{worker}", daemon=True))
+
+        for thread in threads:
+            thread.start()
+
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(POLL_INTERVAL)
+        except KeyboardInterrupt:
+            # 各スレッドは処理中の項目を終えてから停止する。
+            self.stopping.set()
+            for thread in threads:
+                thread.join()
+            raise
+        finally:
+            # 停止要求によりキューに残った項目を片付ける。
+            for queue in queues:
+                self._drain(queue)
+
+    def _put(self, queue: Queue, item: T) -> bool:
+        entry = (item, time.perf_counter())
+        while not self.stopping.is_set():
+            try:
+                queue.put(entry, timeout=POLL_INTERVAL)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _get(self, queue: Queue):
+        while not self.stopping.is_set():
+            try:
+                entry = queue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                continue
+
+            if entry is _END:
+                return _END
+            item, enqueued_at = entry
+            self.on_wait(item, time.perf_counter() - enqueued_at)
+            return item
+        return _END
+
+    def _end(self, queue: Queue) -> None:
+        while not self.stopping.is_set():
+            try:
+                queue.put(_END, timeout=POLL_INTERVAL)
+                return
+            except Full:
+                pass
+
+    def _feed(self, items: Iterable[T], outbound: Queue) -> None:
+        try:
+            for item in items:
+                if self.stopping.is_set() or not self._put(outbound, item):
+                    self._finish(item)
+                    return
+        except Exception as e:
+            # 列挙に失敗したら、投入済みの項目も含めて止める。例外は run から送出する。
+            self.feed_error = e
+            self.stopping.set()
+        finally:
+            self._end(outbound)
+
+    def _work(self, stage: Stage[T], inbound: Queue, outbound: Queue | None, remaining: "_Countdown") -> None:
+        while True:
+            item = self._get(inbound)
+            if item is _END:
+                # 同じステージのほかのスレッドにも終端を知らせる。
+                self._end(inbound)
+                break
+
+            if self._process(stage, item) and outbound is not None:
+                if self._put(outbound, item):
+                    continue
+            self._finish(item)
+
+        # 最後に停止したスレッドが、次のステージに終端を送る。
+        if remaining.decrement() and outbound is not None:
+            self._end(outbound)
+
+    def _drain(self, queue: Queue) -> None:
+        while True:
+            try:
+                entry = queue.get_nowait()
+            except Empty:
+                return
+            if entry is not _END:
+                item, _ = entry
+                self._finish(item)
+
+class _Countdown:
+    def __init__(self, count: int) -> None:
+        self.count = count
+        self.lock = threading.Lock()
+
+    def decrement(self) -> bool:
+        with self.lock:
+            self.count -= 1
+            return self.count == 0
@@ -0,0 +1,88 @@
+from pathlib import Path
+
+from dashcamtools.encoders import EncoderPreset, LIBX264
+from dashcamtools.probe import probe_keyframes
+from dashcamtools.util import temporary_path
+
+# 一覧用のサムネイルを並べたスプライトの大きさ。クリップ全体から等間隔に、列数 × 行数のフレームを選ぶ。
+SPRITE_COLUMNS = 10
+SPRITE_ROWS = 10
+# スプライトのサムネイル 1 枚の幅（ピクセル）。
+SPRITE_WIDTH = 320
+# クリップの長さがわからない場合の、サムネイルの間隔（秒）。
+THUMBNAIL_INTERVAL = 10.0
+# 確認用の低解像度の動画の高さ（ピクセル）。
+PROXY_HEIGHT = 360
+PROXY_PRESET = EncoderPreset(LIBX264, { "crf": "30", "preset": "veryfast" })
+
+class PreviewPaths:
+    def __init__(self, sprite: Path, proxy: Path, keyframes: Path) -> None:
+        self.sprite = sprite
+        self.proxy = proxy
+        # キーフレームの時刻（秒）を 1 行に 1 つずつ書いたテキストファイル。
+        self.keyframes = keyframes
+
+    def to_columns(self) -> dict[str, str | None]:
+        # VideoFile の列の値。書き出せなかったものは None にする。
+        return {
+            "sprite_path": str(self.sprite) if self.sprite.is_file() else None,
+            "proxy_path": str(self.proxy) if self.proxy.is_file() else None,
+            "keyframes_path": str(self.keyframes) if self.keyframes.is_file() else None,
+        }
+
+def preview_paths(directory: Path, name: str) -> PreviewPaths:
+    stem = Path(name).stem
+    return PreviewPaths(
+        sprite=directory / f"{stem}.sprite.jpg",
+        proxy=directory / f"{stem}.proxy.mp4",
+        keyframes=directory / f"{stem}.keyframes.txt",
+    )
+
+def thumbnail_interval(duration: float | None) -> float:
+    if duration is None or duration <= 0:
+        return THUMBNAIL_INTERVAL
+    return max(duration / (SPRITE_COLUMNS * SPRITE_ROWS), 1.0)
+
+def compress_with_previews_command(input_path: str, output_path: str, preset: EncoderPreset, threads: int | None, sprite_path: str, proxy_path: str, duration: float | None) -> list[str]:
+    # 一度のデコードを split で分け、圧縮と同時にスプライトと低解像度の動画を書き出す。
+    # 圧縮したファイルには、compress_command と同様に音声や字幕、データのストリームも含める。
+    graph = ";".join([
+        "[0:v:0]split=3[archive][sprite][proxy]",
+        f"[sprite]fps={1 / thumbnail_interval(duration):.6f},scale={SPRITE_WIDTH}:-2,tile={SPRITE_COLUMNS}x{SPRITE_ROWS}[sprite_out]",
+        f"[proxy]scale=-2:{PROXY_HEIGHT}[proxy_out]",
+    ])
+    return [
+        "ffmpeg",
+        "-y", # overwrite
+        "-loglevel", "error",
+        "-i", input_path,
+        "-filter_complex", graph,
+        "-map", "[archive]",
+        "-map", "0:a?",
+        "-map", "0:s?",
+        "-map", "0:d?",
+        *preset.arguments(threads),
+        "-c:a", "copy",
+        output_path,
+        "-map", "[sprite_out]",
+        "-frames:v", "1",
+        "-update", "1",
+        sprite_path,
+        "-map", "[proxy_out]",
+        "-map", "0:a?",
+        # 低解像度の動画も同じプロセスでエンコードするため、このジョブに割り当てたコアの数に抑える。
+        *PROXY_PRESET.arguments(threads),
+        "-c:a", "copy",
+        "-movflags", "+faststart",
+        proxy_path,
+    ]
+
+def write_keyframes(video_path: Path, keyframes_path: Path) -> list[float]:
+    keyframes = probe_keyframes(video_path)
+    with temporary_path(suffix=".txt", dir=keyframes_path.parent) as temp:
+        temp.write_text("".join(f"{keyframe:.6f}\n" for keyframe in keyframes), encoding="utf-8")
+        temp.replace(keyframes_path)
+    return keyframes
+
+def read_keyframes(keyframes_path: Path) -> list[float]:
+    return [float(line) for line in keyframes_path.read_text(encoding="utf-8").splitlines() if line.strip()]
@@ -0,0 +1,109 @@
+import json
+from pathlib import Path
+import subprocess
+
+# ffprobe の実行時間の上限（秒）。ネットワーク越しのファイルで応答がなくなっても、呼び出し元を止め続けないようにする。
+# パケットを数える場合もデコードはしないため、録画 1 つ分であれば十分に収まる。
+PROBE_TIMEOUT = 120.0
+
+def probe_duration(path: Path) -> float:
+    command = [
+        "ffprobe",
+        "-v", "error",
+        "-show_entries", "format=duration",
+        "-of", "default=noprint_wrappers=1:nokey=1",
+        str(path),
+    ]
+    result = subprocess.run(command, capture_output=True, text=True, check=True, timeout=PROBE_TIMEOUT)
+    return float(result.stdout.strip())
+
+def count_frames(path: Path) -> int:
+    # デコードせずに、映像ストリームのパケットの数を数える。
+    command = [
+        "ffprobe",
+        "-v", "error",
+        "-select_streams", "v:0",
+        "-count_packets",
+        "-show_entries", "stream=nb_read_packets",
+        "-of", "default=noprint_wrappers=1:nokey=1",
+        str(path),
+    ]
+    result = subprocess.run(command, capture_output=True, text=True, check=True, timeout=PROBE_TIMEOUT)
+    return int(result.stdout.strip())
+
+class VideoInfo:
+    def __init__(self, codec: str | None, bit_rate: int | None, width: int | None, height: int | None, duration: float | None) -> None:
+        self.codec = codec
+        # 映像ストリームのビットレート（bps）。ストリームに記録されていなければ、コンテナ全体のもの。
+        self.bit_rate = bit_rate
+        self.width = width
+        self.height = height
+        self.duration = duration
+
+def probe_video(path: Path) -> VideoInfo:
+    # コンテナのヘッダーだけを読み、デコードはしない。
+    command = [
+        "ffprobe",
+        "-v", "error",
+        "-select_streams", "v:0",
+        "-show_entries", "format=duration,bit_rate:stream=codec_name,width,height,bit_rate",
+        "-of", "json",
+        str(path),
+    ]
+    result = subprocess.run(command, capture_output=True, text=True, check=True, timeout=PROBE_TIMEOUT)
+    probed = json.loads(result.stdout)
+
+    format = probed.get("format", {})
+    streams = probed.get("streams", [])
+    stream = streams[0] if streams else {}
+
+    def to_int(value: str | None) -> int | None:
+        return int(value) if value not in (None, "N/A") else None
+
+    def to_float(value: str | None) -> float | None:
+        return float(value) if value not in (None, "N/A") else None
+
+    return VideoInfo(
+        codec=stream.get("codec_name"),
+        bit_rate=to_int(stream.get("bit_rate")) or to_int(format.get("bit_rate")),
+        width=to_int(stream.get("width")),
+        height=to_int(stream.get("height")),
+        duration=to_float(format.get("duration")),
+    )
+
+# concat demuxer でストリームコピーするには、これらがすべてのファイルで一致している必要がある。
+STREAM_PARAMETERS = ["codec_type", "codec_name", "profile", "width", "height", "pix_fmt", "r_frame_rate", "time_base", "sample_rate", "channels"]
+
+def probe_stream_parameters(path: Path) -> list[tuple]:
+    command = [
+        "ffprobe",
+        "-v", "error",
+        "-show_entries", f"stream={','.join(STREAM_PARAMETERS)}",
+        "-of", "json",
+        str(path),
+    ]
+    result = subprocess.run(command, capture_output=True, text=True, check=True, timeout=PROBE_TIMEOUT)
+    streams = json.loads(result.stdout).get("streams", [])
+    return [tuple(stream.get(key) for key in STREAM_PARAMETERS) for stream in streams]
+
+def is_stream_compatible(paths: list[Path]) -> bool:
+    parameters = [probe_stream_parameters(path) for path in paths]
+    return all(parameter == parameters[0] for parameter in parameters[1:])
+
+def probe_keyframes(path: Path) -> list[float]:
+    # パケットのフラグだけを読み、デコードせずに映像のキーフレームの時刻（秒）を求める。
+    command = [
+        "ffprobe",
+        "-v", "error",
+        "-select_streams", "v:0",
+        "-show_entries", "packet=pts_time,flags",
+        "-of", "csv=print_section=0",
+        str(path),
+    ]
+    result = subprocess.run(command, capture_output=True, text=True, check=True, timeout=PROBE_TIMEOUT)
+    keyframes = []
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(",")
+        if flags.startswith("K") and pts_time not in ("", "N/A"):
+            keyframes.append(float(pts_time))
+    return sorted(keyframes)
@@ -0,0 +1,128 @@
+import csv
+import math
+from pathlib import Path
+import re
+import subprocess
+import tempfile
+
+PATTERN_SSIM = re.compile(r"^n:\d+\s+.+\s+All:([\d+\.]+)\s\((.+?)\)$")
+PATTERN_PSNR = re.compile(r"\bpsnr_avg:(\S+)")
+
+class RunningStatistics:
+    # Welford のアルゴリズムで、値を保持せずに平均と分散を求める。
+    def __init__(self) -> None:
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    @property
+    def stddev(self) -> float:
+        # statistics.stdev と同じく、標本標準偏差を返す。
+        if self.count < 2:
+            return math.nan
+        return math.sqrt(self.m2 / (self.count - 1))
+
+    def values(self) -> list[float]:
+        return [self.min, self.max, self.mean, self.stddev]
+
+class QualityResult:
+    def __init__(self, target: Path, vmaf: bool) -> None:
+        self.target = target
+        self.ssim = RunningStatistics()
+        self.ssim_db = RunningStatistics()
+        self.psnr = RunningStatistics()
+        self.vmaf = RunningStatistics() if vmaf else None
+
+def window_inputs(path: Path, windows: list[tuple[float, float]]) -> list[str]:
+    # (開始位置, 長さ) の区間ごとに、同じファイルを別の入力として開く。
+    return [argument for offset, length in windows for argument in ["-ss", f"{offset:.3f}", "-t", f"{length:.3f}", "-i", str(path.resolve())]]
+
+def concat_filter(first: int, count: int) -> str:
+    inputs = "".join(f"[{index}:v]" for index in range(first, first + count))
+    return f"{inputs}concat=n={count}:v=1:a=0"
+
+def build_filter(count: int, every_nth: int, vmaf: bool, windows: int = 0) -> str:
+    # 入力は 0 から count - 1 までが比較対象、count 以降がオリジナル。
+    # オリジナルは 1 回だけデコードし、split で各比較対象との比較に分配する。
+    # windows を指定した場合は、オリジナルの各区間をつなげたものを比較の基準とする。
+    select = f"select=not(mod(n\\,{every_nth}))," if every_nth > 1 else ""
+    metrics = 3 if vmaf else 2
+
+    reference = f"{concat_filter(count, windows)}," if windows > 0 else f"[{count}:v]"
+    references = "".join(f"[r{index}_{metric}]" for index in range(count) for metric in range(metrics))
+    filters = [f"{reference}{select}split={count * metrics}{references}"]
+    for index in range(count):
+        distorted = "".join(f"[d{index}_{metric}]" for metric in range(metrics))
+        filters.append(f"[{index}:v]{select}split={metrics}{distorted}")
+        filters.append(f"[d{index}_0][r{index}_0]ssim=stats_file=ssim{index}.log")
+        filters.append(f"[d{index}_1][r{index}_1]psnr=stats_file=psnr{index}.log")
+        if vmaf:
+            filters.append(f"[d{index}_2][r{index}_2]libvmaf=log_fmt=csv:log_path=vmaf{index}.csv")
+    return ";".join(filters)
+
+def measure_quality(targets: list[Path], original: Path, every_nth: int = 1, vmaf: bool = False, windows: list[tuple[float, float]] | None = None, timeout: float | None = None) -> list[QualityResult]:
+    with tempfile.TemporaryDirectory() as work_dir:
+        original_inputs = window_inputs(original, windows) if windows else ["-i", str(original.resolve())]
+        command = [
+            "ffmpeg",
+            "-y",
+            "-loglevel", "error",
+            *[argument for target in targets for argument in ["-i", str(target.resolve())]],
+            *original_inputs,
+            "-filter_complex", build_filter(len(targets), every_nth, vmaf, len(windows) if windows else 0),
+            "-an",
+            "-f", "null",
+            "-"
+        ]
+        # 統計ファイルのパスにドライブレターのコロンが含まれないよう、作業ディレクトリからの相対パスで指定する。
+        subprocess.run(command, cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True, timeout=timeout)
+
+        results = []
+        for index, target in enumerate(targets):
+            result = QualityResult(target, vmaf)
+            parse_ssim(Path(work_dir, f"ssim{index}.log"), result)
+            parse_psnr(Path(work_dir, f"psnr{index}.log"), result)
+            if vmaf:
+                parse_vmaf(Path(work_dir, f"vmaf{index}.csv"), result)
+            results.append(result)
+        return results
+
+# 統計ファイルはフレームごとに 1 行なので、1 行ずつ読んで集計し、メモリ使用量を動画の長さによらず一定にする。
+def parse_ssim(path: Path, result: QualityResult) -> None:
+    with path.open(encoding="utf-8") as file:
+        for line in file:
+            match = PATTERN_SSIM.search(line.rstrip("\n"))
+            if not match:
+                continue
+
+            (all, db) = match.groups()
+            result.ssim.add(float(all))
+            result.ssim_db.add(float(db))
+
+def parse_psnr(path: Path, result: QualityResult) -> None:
+    with path.open(encoding="utf-8") as file:
+        for line in file:
+            match = PATTERN_PSNR.search(line)
+            if not match:
+                continue
+
+            # 同一のフレームでは inf になるため、集計から除く。
+            psnr = float(match[1])
+            if math.isfinite(psnr):
+                result.psnr.add(psnr)
+
+def parse_vmaf(path: Path, result: QualityResult) -> None:
+    with path.open(encoding="utf-8", newline="") as file:
+        for row in csv.DictReader(file):
+            if row.get("vmaf"):
+                result.vmaf.add(float(row["vmaf"]))
@@ -1,11 +1,67 @@
-from typing import Iterable, Sequence
+from datetime import datetime, timedelta, timezone
+import sys
+import threading
+import time
+from typing import Callable, ContextManager, Iterable, Iterator, Sequence
 
-from sqlalchemy import func, delete, select, Delete, Select
+from sqlalchemy import bindparam, case, cast, extract, func, delete, insert, inspect, literal, not_, or_, select, update, ColumnElement, DateTime, Delete, Select
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm import Session
 
-from dashcamtools.orm import Log, Report, VideoFile
+from dashcamtools.encoders import EncoderPreset, PRESETS, parse_options
+from dashcamtools.orm import Base, CompressJob, ContentHash, EncoderPresetRecord, Log, MachineLease, ProbeResult, Report, ReportStatus, ScannedDirectory, ScannedFile, TuneResult, VideoDirection, VideoFile, WorkLease
 from dashcamtools.util import Snowflake
 
+# SQLite のバインド変数の上限（古いバージョンでは 999）を超えないように、IN 句に渡す値を分割する。
+CHUNK_SIZE = 500
+
+def chunked(values: Iterable, size: int = CHUNK_SIZE) -> Iterator[list]:
+    chunk = []
+    for value in values:
+        chunk.append(value)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def column_values(entity: Base) -> dict:
+    return { attribute.key: getattr(entity, attribute.key) for attribute in inspect(entity).mapper.column_attrs }
+
+def insert_ignoring_duplicates(db: Session, entity_class: type[Base], rows: list[dict]) -> None:
+    # 複数のワーカーが同時に同じ行を追加しても失敗しないよう、主キーが重複する行は無視する。
+    if not rows:
+        return
+
+    dialect = db.get_bind().dialect.name
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    elif dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        for row in rows:
+            try:
+                with db.begin_nested():
+                    db.execute(insert(entity_class), [row])
+            except IntegrityError:
+                pass
+        return
+    db.execute(dialect_insert(entity_class).on_conflict_do_nothing(), rows)
+
+def epoch_seconds(db: Session, column: ColumnElement) -> ColumnElement:
+    # ISO 8601 の文字列で保存した時刻を、UNIX 時間の秒数（小数を含む）にする式。
+    if db.get_bind().dialect.name == "sqlite":
+        return (func.julianday(column) - 2440587.5) * 86400.0
+    return extract("epoch", cast(column, DateTime(timezone=True)))
+
+class TimelineSegment:
+    def __init__(self, direction: VideoDirection, start_minute: int, end_minute: int, count: int) -> None:
+        self.direction = direction
+        self.start_minute = start_minute
+        self.end_minute = end_minute
+        # 区間に含まれるファイルの数。
+        self.count = count
+
 class VideoFileRepository:
     def __init__(self, db: Session):
         self.db = db
@@ -13,38 +69,444 @@ class VideoFileRepository:
     def add(self, video: VideoFile) -> VideoFile:
         self.db.add(video)
         return video
+
+    def add_all_ignoring_duplicates(self, videos: Iterable[VideoFile]) -> None:
+        # ほかのワーカーが先に追加したファイルは、そのレコードを使う。
+        for chunk in chunked(videos):
+            insert_ignoring_duplicates(self.db, VideoFile, [column_values(video) for video in chunk])
     
     def find_by_name(self, name: str) -> VideoFile | None:
         return self.db.execute(select(VideoFile).filter(VideoFile.name == name)).scalar()
 
     def list_by_names(self, names: Iterable[str]) -> Sequence[VideoFile]:
-        query = select(VideoFile).filter(VideoFile.name.in_(names)).order_by(Video.mtime.asc())
-        return self.db.execute(query).scalars().all()
+        videos: list[VideoFile] = []
+        for chunk in chunked(names):
+            query = select(VideoFile).filter(VideoFile.name.in_(chunk))
+            videos.extend(self.db.execute(query).scalars().all())
+        return sorted(videos, key=lambda video: video.mtime)
 
-    def fill_attributes_all(self) -> None:
-        query = select(VideoFile).filter(VideoFile.is_rear == None or VideoFile.is_rear == None or VideoFile.recorded_at == None)
-        for video in self.db.execute(query).scalars().all():
-            video.fill_attributes()
-            print(video)
-            print(video.recorded_at)
+    def list_timeline(self, direction: VideoDirection, start_minute: int, end_minute: int, is_event: bool | None = None) -> Sequence[VideoFile]:
+        # (direction, unix_minute) のインデックスによる範囲検索。
+        query = select(VideoFile).filter(VideoFile.direction == direction, VideoFile.unix_minute.between(start_minute, end_minute))
+        if is_event is not None:
+            query = query.filter(VideoFile.is_event == is_event)
+        return self.db.execute(query.order_by(VideoFile.unix_minute.asc())).scalars().all()
 
-class ReportRepository:
+    def list_segments(self, direction: VideoDirection, start_minute: int, end_minute: int, is_event: bool | None = None) -> list[TimelineSegment]:
+        # 連続した分ごとに同じ値になる unix_minute - DENSE_RANK() でまとめ、途切れなく録画された区間を求める。
+        # 同じ分に常時録画とイベント録画の両方がある場合も、1 分として数える。
+        rank = func.dense_rank().over(order_by=VideoFile.unix_minute)
+        timeline = select(VideoFile.unix_minute, (VideoFile.unix_minute - rank).label("island")) \
+            .filter(VideoFile.direction == direction, VideoFile.unix_minute.between(start_minute, end_minute))
+        if is_event is not None:
+            timeline = timeline.filter(VideoFile.is_event == is_event)
+        timeline = timeline.subquery()
+
+        query = select(func.min(timeline.c.unix_minute), func.max(timeline.c.unix_minute), func.count()) \
+            .group_by(timeline.c.island) \
+            .order_by(func.min(timeline.c.unix_minute))
+        return [TimelineSegment(direction, start, end, count) for start, end, count in self.db.execute(query).all()]
+
+    def iterate_names_without_attributes(self, chunk_size: int) -> Iterator[Sequence[str]]:
+        # 名前だけを chunk_size 件ずつ読み出し、ORM オブジェクトを作らずにメモリ使用量を一定に保つ。
+        query = select(VideoFile.name) \
+            .filter(or_(VideoFile.direction == None, VideoFile.is_event == None, VideoFile.recorded_at == None, VideoFile.unix_minute == None)) \
+            .execution_options(yield_per=chunk_size)
+        for partition in self.db.execute(query).scalars().partitions():
+            yield partition
+
+    def update_attributes(self, rows: list[dict]) -> None:
+        # rows の各要素は name, direction, is_event, recorded_at, unix_minute をもつ。executemany でまとめて更新する。
+        table = VideoFile.__table__
+        statement = update(table) \
+            .where(table.c.name == bindparam("target_name")) \
+            .values(direction=bindparam("direction"), is_event=bindparam("is_event"), recorded_at=bindparam("recorded_at"), unix_minute=bindparam("unix_minute"))
+        self.db.execute(statement, [{ **row, "target_name": row["name"] } for row in rows])
+
+class ScanIndexRepository:
+    def __init__(self, db: Session):
+        self.db = db
+
+    def find_directory(self, path: str) -> ScannedDirectory | None:
+        return self.db.get(ScannedDirectory, path)
+
+    def list_files(self, directory: str) -> Sequence[ScannedFile]:
+        return self.db.execute(select(ScannedFile).filter(ScannedFile.directory == directory)).scalars().all()
+
+    def save_directory(self, path: str, mtime: float) -> None:
+        # merge では、同じディレクトリを同時に走査したワーカーとの間で INSERT が競合する。
+        insert_ignoring_duplicates(self.db, ScannedDirectory, [{ "path": path, "mtime": mtime }])
+        self.db.execute(update(ScannedDirectory).filter(ScannedDirectory.path == path).values(mtime=mtime))
+
+    def add_files(self, files: Iterable[ScannedFile]) -> None:
+        # 同じディレクトリを同時に走査したほかのワーカーが、先に追加していることがある。
+        for chunk in chunked(files):
+            insert_ignoring_duplicates(self.db, ScannedFile, [column_values(file) for file in chunk])
+
+    def delete_files(self, directory: str, names: Iterable[str]) -> None:
+        for chunk in chunked(names):
+            self.db.execute(delete(ScannedFile).filter(ScannedFile.directory == directory, ScannedFile.name.in_(chunk)))
+
+class ProbeResultRepository:
+    def __init__(self, db: Session):
+        self.db = db
+
+    def list_by_names(self, names: Iterable[str]) -> Sequence[ProbeResult]:
+        results: list[ProbeResult] = []
+        for chunk in chunked(names):
+            results.extend(self.db.execute(select(ProbeResult).filter(ProbeResult.name.in_(chunk))).scalars().all())
+        return results
+
+    def add(self, result: ProbeResult) -> None:
+        # 同じファイルをほかのワーカーが先に調べていることがある。内容は同じになるため、重複は無視する。
+        insert_ignoring_duplicates(self.db, ProbeResult, [column_values(result)])
+
+class CompressJobRepository:
+    def __init__(self, db: Session):
+        self.db = db
+
+    def list_by_names(self, names: Iterable[str]) -> Sequence[CompressJob]:
+        jobs: list[CompressJob] = []
+        for chunk in chunked(names):
+            jobs.extend(self.db.execute(select(CompressJob).filter(CompressJob.name.in_(chunk))).scalars().all())
+        return jobs
+
+    def save(self, job: CompressJob) -> None:
+        # job はセッションから切り離したものを各スレッドが保持するため、merge で書き込む。
+        self.db.merge(job)
+
+class ContentHashRepository:
+    def __init__(self, db: Session):
+        self.db = db
+
+    def list_by_partial_hash(self, size: int, partial_hash: str) -> Sequence[ContentHash]:
+        return self.db.execute(select(ContentHash).filter(ContentHash.size == size, ContentHash.partial_hash == partial_hash)).scalars().all()
+
+    def list_names(self, directory: str) -> Sequence[str]:
+        return self.db.execute(select(ContentHash.name).filter(ContentHash.directory == directory)).scalars().all()
+
+    def save(self, content_hash: ContentHash) -> None:
+        self.db.merge(content_hash)
+
+class WorkLeaseRepository:
+    def __init__(self, db: Session):
+        self.db = db
+
+    def claim(self, names: Sequence[str], owner: str, seconds: float, limit: int) -> list[str]:
+        # names の先頭から、誰も持っていないか期限の切れたリースを、最大 limit 件取得する。
+        now = datetime.now(tz=timezone.utc)
+        claimable = or_(WorkLease.owner.is_(None), WorkLease.expires_at < now)
+        claimed: list[str] = []
+        for chunk in chunked(names):
+            if len(claimed) >= limit:
+                break
+
+            existing = set(self.db.execute(select(WorkLease.name).filter(WorkLease.name.in_(chunk))).scalars())
+            insert_ignoring_duplicates(self.db, WorkLease, [{ "name": name, "owner": None, "claimed_at": None, "heartbeat_at": None, "expires_at": now } for name in chunk if name not in existing])
+
+            taken = set(self.db.execute(select(WorkLease.name).filter(WorkLease.name.in_(chunk), not_(claimable))).scalars())
+            wanted = [name for name in chunk if name not in taken][:limit - len(claimed)]
+            if not wanted:
+                continue
+
+            # 条件付きの UPDATE は行ごとに不可分なため、ほかのワーカーが先に取得した行は更新されない。
+            # 取得できた行は、claimed_at がこの呼び出しの時刻になっているもの。
+            self.db.execute(update(WorkLease).filter(WorkLease.name.in_(wanted), claimable).values(owner=owner, claimed_at=now, heartbeat_at=now, expires_at=now + timedelta(seconds=seconds)))
+            won = set(self.db.execute(select(WorkLease.name).filter(WorkLease.name.in_(wanted), WorkLease.owner == owner, WorkLease.claimed_at == now)).scalars())
+            claimed.extend(name for name in wanted if name in won)
+        return claimed
+
+    def extend(self, owner: str, seconds: float) -> int:
+        now = datetime.now(tz=timezone.utc)
+        return self.db.execute(update(WorkLease).filter(WorkLease.owner == owner).values(heartbeat_at=now, expires_at=now + timedelta(seconds=seconds))).rowcount
+
+    def is_owned(self, name: str, owner: str) -> bool:
+        return self.db.execute(select(WorkLease.name).filter(WorkLease.name == name, WorkLease.owner == owner)).first() is not None
+
+    def count_active(self, owner: str) -> int:
+        now = datetime.now(tz=timezone.utc)
+        return self.db.execute(select(func.count()).select_from(WorkLease).filter(WorkLease.owner == owner, WorkLease.expires_at >= now)).scalar_one()
+
+    def list_expirations(self, names: Iterable[str]) -> dict[str, datetime]:
+        # names のうち、いずれかのワーカーが有効なリースを持っているファイルと、その期限。
+        now = datetime.now(tz=timezone.utc)
+        expirations: dict[str, datetime] = {}
+        for chunk in chunked(names):
+            query = select(WorkLease.name, WorkLease.expires_at).filter(WorkLease.name.in_(chunk), WorkLease.owner.is_not(None), WorkLease.expires_at >= now)
+            expirations.update({ name: expires_at for name, expires_at in self.db.execute(query).all() })
+        return expirations
+
+    def release(self, names: Iterable[str], owner: str) -> None:
+        for chunk in chunked(names):
+            self.db.execute(delete(WorkLease).filter(WorkLease.name.in_(chunk), WorkLease.owner == owner))
+
+    def release_all(self, owner: str) -> int:
+        return self.db.execute(delete(WorkLease).filter(WorkLease.owner == owner)).rowcount
+
+class MachineLeaseRepository:
+    def __init__(self, db: Session):
+        self.db = db
+
+    def claim(self, candidates: Iterable[int], owner: str, seconds: float) -> int | None:
+        # candidates の先頭から、誰も持っていないか期限の切れた machine_id を 1 つ取得する。取得できなければ None。
+        # 前回このワーカーが落ちたときのリースは、期限を待たずに手放す。
+        self.release(owner)
+        now = datetime.now(tz=timezone.utc)
+        claimable = or_(MachineLease.owner.is_(None), MachineLease.expires_at < now)
+        taken = set(self.db.execute(select(MachineLease.machine_id).filter(not_(claimable))).scalars())
+        for machine_id in candidates:
+            if machine_id in taken:
+                continue
+
+            insert_ignoring_duplicates(self.db, MachineLease, [{ "machine_id": machine_id, "owner": None, "heartbeat_at": None, "expires_at": now }])
+            # 条件付きの UPDATE は行ごとに不可分なため、ほかのワーカーが先に取得した行は更新されない。
+            self.db.execute(update(MachineLease).filter(MachineLease.machine_id == machine_id, claimable).values(owner=owner, heartbeat_at=now, expires_at=now + timedelta(seconds=seconds)))
+            if self.db.execute(select(MachineLease.owner).filter(MachineLease.machine_id == machine_id)).scalar_one() == owner:
+                return machine_id
+        return None
+
+    def find_owner(self, machine_id: int) -> str | None:
+        # machine_id の有効なリースを持っているワーカー。
+        now = datetime.now(tz=timezone.utc)
+        return self.db.execute(select(MachineLease.owner).filter(MachineLease.machine_id == machine_id, MachineLease.expires_at >= now)).scalar_one_or_none()
+
+    def extend(self, owner: str, seconds: float) -> int:
+        now = datetime.now(tz=timezone.utc)
+        return self.db.execute(update(MachineLease).filter(MachineLease.owner == owner).values(heartbeat_at=now, expires_at=now + timedelta(seconds=seconds))).rowcount
+
+    def release(self, owner: str) -> int:
+        return self.db.execute(delete(MachineLease).filter(MachineLease.owner == owner)).rowcount
+
+class EncoderPresetRepository:
     def __init__(self, db: Session):
         self.db = db
 
+    def find_by_name(self, name: str) -> EncoderPreset | None:
+        record = self.db.get(EncoderPresetRecord, name)
+        if record is not None:
+            return EncoderPreset(record.codec, parse_options(record.options))
+        return PRESETS.get(name)
+
+    def save(self, name: str, preset: EncoderPreset) -> None:
+        self.db.merge(EncoderPresetRecord(name=name, codec=preset.codec, options=preset.format_options()))
+
+class TuneResultRepository:
+    def __init__(self, db: Session):
+        self.db = db
+
+    def find(self, clip_hash: str, codec: str, options: str, jobs: int, threads: int, every_nth: int) -> TuneResult | None:
+        return self.db.get(TuneResult, (clip_hash, codec, options, jobs, threads, every_nth))
+
+    def add(self, result: TuneResult) -> TuneResult:
+        self.db.add(result)
+        return result
+
+# close で書き込みに失敗した場合に、再試行する回数。
+CLOSE_ATTEMPTS = 3
+
+class BufferedWriter:
+    # Log や Report の INSERT をためておき、件数か経過時間がしきい値を超えたらまとめて書き込む。
+    def __init__(self, session_factory: Callable[[], ContextManager[Session]], max_rows: int = 100, max_delay: float = 5.0):
+        self.session_factory = session_factory
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.rows: dict[type[Base], list[dict]] = {}
+        self.count = 0
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.flusher: threading.Thread | None = None
+        # 書き込みに失敗した後、add から再び flush を試みるまでの時刻。
+        self.retry_at = 0.0
+
+    def __enter__(self) -> "BufferedWriter":
+        # 書き込みが途絶えても、max_delay 秒以上ためたままにしない。
+        self.flusher = threading.Thread(target=self._flush_periodically, name="flusher", daemon=True)
+        self.flusher.start()
+        return self
+
+    def __exit__(self, *_) -> None:
+        # 例外や KeyboardInterrupt で抜ける場合も、ためている行をすべて書き込む。
+        self.close()
+
+    def add(self, entity: Base) -> None:
+        values = column_values(entity)
+        with self.lock:
+            self.rows.setdefault(type(entity), []).append(values)
+            self.count += 1
+            # 書き込みに失敗した後は、max_delay 秒ごとの定期的な flush に再試行を任せる。
+            if self.count >= self.max_rows and time.monotonic() >= self.retry_at:
+                # 呼び出し元のスレッドには、書き込みの失敗を伝えない。
+                try:
+                    self._flush()
+                except Exception as e:
+                    print(f"Failed to write buffered rows. ({e})", file=sys.stderr)
+
+    def flush(self) -> None:
+        with self.lock:
+            self._flush()
+
+    def close(self) -> None:
+        self.closed.set()
+        if self.flusher is not None:
+            self.flusher.join()
+
+        for attempt in range(CLOSE_ATTEMPTS):
+            try:
+                self.flush()
+                return
+            except Exception as e:
+                print(f"Failed to write buffered rows. ({e})", file=sys.stderr)
+                if attempt + 1 < CLOSE_ATTEMPTS:
+                    time.sleep(self.max_delay)
+
+        # 書き込めなかった行は、失われないように標準エラー出力に残す。
+        with self.lock:
+            for entity_class, rows in self.rows.items():
+                for row in rows:
+                    print(f"Unwritten {entity_class.__tablename__} row: {row}", file=sys.stderr)
+
+    def _flush(self) -> None:
+        if self.count == 0:
+            return
+
+        try:
+            with self.session_factory() as db:
+                for entity_class, rows in self.rows.items():
+                    if rows:
+                        db.execute(insert(entity_class), rows)
+                db.commit()
+        except OperationalError:
+            # 接続の切断やロックの待ち時間切れなど、一時的な失敗であれば、次回の flush で再試行できるように行を残す。
+            self.retry_at = time.monotonic() + self.max_delay
+            raise
+        except Exception:
+            # 一部の行が制約に違反していると、まとめた INSERT ごと失敗する。1 行ずつ書き込み直し、違反した行だけを捨てる。
+            self._flush_each()
+            return
+
+        self.rows = {}
+        self.count = 0
+
+    def _flush_each(self) -> None:
+        remaining: dict[type[Base], list[dict]] = {}
+        error: Exception | None = None
+        with self.session_factory() as db:
+            for entity_class, rows in self.rows.items():
+                for row in rows:
+                    if error is not None:
+                        remaining.setdefault(entity_class, []).append(row)
+                        continue
+                    try:
+                        db.execute(insert(entity_class), [row])
+                        db.commit()
+                    except OperationalError as e:
+                        # 一時的な失敗の後は、残りの行も書き込まずに次回の flush に回す。
+                        db.rollback()
+                        error = e
+                        remaining.setdefault(entity_class, []).append(row)
+                    except Exception as e:
+                        db.rollback()
+                        print(f"Dropped a {entity_class.__tablename__} row that cannot be written. ({e})", file=sys.stderr)
+
+        self.rows = remaining
+        self.count = sum(len(rows) for rows in remaining.values())
+        if error is not None:
+            self.retry_at = time.monotonic() + self.max_delay
+            raise error
+
+    def _flush_periodically(self) -> None:
+        while not self.closed.wait(self.max_delay):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Failed to write buffered rows. ({e})", file=sys.stderr)
+
+class ReportRepository:
+    def __init__(self, db: Session, writer: BufferedWriter | None = None):
+        self.db = db
+        self.writer = writer
+
     def create(self, report: Report) -> Report:
+        if self.writer is not None:
+            self.writer.add(report)
+            return report
+
         self.db.add(report)
         self.db.commit()
         return report
 
+    def list_savings_rates(self) -> dict[tuple[VideoDirection | None, bool | None], float]:
+        # エンコードに成功したレポートから、(direction, is_event) ごとに、エンコード 1 秒あたりに削減したバイト数を求める。
+        query = select(VideoFile.direction, VideoFile.is_event, func.sum(Report.original_bytes - Report.compressed_bytes), func.sum(Report.duration_compress)) \
+            .join(VideoFile, VideoFile.name == Report.name) \
+            .filter(Report.status == ReportStatus.SUCCESSFUL, Report.codec != "copy", Report.duration_compress > 0) \
+            .group_by(VideoFile.direction, VideoFile.is_event)
+        return { (direction, is_event): saved / seconds for direction, is_event, saved, seconds in self.db.execute(query).all() if seconds }
+
+    def list_percentiles(self, value: ColumnElement, percentiles: list[float], since: datetime | None = None, group: ColumnElement | None = None) -> list[tuple]:
+        # 成功したレポートの value の百分位数（最近順位法）を、group ごとに求める。
+        # 各行の順位と件数をウィンドウ関数で求め、順位が p * 件数 以上の最小の値を選ぶことで、行を読み出さずに SQL の中で集計する。
+        # 結果の各行は (group の値, 件数, 各百分位数...)。
+        partition_by = group if group is not None else None
+        ranked = select(
+            (group if group is not None else literal(None)).label("key"),
+            value.label("value"),
+            func.row_number().over(partition_by=partition_by, order_by=value).label("position"),
+            func.count().over(partition_by=partition_by).label("total"),
+        ).filter(Report.status == ReportStatus.SUCCESSFUL, value.is_not(None))
+        if since is not None:
+            ranked = ranked.filter(Report.started_at >= since)
+        ranked = ranked.subquery()
+
+        query = select(ranked.c.key, func.max(ranked.c.total), *[func.min(case((ranked.c.position >= percentile * ranked.c.total, ranked.c.value))) for percentile in percentiles]) \
+            .group_by(ranked.c.key) \
+            .order_by(ranked.c.key)
+        return [tuple(row) for row in self.db.execute(query).all()]
+
+    def summarize_codecs(self, since: datetime | None = None) -> list[tuple]:
+        # 結果の各行は (codec, 件数, 元のバイト数, 圧縮後のバイト数, 平均の画質, 平均のフレームレート, 圧縮にかかった時間)。
+        query = select(Report.codec, func.count(), func.sum(Report.original_bytes), func.sum(Report.compressed_bytes), func.avg(Report.quality), func.avg(Report.encode_fps), func.sum(Report.duration_compress)) \
+            .filter(Report.status == ReportStatus.SUCCESSFUL) \
+            .group_by(Report.codec) \
+            .order_by(Report.codec)
+        if since is not None:
+            query = query.filter(Report.started_at >= since)
+        return [tuple(row) for row in self.db.execute(query).all()]
+
+    def measure_busy_time(self, since: datetime | None = None) -> tuple[int, float]:
+        # 並行して処理したジョブの時間を重複して数えないよう、各ジョブの [開始, 終了] の区間を重なりごとにまとめ、
+        # 何かしらのジョブを処理していた時間の合計と、その間に処理したバイト数を求める。
+        start = epoch_seconds(self.db, Report.started_at)
+        intervals = select(start.label("start"), (start + Report.duration).label("end"), Report.original_bytes.label("size")) \
+            .filter(Report.status == ReportStatus.SUCCESSFUL, Report.duration.is_not(None))
+        if since is not None:
+            intervals = intervals.filter(Report.started_at >= since)
+        intervals = intervals.subquery()
+
+        # それまでの区間の終了のいずれよりも後に始まる区間が、新しいまとまりの始まりとなる。
+        previous_end = func.max(intervals.c.end).over(order_by=intervals.c.start, rows=(None, -1))
+        flagged = select(intervals.c.start, intervals.c.end, intervals.c.size, case((or_(previous_end == None, intervals.c.start > previous_end), 1), else_=0).label("is_first")).subquery()
+        numbered = select(flagged.c.start, flagged.c.end, flagged.c.size, func.sum(flagged.c.is_first).over(order_by=flagged.c.start, rows=(None, 0)).label("island")).subquery()
+        islands = select((func.max(numbered.c.end) - func.min(numbered.c.start)).label("seconds"), func.sum(numbered.c.size).label("size")) \
+            .group_by(numbered.c.island) \
+            .subquery()
+
+        size, seconds = self.db.execute(select(func.sum(islands.c.size), func.sum(islands.c.seconds))).one()
+        return size or 0, seconds or 0.0
+
 class LogRepository:
-    def __init__(self, db: Session, snowflake: Snowflake):
+    def __init__(self, db: Session, snowflake: Snowflake, writer: BufferedWriter | None = None):
         self.db = db
         self.snowflake = snowflake
+        self.writer = writer
 
     def create(self, log: Log) -> Log:
         log.id = self.snowflake.generate()
 
+        if self.writer is not None:
+            self.writer.add(log)
+            return log
+
         self.db.add(log)
         self.db.commit()
         return log
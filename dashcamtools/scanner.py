@@ -0,0 +1,49 @@
+from fnmatch import fnmatch
+import os
+from pathlib import Path
+
+from dashcamtools.orm import ScannedFile
+from dashcamtools.repositories import ScanIndexRepository
+
+def scan_directory(repository: ScanIndexRepository, directory: Path, pattern: str, full_rescan: bool = False) -> list[ScannedFile]:
+    # ディレクトリの走査結果を DB に保持し、前回から変化したエントリだけを stat する。
+    key = str(directory)
+    directory_mtime = directory.stat().st_mtime
+
+    indexed_directory = repository.find_directory(key)
+    indexed_files = { file.name: file for file in repository.list_files(key) }
+
+    if not full_rescan and indexed_directory is not None and indexed_directory.mtime == directory_mtime:
+        return list(indexed_files.values())
+
+    files: list[ScannedFile] = []
+    new_files: list[ScannedFile] = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            # glob と同様に、Windows では大文字と小文字を区別しない。
+            if not fnmatch(entry.name, pattern) or not entry.is_file():
+                continue
+
+            # 索引にあるファイルは stat し直さない。書き込み中のファイルのサイズと更新時刻は、--full-rescan か --watch の待機で確かめる。
+            indexed = indexed_files.pop(entry.name, None)
+            if indexed is not None and not full_rescan:
+                files.append(indexed)
+                continue
+
+            stat = entry.stat()
+            if indexed is not None:
+                indexed.size = stat.st_size
+                indexed.mtime = stat.st_mtime
+                files.append(indexed)
+            else:
+                file = ScannedFile(directory=key, name=entry.name, size=stat.st_size, mtime=stat.st_mtime)
+                files.append(file)
+                new_files.append(file)
+
+    # 残ったものは、前回の走査以降に削除されたファイル。
+    repository.delete_files(key, indexed_files.keys())
+    repository.add_files(new_files)
+    repository.save_directory(key, directory_mtime)
+    repository.db.commit()
+
+    return files
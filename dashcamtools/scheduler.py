@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Sequence, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from dashcamtools.orm import VideoDirection, VideoFile
+
+# 処理の順序を決める方針。複数指定した場合は、先に指定したものを優先する。
+POLICY_EVENT = "event"
+POLICY_OLDEST = "oldest"
+POLICY_SAVINGS = "savings"
+POLICIES = [POLICY_EVENT, POLICY_OLDEST, POLICY_SAVINGS]
+
+class SavingsEstimator:
+    # 過去のレポートから求めた、エンコード 1 秒あたりに削減できたバイト数。
+    # 前方と後方のカメラや、常時録画とイベント録画では映像の性質が異なるため、(direction, is_event) ごとに分ける。
+    def __init__(self, rates: dict[tuple[VideoDirection | None, bool | None], float]) -> None:
+        self.rates = rates
+        self.default = sum(rates.values()) / len(rates) if rates else 0.0
+
+    def rate(self, video: VideoFile) -> float:
+        return self.rates.get((video.direction, video.is_event), self.default)
+
+def order_videos(videos: Sequence[VideoFile], sizes: dict[str, int], policies: list[str], estimator: SavingsEstimator) -> list[VideoFile]:
+    def key(video: VideoFile) -> tuple:
+        values = []
+        for policy in policies:
+            if policy == POLICY_EVENT:
+                values.append(0 if video.is_event else 1)
+            elif policy == POLICY_OLDEST:
+                values.append(video.mtime)
+            elif policy == POLICY_SAVINGS:
+                # 削減の効率が同じであれば、大きいファイルほど多くの容量を空けられる。
+                values.extend([-estimator.rate(video), -sizes.get(video.name, 0)])
+        return tuple(values)
+
+    return sorted(videos, key=key)
+
+class DiskPressure:
+    # path のあるボリュームの空き容量が watermark バイトを下回っているかどうか。
+    # 各エンコードの開始時に問い合わせるため、interval 秒の間は前回の結果を使う。
+    def __init__(self, path: Path, watermark: int, interval: float = 10.0, on_change: Callable[[bool, int], None] | None = None) -> None:
+        self.path = path
+        self.watermark = watermark
+        self.interval = interval
+        self.on_change = on_change
+        self.active = False
+        self.checked_at: float | None = None
+        self.lock = threading.Lock()
+
+    def is_active(self) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            if self.checked_at is not None and now - self.checked_at < self.interval:
+                return self.active
+
+            free = shutil.disk_usage(self.path).free
+            active = free < self.watermark
+            changed = active != self.active
+            self.active = active
+            self.checked_at = now
+
+        if changed and self.on_change is not None:
+            self.on_change(active, free)
+        return active
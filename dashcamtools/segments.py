@@ -0,0 +1,86 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import subprocess
+import tempfile
+from typing import Callable
+
+from dashcamtools.encoders import compress_command, EncoderPreset
+from dashcamtools.probe import count_frames, probe_duration
+
+# つなげた後の長さと元の長さの差の、チャンク 1 つあたりの許容範囲（秒）。チャンクの境界で、音声がフレーム単位でずれることがある。
+DURATION_TOLERANCE = 0.1
+
+class SegmentMismatchError(Exception):
+    pass
+
+def run_command(command: list[str], timeout: float | None = None) -> None:
+    subprocess.run(command, stderr=subprocess.PIPE, text=True, check=True, timeout=timeout)
+
+def write_concat_list(paths: list[Path], list_path: Path) -> None:
+    list_path.write_text("".join(f"file '{path.resolve()}'\n" for path in paths), encoding="utf-8")
+
+def split_at_keyframes(source: Path, work_dir: Path, count: int, duration: float, timeout: float | None = None) -> list[Path]:
+    # -c copy ではキーフレームでしか分割できないため、それぞれの時刻の後にある最初のキーフレームで分かれる。
+    times = ",".join(f"{duration * index / count:.3f}" for index in range(1, count))
+    run_command([
+        "ffmpeg",
+        "-y",
+        "-loglevel", "error",
+        "-i", str(source),
+        "-map", "0",
+        "-c", "copy",
+        "-f", "segment",
+        "-segment_times", times,
+        "-reset_timestamps", "1",
+        str(work_dir / f"chunk%03d{source.suffix}"),
+    ], timeout)
+    return sorted(work_dir.glob(f"chunk*{source.suffix}"))
+
+def chunk_command(chunk: Path, output: Path, preset: EncoderPreset, threads: int | None) -> list[str]:
+    # 分割の境界で音声が映像より先に始まると、既定の固定フレームレートの出力ではフレームが複製されるため、タイムスタンプをそのまま使う。
+    command = compress_command(str(chunk), str(output), preset, threads)
+    return [*command[:-1], "-fps_mode", "passthrough", command[-1]]
+
+def encode_chunks(chunks: list[Path], outputs: list[Path], preset: EncoderPreset, workers: int, threads: int | None, encode: Callable[[list[str]], None] = run_command) -> None:
+    # チャンクごとに別のプロセスでエンコードし、1 つのプロセスでは使い切れないコアを埋める。
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda chunk, output: encode(chunk_command(chunk, output, preset, threads)), chunks, outputs))
+
+def join_chunks(chunks: list[Path], output: Path, work_dir: Path, timeout: float | None = None) -> None:
+    list_path = work_dir / "chunks.txt"
+    write_concat_list(chunks, list_path)
+    run_command([
+        "ffmpeg",
+        "-y",
+        "-loglevel", "error",
+        "-f", "concat",
+        "-safe", "0",
+        "-i", str(list_path),
+        "-map", "0",
+        "-c", "copy",
+        "-movflags", "+faststart",
+        str(output),
+    ], timeout)
+
+def verify_join(output: Path, frames: int, duration: float, chunk_count: int) -> None:
+    actual_frames = count_frames(output)
+    actual_duration = probe_duration(output)
+    if actual_frames != frames or abs(actual_duration - duration) > DURATION_TOLERANCE * chunk_count:
+        raise SegmentMismatchError(f"{output.name}: expected {frames} frames and {duration:.3f} seconds, but got {actual_frames} frames and {actual_duration:.3f} seconds.")
+
+def encode_segmented(source: Path, output: Path, preset: EncoderPreset, count: int, threads: int | None, encode: Callable[[list[str]], None] = run_command, work_dir: Path | None = None, timeout: float | None = None) -> int:
+    # source をキーフレームで count 個に分割して並行してエンコードし、ストリームコピーでつなげる。
+    # つなげた結果のフレーム数と長さが元と一致しなければ SegmentMismatchError を送出する。実際に分割した数を返す。
+    # timeout は、分割とつなげるストリームコピーのそれぞれにかけてよい時間（秒）。
+    duration = probe_duration(source)
+    frames = count_frames(source)
+
+    with tempfile.TemporaryDirectory(dir=work_dir) as temp_dir:
+        chunk_dir = Path(temp_dir)
+        chunks = split_at_keyframes(source, chunk_dir, count, duration, timeout)
+        outputs = [chunk_dir / f"encoded{index:03d}{source.suffix}" for index in range(len(chunks))]
+        encode_chunks(chunks, outputs, preset, len(chunks), threads, encode)
+        join_chunks(outputs, output, chunk_dir, timeout)
+
+    verify_join(output, frames, duration, len(chunks))
+    return len(chunks)
@@ -1,9 +1,11 @@
 import os
 
-from dotenv import load_dotenv
 
+def database_url() -> str:
+    # python-dotenv の読み込みにも時間がかかるため、DB に接続するときに初めて読み込む。
+    from dotenv import load_dotenv
 
-load_dotenv()
+    load_dotenv()
 
-# 例: "sqlite:///./dashcam-tools.db"
-DATABASE_URL: str = os.environ["DATABASE_URL"]
+    # 例: "sqlite:///./dashcam-tools.db"
+    return os.environ["DATABASE_URL"]
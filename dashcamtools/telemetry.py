@@ -0,0 +1,208 @@
+from collections import deque
+import os
+from pathlib import Path
+import subprocess
+import threading
+import time
+
+from dashcamtools.orm import Report, ReportStatus
+
+# 失敗したときにログに残す、ffmpeg の標準エラー出力の末尾の行数。
+STDERR_LINES = 50
+# 進捗が止まっていないかを確かめる間隔（秒）。
+POLL_INTERVAL = 1.0
+# クリップの長さか過去の速度が分からない場合の、進捗が止まったとみなすまでの時間（秒）。
+DEFAULT_STALL_TIMEOUT = 300.0
+# 過去の速度から見込んだエンコード全体の時間に対する、進捗が止まったとみなすまでの時間の割合。
+STALL_FACTOR = 0.5
+
+class StalledError(subprocess.SubprocessError):
+    def __init__(self, cmd: list[str], timeout: float, stderr: str | None = None) -> None:
+        self.cmd = cmd
+        self.timeout = timeout
+        self.stderr = stderr
+
+    def __str__(self) -> str:
+        return f"Command '{self.cmd[0]}' made no progress for {self.timeout:.0f} seconds and was killed."
+
+class EncodeStats:
+    # ffmpeg の -progress の出力と、プロセスの資源使用量から求めた、1 回のエンコードの統計。
+    def __init__(self) -> None:
+        self.frames: int | None = None
+        self.fps: float | None = None
+        self.speed: float | None = None
+        # 出力のビットレート（kbit/s）。
+        self.bitrate: float | None = None
+        self.total_size: int | None = None
+        # 出力済みの長さ（マイクロ秒）と、それが最後に進んだ時刻（time.monotonic）。
+        self.out_time_us = 0
+        self.progressed_at = time.monotonic()
+        self.duration: float = 0.0
+        self.cpu_time: float | None = None
+        # 最大常駐メモリ（Linux では KB、macOS ではバイト）。
+        self.max_rss: int | None = None
+
+    def update(self, key: str, value: str) -> None:
+        # 値が未確定の間は "N/A" が出力される。
+        try:
+            match key:
+                case "frame":
+                    self.frames = int(value)
+                case "fps":
+                    self.fps = float(value)
+                case "speed":
+                    self.speed = float(value.rstrip("x"))
+                case "bitrate":
+                    self.bitrate = float(value.removesuffix("kbits/s"))
+                case "total_size":
+                    self.total_size = int(value)
+                case "out_time_us":
+                    out_time_us = int(value)
+                    if out_time_us > self.out_time_us:
+                        self.out_time_us = out_time_us
+                        self.progressed_at = time.monotonic()
+        except ValueError:
+            pass
+
+    @property
+    def average_fps(self) -> float | None:
+        # -progress の fps は直近の値なので、全体の平均はフレーム数と経過時間から求める。
+        if self.frames is None or self.duration <= 0:
+            return self.fps
+        return self.frames / self.duration
+
+def with_progress(command: list[str]) -> list[str]:
+    return [command[0], "-progress", "pipe:1", "-nostats", *command[1:]]
+
+def stall_timeout(duration: float | None, speed: float | None, minimum: float) -> float:
+    # 過去の速度でエンコード全体にかかると見込まれる時間の一定の割合。ただし minimum 秒より短くはしない。
+    if not duration or not speed:
+        return max(minimum, DEFAULT_STALL_TIMEOUT)
+    return max(minimum, duration / speed * STALL_FACTOR)
+
+def run_with_progress(command: list[str], timeout: float | None = None, stderr_lines: int = STDERR_LINES) -> EncodeStats:
+    # 標準出力に書き出される key=value の進捗を読みながら ffmpeg を実行する。
+    # 出力済みの長さが timeout 秒以上進まなければ、ffmpeg が止まったとみなして強制終了し、StalledError を送出する。
+    # 失敗した場合の例外の stderr には、標準エラー出力の末尾 stderr_lines 行を入れる。
+    stats = EncodeStats()
+    stderr: deque[str] = deque(maxlen=stderr_lines)
+    start = time.perf_counter()
+    process = subprocess.Popen(with_progress(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, errors="replace")
+
+    def read_progress():
+        for line in process.stdout:
+            key, _, value = line.strip().partition("=")
+            stats.update(key, value)
+
+    def read_stderr():
+        for line in process.stderr:
+            stderr.append(line.rstrip("\n"))
+
+    progress_reader = threading.Thread(target=read_progress, name="ffmpeg-progress", daemon=True)
+    stderr_reader = threading.Thread(target=read_stderr, name="ffmpeg-stderr", daemon=True)
+    progress_reader.start()
+    stderr_reader.start()
+
+    # 標準出力が閉じられるのは ffmpeg が終了したときなので、それまで進捗を見張る。
+    stalled = False
+    while progress_reader.is_alive():
+        progress_reader.join(POLL_INTERVAL)
+        if timeout is not None and not stalled and time.monotonic() - stats.progressed_at > timeout:
+            stalled = True
+            process.kill()
+    stderr_reader.join()
+    process.stdout.close()
+    process.stderr.close()
+
+    if hasattr(os, "wait4"):
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        stats.cpu_time = usage.ru_utime + usage.ru_stime
+        stats.max_rss = usage.ru_maxrss
+    else:
+        process.wait()
+    stats.duration = time.perf_counter() - start
+
+    if stalled:
+        raise StalledError(process.args, timeout, "\n".join(stderr))
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args, stderr="\n".join(stderr))
+    return stats
+
+def merge_stats(stats: list[EncodeStats], duration: float, clip_duration: float | None) -> EncodeStats:
+    # 並行して実行した複数のエンコードの統計を、duration 秒かかった 1 つのエンコードとしてまとめる。
+    merged = EncodeStats()
+    merged.frames = sum(stat.frames or 0 for stat in stats)
+    merged.duration = duration
+    merged.speed = clip_duration / duration if clip_duration and duration > 0 else None
+    cpu_times = [stat.cpu_time for stat in stats if stat.cpu_time is not None]
+    merged.cpu_time = sum(cpu_times) if cpu_times else None
+    # 同時に動いていたプロセスのメモリの合計。
+    max_rsses = [stat.max_rss for stat in stats if stat.max_rss is not None]
+    merged.max_rss = sum(max_rsses) if max_rsses else None
+    return merged
+
+def megabytes_per_second(size: int | None, seconds: float | None) -> float | None:
+    if size is None or not seconds:
+        return None
+    return size / seconds / 1e6
+
+class MetricsExporter:
+    # node_exporter の textfile collector が読む、Prometheus のテキスト形式のファイルに書き出す。
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.files = { status: 0 for status in ReportStatus }
+        self.bytes = { "original": 0, "compressed": 0 }
+        self.stage_seconds = { "download": 0.0, "compress": 0.0, "upload": 0.0, "wait": 0.0 }
+        self.cpu_seconds = 0.0
+        self.encode_fps: float | None = None
+        self.encode_speed: float | None = None
+        self.last_success: float | None = None
+
+    def observe(self, report: Report) -> None:
+        with self.lock:
+            self.files[report.status] += 1
+            if report.status != ReportStatus.SUCCESSFUL:
+                return
+
+            self.bytes["original"] += report.original_bytes or 0
+            self.bytes["compressed"] += report.compressed_bytes or 0
+            for stage, seconds in [("download", report.duration_download), ("compress", report.duration_compress), ("upload", report.duration_upload), ("wait", report.duration_wait)]:
+                self.stage_seconds[stage] += seconds or 0.0
+            self.cpu_seconds += report.cpu_time or 0.0
+            if report.encode_fps is not None:
+                self.encode_fps = report.encode_fps
+                self.encode_speed = report.encode_speed
+            self.last_success = time.time()
+
+    def write(self, free_bytes: int | None = None) -> None:
+        with self.lock:
+            lines = [
+                "# HELP dashcam_compress_files_total Files processed by compress.",
+                "# TYPE dashcam_compress_files_total counter",
+                *[f'dashcam_compress_files_total{{status="{status.value}"}} {count}' for status, count in self.files.items()],
+                "# HELP dashcam_compress_bytes_total Bytes read from Raw and written to Archive.",
+                "# TYPE dashcam_compress_bytes_total counter",
+                *[f'dashcam_compress_bytes_total{{kind="{kind}"}} {count}' for kind, count in self.bytes.items()],
+                "# HELP dashcam_compress_stage_seconds_total Seconds spent in each stage.",
+                "# TYPE dashcam_compress_stage_seconds_total counter",
+                *[f'dashcam_compress_stage_seconds_total{{stage="{stage}"}} {seconds:.3f}' for stage, seconds in self.stage_seconds.items()],
+                "# HELP dashcam_compress_cpu_seconds_total CPU time consumed by ffmpeg.",
+                "# TYPE dashcam_compress_cpu_seconds_total counter",
+                f"dashcam_compress_cpu_seconds_total {self.cpu_seconds:.3f}",
+            ]
+            gauges = [
+                ("dashcam_compress_encode_fps", "Average frames per second of the last encode.", self.encode_fps),
+                ("dashcam_compress_encode_speed", "Speed of the last encode relative to real time.", self.encode_speed),
+                ("dashcam_compress_last_success_timestamp_seconds", "Unix time of the last successful file.", self.last_success),
+                ("dashcam_compress_raw_free_bytes", "Free space of the Raw volume.", free_bytes),
+            ]
+            for name, help, value in gauges:
+                if value is not None:
+                    lines.extend([f"# HELP {name} {help}", f"# TYPE {name} gauge", f"{name} {value}"])
+
+        # collector が書きかけのファイルを読まないよう、別名で書いてから置き換える。
+        temp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        temp.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        temp.replace(self.path)
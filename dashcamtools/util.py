@@ -1,10 +1,15 @@
 from contextlib import contextmanager
 from datetime import datetime
+import hashlib
+import os
 from pathlib import Path
+import sys
 import tempfile
+import threading
 import time
 from typing import Generator
 import uuid
+import weakref
 
 # 2010-11-04T01:42:54.657Z
 ORIGINAL_TIMESTAMP = 1288834974657
@@ -14,8 +19,7 @@ def temporary_path(suffix: str | None = None, dir: Path | None = None) -> Genera
     
     try:
         if dir is not None:
-            path = Path(dir, str(uuid.uuid4()))
-            path = path.with_suffix(suffix=suffix) if suffix else path
+            path = random_path(dir, suffix)
             yield path
         else:
             temp = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
@@ -25,30 +29,88 @@ def temporary_path(suffix: str | None = None, dir: Path | None = None) -> Genera
     finally:
         path.unlink(missing_ok=True)
 
+def random_path(dir: Path, suffix: str | None = None) -> Path:
+    path = Path(dir, str(uuid.uuid4()))
+    return path.with_suffix(suffix) if suffix else path
+
+def numbered_name(name: str, index: int) -> str:
+    path = Path(name)
+    return f"{path.stem} ({index}){path.suffix}"
+
 def resolve_unique_path(destination: Path) -> Path:
     if not destination.exists():
         return destination
     
     parent = destination.parent
-    stem = destination.stem
-    suffix = destination.suffix
     
     index = 1
     while True:
-        new_path = parent / f"{stem} ({index}){suffix}"
+        new_path = parent / numbered_name(destination.name, index)
         if not new_path.exists():
             return new_path
         index += 1
 
+def resolve_unique_name(name: str, taken: set[str]) -> str:
+    # resolve_unique_path と同じ規則で、ファイルシステムではなく taken にない名前を選ぶ。
+    if name not in taken:
+        return name
+
+    index = 1
+    while numbered_name(name, index) in taken:
+        index += 1
+    return numbered_name(name, index)
+
+def file_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as file:
+        while chunk := file.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 def iso8601(datetime: datetime) -> str:
     return datetime.isoformat(timespec="milliseconds").replace("+00:00", "Z")
 
+# 時計が戻ったときや、1 ミリ秒の連番を使い切ったときに、時計より先の時刻の ID を使える幅（ミリ秒）。超える場合は時計が追いつくまで待つ。
+MAX_CLOCK_LEAD_MS = 10_000
+
+@contextmanager
+def locked_file(path: Path) -> Generator[int, None, None]:
+    # ファイル全体をロックし、ほかのプロセスを待たせる。ファイル記述子を返す。
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        if sys.platform == "win32":
+            import msvcrt
+            # LK_LOCK は 10 秒で諦めるため、ロックできるまで待ち続ける。
+            while True:
+                try:
+                    msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.001)
+            try:
+                yield fd
+            finally:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield fd
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
 class Snowflake:
-    def __init__(self, machine_id: int) -> None:
+    # スレッドからもプロセスからも同時に使える ID の生成器。同じミリ秒の連番を block_size 個ずつまとめて予約し、ID ごとの排他を軽くする。
+    # state_path を指定すると、最後に予約した時刻と連番をそのファイルで共有し、同じ machine_id の複数のプロセスや、再起動の前後でも重複させない。
+    def __init__(self, machine_id: int, block_size: int = 64, state_path: Path | None = None) -> None:
         self.machine_id = machine_id
         self.epoch = ORIGINAL_TIMESTAMP
-        self.sequence = 0
-        self.last_timestamp = -1
+        self.block_size = block_size
+        self.state_path = state_path
 
         self.machine_id_bits = 10
         self.sequence_bits = 12
@@ -61,35 +123,86 @@ class Snowflake:
 
         if self.machine_id > self.max_machine_id or self.machine_id < 0:
             raise ValueError(f"machine_id must be between 0 and {self.max_machine_id}")
+        if not 1 <= self.block_size <= self.max_sequence + 1:
+            raise ValueError(f"block_size must be between 1 and {self.max_sequence + 1}")
 
-    def generate(self) -> int:
-        timestamp = self._timestamp()
-
-        if timestamp < self.last_timestamp:
-            raise Exception("Clock moved backwards. Refusing to generate id")
-
-        if self.last_timestamp == timestamp:
-            self.sequence = (self.sequence + 1) & self.max_sequence
-            if self.sequence == 0:
-                timestamp = self._wait_next_millis(self.last_timestamp)
-        else:
-            self.sequence = 0
-
-        self.last_timestamp = timestamp
+        self.lock = threading.Lock()
+        # 最後に予約した時刻と、その時刻で使った最後の連番。
+        self.last_timestamp = -1
+        self.sequence = self.max_sequence
+        # 予約済みで、まだ使っていない ID の範囲 [next_id, end_id)。
+        self.block_timestamp = -1
+        self.next_id = 0
+        self.end_id = 0
+        # fork した子プロセスは、親が予約した残りを使わずに予約し直す。
+        forked_snowflakes.add(self)
 
-        snowflake_id = ((timestamp - self.epoch) << self.timestamp_shift) | \
+    def generate(self) -> int:
+        with self.lock:
+            # 時計が予約した時刻を過ぎていれば、ID の時刻が古くならないよう、残りを捨てて予約し直す。
+            if self.next_id >= self.end_id or self._timestamp() > self.block_timestamp:
+                self._reserve()
+            snowflake_id = self.next_id
+            self.next_id += 1
+            return snowflake_id
+
+    def _reserve(self) -> None:
+        if self.state_path is None:
+            self._reserve_block()
+            return
+
+        with locked_file(self.state_path) as fd:
+            # ほかのプロセスが予約した分と、このプロセスが予約した分の新しいほうに続ける。
+            os.lseek(fd, 0, os.SEEK_SET)
+            saved = os.read(fd, 64).split()
+            if len(saved) == 2:
+                saved_timestamp, saved_sequence = int(saved[0]), int(saved[1])
+                if (saved_timestamp, saved_sequence) > (self.last_timestamp, self.sequence):
+                    self.last_timestamp, self.sequence = saved_timestamp, saved_sequence
+            self._reserve_block()
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, f"{self.last_timestamp} {self.sequence}".encode("ascii"))
+
+    def _reserve_block(self) -> None:
+        while True:
+            timestamp = self._timestamp()
+            if timestamp > self.last_timestamp:
+                next_timestamp, next_sequence = timestamp, 0
+            elif self.sequence < self.max_sequence:
+                # 同じミリ秒か、時計が戻った場合は、前の時刻の連番の続きを使う。
+                next_timestamp, next_sequence = self.last_timestamp, self.sequence + 1
+            else:
+                # 連番を使い切った場合は、時計を待たずに次のミリ秒を先に使う。
+                next_timestamp, next_sequence = self.last_timestamp + 1, 0
+
+            lead = next_timestamp - timestamp
+            if lead <= MAX_CLOCK_LEAD_MS:
+                break
+            # 時計が大きく戻った場合は、例外にせず、追いつくまで眠って待つ。時計が再び補正されることもあるため、1 秒ごとに調べ直す。
+            time.sleep(min((lead - MAX_CLOCK_LEAD_MS) / 1000, 1.0))
+
+        count = min(self.block_size, self.max_sequence - next_sequence + 1)
+        self.last_timestamp = next_timestamp
+        self.sequence = next_sequence + count - 1
+        self.block_timestamp = max(next_timestamp, timestamp)
+        self.next_id = ((next_timestamp - self.epoch) << self.timestamp_shift) | \
                        (self.machine_id << self.machine_id_shift) | \
-                       self.sequence
-
-        return snowflake_id
+                       next_sequence
+        self.end_id = self.next_id + count
 
     def _timestamp(self) -> int:
-        return int(time.time() * 1000)
+        return time.time_ns() // 1_000_000
 
-    def _wait_next_millis(self, last_timestamp: int) -> int:
-        timestamp = self._timestamp()
-        while timestamp <= last_timestamp:
-            timestamp = self._timestamp()
-        return timestamp
+    def _discard(self) -> None:
+        self.lock = threading.Lock()
+        self.end_id = self.next_id
+
+forked_snowflakes: "weakref.WeakSet[Snowflake]" = weakref.WeakSet()
 
+def discard_forked_snowflakes() -> None:
+    for snowflake in forked_snowflakes:
+        snowflake._discard()
 
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=discard_forked_snowflakes)
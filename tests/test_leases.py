@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine, update
+from sqlalchemy.orm import Session
+
+from dashcamtools.leases import machine_id_candidates, machine_id_of
+from dashcamtools.migrations import migrate
+from dashcamtools.orm import MachineLease
+from dashcamtools.repositories import MachineLeaseRepository
+
+# ワーカーの ID から求めた machine_id が重なる 2 つのワーカー。
+COLLIDING_WORKERS = ("worker95", "worker100")
+
+class MachineLeaseTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+
+        engine = create_engine(f"sqlite:///{Path(temp_dir.name, 'db.sqlite')}")
+        self.addCleanup(engine.dispose)
+        migrate(engine)
+        self.db = Session(engine)
+        self.addCleanup(self.db.close)
+        self.repository = MachineLeaseRepository(self.db)
+
+    def test_colliding_workers_get_different_machine_ids(self):
+        first, second = COLLIDING_WORKERS
+        self.assertEqual(machine_id_of(first), machine_id_of(second))
+
+        first_id = self.repository.claim(machine_id_candidates(first), first, 60)
+        second_id = self.repository.claim(machine_id_candidates(second), second, 60)
+        self.assertEqual(first_id, machine_id_of(first))
+        self.assertIsNotNone(second_id)
+        self.assertNotEqual(first_id, second_id)
+
+    def test_machine_id_held_by_active_worker_is_not_claimed(self):
+        first, second = COLLIDING_WORKERS
+        machine_id = machine_id_of(first)
+        self.assertEqual(self.repository.claim([machine_id], first, 60), machine_id)
+
+        self.assertIsNone(self.repository.claim([machine_id], second, 60))
+        self.assertEqual(self.repository.find_owner(machine_id), first)
+
+    def test_expired_or_released_machine_id_is_claimed(self):
+        first, second = COLLIDING_WORKERS
+        machine_id = machine_id_of(first)
+        self.repository.claim([machine_id], first, 60)
+        self.db.execute(update(MachineLease).values(expires_at=datetime.now(tz=timezone.utc) - timedelta(seconds=1)))
+        self.assertEqual(self.repository.claim([machine_id], second, 60), machine_id)
+
+        self.repository.release(second)
+        self.assertIsNone(self.repository.find_owner(machine_id))
+        self.assertEqual(self.repository.claim([machine_id], first, 60), machine_id)
+
+    def test_restarted_worker_reclaims_its_machine_id(self):
+        # 強制終了したワーカーが同じ --worker-id で起動し直した場合は、期限を待たずに同じ値を使う。
+        worker = COLLIDING_WORKERS[0]
+        machine_id = self.repository.claim(machine_id_candidates(worker), worker, 60)
+        self.assertEqual(self.repository.claim(machine_id_candidates(worker), worker, 60), machine_id)
+
+if __name__ == "__main__":
+    unittest.main()
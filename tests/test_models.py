@@ -0,0 +1,20 @@
+from datetime import datetime
+import unittest
+
+from dashcamtools.models import parse_video_name
+
+class ParseVideoNameTest(unittest.TestCase):
+    def test_valid_name(self):
+        self.assertEqual(parse_video_name("20240801_2408011403_GR.MP4"), (datetime(2024, 8, 1, 14, 3), True, False))
+
+    def test_unexpected_name(self):
+        self.assertIsNone(parse_video_name("20240801_2408011403.mp4"))
+
+    def test_impossible_timestamp(self):
+        # 形式には合うが、日付や時刻としてありえない名前。
+        for name in ["20240800_2408001403_NF.mp4", "20240801_2408012503_NF.mp4", "20240801_2413011403_NF.mp4", "20240801_2408011460_NF.mp4"]:
+            with self.subTest(name=name):
+                self.assertIsNone(parse_video_name(name))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import threading
+import unittest
+
+from dashcamtools.pipeline import Pipeline, Stage
+
+# run が戻らなかった場合に、テストを失敗させるまでの時間（秒）。
+TIMEOUT = 10.0
+
+def run_with_timeout(pipeline: Pipeline, items) -> Exception | None:
+    errors: list[Exception] = []
+
+    def target():
+        try:
+            pipeline.run(items)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(TIMEOUT)
+    if thread.is_alive():
+        raise AssertionError("Pipeline.run did not return.")
+    return errors[0] if errors else None
+
+def create_pipeline(finished: list, on_finish=None, depth: int = 1) -> Pipeline:
+    stages = [Stage("first", lambda item: True), Stage("second", lambda item: True, workers=2)]
+    return Pipeline(stages, depth=depth, on_error=lambda item, e: None, on_finish=on_finish or finished.append, on_wait=lambda item, seconds: None)
+
+class PipelineTest(unittest.TestCase):
+    def test_all_items_are_finished(self):
+        finished = []
+        self.assertIsNone(run_with_timeout(create_pipeline(finished), range(10)))
+        self.assertEqual(sorted(finished), list(range(10)))
+
+    def test_feed_error_is_raised_from_run(self):
+        def items():
+            yield 1
+            yield 2
+            raise OSError("share disconnected")
+
+        finished = []
+        error = run_with_timeout(create_pipeline(finished), items())
+        self.assertIsInstance(error, OSError)
+
+    def test_failing_on_finish_does_not_hang(self):
+        finished = []
+
+        def on_finish(item):
+            finished.append(item)
+            raise RuntimeError("database is locked")
+
+        self.assertIsNone(run_with_timeout(create_pipeline(finished, on_finish), range(10)))
+        self.assertEqual(sorted(finished), list(range(10)))
+
+    def test_failing_on_error_does_not_hang(self):
+        finished = []
+
+        def process(item):
+            raise ValueError(item)
+
+        def on_error(item, e):
+            raise RuntimeError("failed to report")
+
+        pipeline = Pipeline([Stage("first", process, workers=2)], depth=1, on_error=on_error, on_finish=finished.append, on_wait=lambda item, seconds: None)
+        self.assertIsNone(run_with_timeout(pipeline, range(10)))
+        self.assertEqual(sorted(finished), list(range(10)))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+from pathlib import Path
+import tempfile
+import unittest
+from unittest import mock
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from dashcamtools.migrations import migrate
+from dashcamtools.repositories import ScanIndexRepository
+from dashcamtools.scanner import scan_directory
+
+class ScanDirectoryTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.directory = Path(temp_dir.name, "Raw")
+        self.directory.mkdir()
+        for index in range(5):
+            Path(self.directory, f"{index}.mp4").write_bytes(b"x" * index)
+
+        engine = create_engine(f"sqlite:///{Path(temp_dir.name, 'db.sqlite')}")
+        self.addCleanup(engine.dispose)
+        migrate(engine)
+        self.db = Session(engine)
+        self.addCleanup(self.db.close)
+        self.repository = ScanIndexRepository(self.db)
+
+    def count_stats(self) -> tuple[mock.MagicMock, mock.MagicMock]:
+        # ディレクトリとファイルの stat、およびディレクトリの一覧の読み出しを数える。
+        path_stat = mock.patch.object(Path, "stat", autospec=True, side_effect=lambda path, **kwargs: os.stat(path, **kwargs))
+        scandir = mock.patch("dashcamtools.scanner.os.scandir", side_effect=os.scandir)
+        stat_mock = path_stat.start()
+        scandir_mock = scandir.start()
+        self.addCleanup(path_stat.stop)
+        self.addCleanup(scandir.stop)
+        return stat_mock, scandir_mock
+
+    def test_unchanged_directory_is_not_listed_nor_stat_per_file(self):
+        scan_directory(self.repository, self.directory, "*.mp4")
+        stat_mock, scandir_mock = self.count_stats()
+
+        files = scan_directory(self.repository, self.directory, "*.mp4")
+
+        self.assertEqual(len(files), 5)
+        # ディレクトリ自体の stat だけで済む。
+        self.assertEqual(stat_mock.call_count, 1)
+        self.assertEqual(scandir_mock.call_count, 0)
+
+    def test_changed_directory_stats_only_new_entries(self):
+        scan_directory(self.repository, self.directory, "*.mp4")
+        Path(self.directory, "new.mp4").write_bytes(b"new")
+        Path(self.directory, "0.mp4").unlink()
+        entry_stats = []
+        real_scandir = os.scandir
+
+        def scandir(path):
+            # DirEntry.stat は差し替えられないため、呼び出した名前を記録する包みを返す。
+            class Entry:
+                def __init__(self, entry):
+                    self.entry = entry
+                    self.name = entry.name
+
+                def is_file(self):
+                    return self.entry.is_file()
+
+                def stat(self):
+                    entry_stats.append(self.name)
+                    return self.entry.stat()
+
+            class Entries:
+                def __enter__(self):
+                    self.iterator = real_scandir(path)
+                    return (Entry(entry) for entry in self.iterator)
+
+                def __exit__(self, *_):
+                    self.iterator.close()
+
+            return Entries()
+
+        with mock.patch("dashcamtools.scanner.os.scandir", side_effect=scandir):
+            files = scan_directory(self.repository, self.directory, "*.mp4")
+
+        self.assertEqual(sorted(file.name for file in files), ["1.mp4", "2.mp4", "3.mp4", "4.mp4", "new.mp4"])
+        self.assertEqual(entry_stats, ["new.mp4"])
+        self.assertEqual(sorted(file.name for file in self.repository.list_files(str(self.directory))), ["1.mp4", "2.mp4", "3.mp4", "4.mp4", "new.mp4"])
+
+if __name__ == "__main__":
+    unittest.main()